@@ -0,0 +1,173 @@
+"""Benchmarks of the macro module.
+
+This script times the sample models in ziggie.samples as well as generated
+models that scale the number of leaf groups, the depth of the group tree,
+the number of compartments, the number of iterations, the record frequency
+and the number of simulate_series worker processes.
+
+Each benchmark is printed as one JSON object per line with the settings
+used and these measurements:
+
+    * seconds - wall time of the run
+    * iterations_per_second - model iterations executed per second
+    * peak_memory - peak bytes allocated by Python during the run (only
+                    with --memory because tracing allocations slows
+                    the run down; worker processes are not traced)
+    * output_bytes - approximate in-memory size of the recorded output
+
+It can be executed thus:
+
+python benchmarks/bench.py [--quick] [--memory] [--output results.jsonl]
+
+Compare the output of two versions of the package to catch performance
+regressions.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from ziggie import macro, samples
+
+BASE = {
+    'leaves': 100,
+    'depth': 2,
+    'compartments': 4,
+    'iterations': 100,
+    'record_frequency': 50,
+    'workers': 1,
+}
+
+SWEEPS = {
+    'leaves': [10, 100, 1000, 10000],
+    'depth': [1, 2, 3, 4],
+    'compartments': [3, 5, 8, 12],
+    'iterations': [10, 100, 1000],
+    'record_frequency': [1, 10, 100],
+    'workers': [1, 2, 4],
+}
+
+QUICK_SWEEPS = {
+    'leaves': [10, 100, 1000],
+    'depth': [1, 3],
+    'compartments': [3, 8],
+    'iterations': [10, 100],
+    'record_frequency': [1, 50],
+    'workers': [1, 2],
+}
+
+
+def fixtures():
+    models = samples.MacroModels()
+    return {
+        'simple': [models.simple()],
+        'complicated': [models.complicated()],
+        'granich': [models.granich()],
+        'seir': [models.seir()],
+        'corona': models.corona(),
+    }
+
+
+def synthetic_cases(sweeps):
+    seen = set()
+    for key, values in sweeps.items():
+        for value in values:
+            settings = dict(BASE)
+            settings[key] = value
+            ident = tuple(sorted(settings.items()))
+            if ident not in seen:
+                seen.add(ident)
+                yield settings
+
+
+def synthetic(settings):
+    model = samples.MacroModels().synthetic(settings['leaves'],
+                                            settings['depth'],
+                                            settings['compartments'])
+    model['parameters'] = {
+        'to': settings['iterations'],
+        'record_frequency': settings['record_frequency'],
+    }
+    return [model]
+
+
+def run(name, modelList, workers=1, memory=False, engine=None):
+    if engine is not None:
+        modelList = [dict(m, parameters=dict(m.get('parameters', {}),
+                                             engine=engine))
+                     for m in modelList]
+    parameters = [macro._make_parameters(m.get('parameters', {}))
+                  for m in modelList]
+    iterations = max(p['to'] for p in parameters) - \
+        min(p['from'] for p in parameters)
+    scenarios = 1 if workers == 1 else 2 * workers
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    if workers == 1:
+        results = macro.simulate(modelList)
+    else:
+        results = macro.simulate_series([modelList] * scenarios, workers)
+    seconds = time.perf_counter() - start
+    peak_memory = None
+    if memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        'name': name,
+        'models': len(modelList),
+        'groups': sum(len(list(macro.traverse(m))) for m in modelList),
+        'iterations': iterations,
+        'scenarios': scenarios,
+        'workers': workers,
+        'seconds': seconds,
+        'iterations_per_second': iterations * scenarios / seconds,
+        'peak_memory': peak_memory,
+        'output_bytes': macro._sizeof(results),
+        'records': len(results),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='run a smaller set of benchmarks')
+    parser.add_argument('--memory', action='store_true',
+                        help='measure peak memory (slows the runs down)')
+    parser.add_argument('--output', help='file to write results to '
+                        '(default standard output)')
+    parser.add_argument('--engine',
+                        help='engine parameter to run the models with')
+    parser.add_argument('--only', choices=['fixtures', 'synthetic'],
+                        help='only run one kind of benchmark')
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    environment = {'python': platform.python_version(),
+                   'machine': platform.machine(),
+                   'engine': args.engine or 'dict'}
+    try:
+        if args.only != 'synthetic':
+            for name, modelList in fixtures().items():
+                result = run(name, modelList, memory=args.memory,
+                             engine=args.engine)
+                result.update(environment)
+                print(json.dumps(result), file=out, flush=True)
+        if args.only != 'fixtures':
+            sweeps = QUICK_SWEEPS if args.quick else SWEEPS
+            for settings in synthetic_cases(sweeps):
+                result = run('synthetic', synthetic(settings),
+                             settings['workers'], args.memory, args.engine)
+                result.update(settings)
+                result.update(environment)
+                print(json.dumps(result), file=out, flush=True)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
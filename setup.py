@@ -13,6 +13,13 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/nathangeffen/ziggie",
     packages=setuptools.find_packages(),
+    extras_require={
+        'numpy': ['numpy'],
+        'pandas': ['pandas'],
+    },
+    entry_points={
+        'console_scripts': ['ziggie=ziggie.cli:main'],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
 
@@ -23,11 +30,9 @@ setuptools.setup(
         "Operating System :: OS Independent",
 
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3 :: Only",
     ],
-    python_requires=">=3.5",
+    python_requires=">=3.7",
 )
@@ -10,11 +10,33 @@ python test.py
 Requires Python 3.5 or higher.
 """
 
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
 import csv
-from ziggie import macro, samples
+import io
+import json
+import math
+import os
+import pickle
+import random
+from ziggie import aio, cache, cli, distributed, gillespie, macro, pool, \
+    samples
 import tempfile
+import threading
+import time
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
 
 class TestSimple(unittest.TestCase):
 
@@ -139,6 +161,1343 @@ class TestComplicated(unittest.TestCase):
             for pair in zip(table[-1], t[-5]):
                 self.assertEqual(str(pair[0]), str(pair[1]))
 
+    def test_table_layout(self):
+        # Groups at different depths take the missing leading names from
+        # the longest list of names seen so far
+        model = {
+            'name': 'A', 'iteration': 3, 'groups': [
+                {'name': 'B', 'groups': [
+                    {'name': 'b1', 'compartments': {'S': 1, 'I': 2}},
+                    {'name': 'b2', 'ident': 7,
+                     'compartments': {'S': 3, 'I': 4}}]},
+                {'name': 'C', 'compartments': {'S': 5, 'I': 6}},
+                {'groups': [{'name': 'd', 'groups': [
+                    {'name': 'e', 'compartments': {'S': 0, 'I': 1}}]}]},
+                {'compartments': {'S': 9, 'I': 9}}]}
+        expected = [[3, 'A', 'B', 'b1', 1, 2], [7, 'A', 'B', 'b2', 3, 4],
+                    [3, 'A', 'B', 'C', 5, 6], [3, 'A', 'd', 'e', 0, 1],
+                    [3, 'A', 'B', 'b1', 9, 9]]
+        self.assertEqual(macro.model_to_table(model), expected)
+        other = deepcopy(model)
+        other['iteration'] = 4
+        other['groups'][1]['compartments']['I'] = 8
+        table = macro.series_to_table([[model], [other]], False, '.')
+        self.assertEqual(table[3], [3, 'A.d.e', 0, 1])
+        self.assertEqual(table[7], [4, 'A.B.C', 5, 8])
+        other['groups'][1]['compartments'] = {'I': 8, 'S': 5}
+        table = macro.series_to_table([[model], [other]], False)
+        self.assertEqual(table[7], [4, 'A', 'B', 'C', 8, 5])
+
+
+class TestRecordLevel(unittest.TestCase):
+
+    def simulate(self, level):
+        model = samples.MacroModels().complicated()
+        model['parameters'] = {'record_level': level}
+        return macro.simulate([model])
+
+    def test_levels(self):
+        leaf = self.simulate('leaf')
+        totals = macro.calc_totals(leaf[-1][0])
+        del totals['N']
+
+        res = self.simulate('model')
+        self.assertEqual(len(res), len(leaf))
+        self.assertNotIn('groups', res[-1][0])
+        self.assertNotIn('parameters', res[-1][0])
+        self.assertEqual(res[-1][0]['iteration'], 365)
+        for key, value in totals.items():
+            self.assertAlmostEqual(res[-1][0]['compartments'][key], value)
+
+        res = self.simulate(2)
+        table = macro.modelList_to_table(res[-1])
+        self.assertEqual(table[0], ['iter', 'name_0', 'name_1', 'S', 'I', 'R'])
+        self.assertEqual(len(table), 3)
+        self.assertAlmostEqual(sum(row[3] for row in table[1:]), totals['S'])
+
+        res = self.simulate(10)
+        self.assertEqual(macro.modelList_to_table(res[-1]),
+                         macro.modelList_to_table(leaf[-1]))
+
+    def test_modelList(self):
+        models = samples.MacroModels().corona()
+        for model in models:
+            model['parameters'] = dict(model['parameters'],
+                                       record_level='modelList', noise=0.0)
+        res = macro.simulate(models)
+        self.assertEqual(len(res), 366)
+        self.assertEqual(len(res[-1]), 1)
+        self.assertAlmostEqual(
+            macro.grand_sum_totals([macro.calc_totals(res[0][0])]),
+            macro.grand_sum_totals([macro.calc_totals(res[-1][0])]), 5)
+
+
+class TestProfile(unittest.TestCase):
+
+    def test_simulate(self):
+        profile = macro.Profile(trace=True)
+        res = macro.simulate([samples.MacroModels().seir()], profile=profile)
+        plain = macro.simulate([samples.MacroModels().seir()])
+        self.assertEqual(macro.series_to_table(res),
+                         macro.series_to_table(plain))
+        report = profile.report()
+        self.assertEqual(report['iterations'], 365)
+        self.assertEqual(report['records'], len(res))
+        self.assertGreater(report['bytes_recorded'], 0)
+        self.assertEqual(set(report['phases']), set(macro.Profile.PHASES))
+        self.assertEqual(report['funcs']['delta_X_Y']['calls'], 365 * 4)
+        self.assertEqual(report['funcs']['delta_S_I']['calls'], 365)
+        self.assertEqual(report['funcs']['delta_birth_X']['calls'], 365)
+        self.assertEqual(len(report['trace']), 365)
+        self.assertEqual(report['trace'][-1]['iteration'], 365)
+
+    def test_series(self):
+        profile = macro.Profile()
+        macro.simulate_series([[samples.MacroModels().simple()]
+                               for _ in range(3)], 2, profile=profile)
+        report = profile.report()
+        self.assertEqual(report['iterations'], 3 * 365)
+        self.assertEqual(report['funcs']['delta_S_I']['calls'], 3 * 365)
+        self.assertNotIn('trace', report)
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def test_synthetic(self):
+        model = samples.MacroModels().synthetic(100, 3, 6)
+        leaves = [g for g in macro.traverse(model) if 'compartments' in g]
+        self.assertEqual(len(leaves), 100)
+        self.assertEqual(list(leaves[0]['compartments']),
+                         ['S', 'I', 'I2', 'I3', 'I4', 'R'])
+        model['parameters'] = {'to': 50}
+        res = macro.simulate([model])
+        self.assertAlmostEqual(macro.calc_totals(res[0][0])['N'],
+                               macro.calc_totals(res[-1][0])['N'], 6)
+        self.assertGreater(macro.calc_totals(res[-1][0])['R'], 0)
+
+
+class TestCompile(unittest.TestCase):
+
+    def test_compile(self):
+        compiled = macro.compile_model(samples.MacroModels().complicated())
+        leaves = compiled['leaves']
+        self.assertEqual(len(leaves), 4)
+        self.assertEqual(leaves[3]['path'], (0, 1, 1))
+        self.assertEqual(leaves[3]['names'],
+                         ['Van Wyks Dorp', 'Female', '50-100'])
+        self.assertEqual(leaves[3]['transitions'],
+                         [('I', 'R', 'I_R', (0,)), ('S', 'I', 'S_I', (0, 1))])
+
+    def test_validate(self):
+        model = samples.MacroModels().simple()
+        model['transitions']['I_X'] = 0.1
+        with self.assertRaises(ValueError):
+            macro.compile_model(model)
+        with self.assertRaises(ValueError):
+            macro.simulate([model])
+
+    def test_hook_changes(self):
+        def add_recovery(model, modelList):
+            model['transitions'].setdefault('I_R', 0.1)
+
+        def copy_compartments(model, modelList):
+            model['compartments'] = dict(model['compartments'])
+
+        expected = samples.MacroModels().simple()
+        expected['parameters'] = {'to': 100}
+        expected = macro.series_to_table(macro.simulate([expected]))
+        for funcs in ([add_recovery], [add_recovery, copy_compartments]):
+            model = samples.MacroModels().simple()
+            del model['transitions']['I_R']
+            model['parameters'] = {'to': 100, 'before_funcs': funcs}
+            self.assertEqual(macro.series_to_table(
+                macro.simulate([deepcopy(model)])), expected)
+            self.assertEqual(macro.series_to_table(macro.simulate(
+                [model], profile=macro.Profile())), expected)
+        if numpy is not None:
+            model['parameters']['engine'] = 'binomial'
+            with self.assertRaises(ValueError):
+                macro.simulate([model])
+        model['parameters']['engine'] = 'gillespie'
+        model['compartments'] = {'S': 100, 'I': 1, 'R': 0}
+        with self.assertRaises(ValueError):
+            macro.simulate([model])
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            disk = cache.DiskCache(directory)
+            model = samples.MacroModels().complicated()
+            compiled = macro.compile_model(model, disk)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            model['groups'][0]['transitions']['I_R'] = 0.5
+            self.assertEqual(macro.compile_model(model, disk), compiled)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            model['groups'][0]['transitions']['R_S'] = 0.5
+            self.assertNotEqual(macro.compile_model(model, disk), compiled)
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+            model = samples.MacroModels().complicated()
+            model['parameters'] = {'compile_cache': directory}
+            self.assertEqual(
+                macro.series_to_table(macro.simulate([model])),
+                macro.series_to_table(
+                    macro.simulate([samples.MacroModels().complicated()])))
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as directory:
+            disk = cache.DiskCache(directory, 1000)
+            for i in range(5):
+                disk.put(str(i), 'x' * 300)
+                os.utime(os.path.join(directory, str(i) + '.pickle'),
+                         (i, i))
+            disk.put('5', 'x' * 300)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['3.pickle', '4.pickle', '5.pickle'])
+            self.assertIsNone(disk.get('0'))
+            self.assertEqual(disk.get('4'), 'x' * 300)
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_csv(self):
+        seir = samples.MacroModels().seir()
+        seir['parameters'] = {'transition_funcs': {'S_E': 'delta_S_I1'},
+                              'after_funcs': ['reduce_infectivity'],
+                              'reduce_infectivity': 0.999}
+        with open(self.path('seir.json'), 'w') as f:
+            json.dump([[seir], [samples.MacroModels().seir()]], f)
+        with open(self.path('simple.json'), 'w') as f:
+            json.dump(samples.MacroModels().simple(), f)
+        cli.main([self.path('seir.json'), self.path('simple.json'),
+                  '--workers', '2', '--record-frequency', '100',
+                  '-o', self.path('out.csv')])
+
+        seir['parameters']['transition_funcs']['S_E'] = macro.delta_S_I1
+        seir['parameters']['after_funcs'] = [macro.reduce_infectivity]
+        seir['parameters']['record_frequency'] = 100
+        plain = samples.MacroModels().seir()
+        plain['parameters'] = {'record_frequency': 100}
+        expected = macro.series_to_table(macro.simulate([seir], 0) +
+                                         macro.simulate([plain], 1))
+        with open(self.path('out.csv'), newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], expected[0])
+        self.assertEqual(len(rows), len(expected) + 5)
+        self.assertEqual(rows[1:len(expected)],
+                         [[str(v) for v in row] for row in expected[1:]])
+        self.assertEqual(rows[-1][:3], ['2', '365', 'Simple model'])
+
+    def test_pickle(self):
+        granich = samples.MacroModels().granich()
+        granich['parameters']['after_funcs'] = ['reduce_infectivity']
+        with open(self.path('noise.json'), 'w') as f:
+            json.dump(granich, f)
+        for name in ('a', 'b'):
+            cli.main([self.path('noise.json'), '--seed', '7', '--to', '100',
+                      '--record-level', 'model', '--format', 'pickle',
+                      '-o', self.path(name)])
+        a = list(cli.read_pickle(self.path('a')))
+        b = list(cli.read_pickle(self.path('b')))
+        self.assertEqual(len(a), 1)
+        self.assertEqual(a[0][-1][0]['iteration'], 100)
+        self.assertNotIn('parameters', a[0][-1][0])
+        self.assertEqual(a, b)
+
+    def test_empty(self):
+        out = io.StringIO()
+        table = macro.series_to_table(macro.simulate(
+            [samples.MacroModels().simple()]))
+        cli.write_csv([[], macro.simulate([samples.MacroModels().simple()]),
+                       []], out)
+        self.assertEqual(list(csv.reader(io.StringIO(out.getvalue()))),
+                         [[str(v) for v in row] for row in table])
+        out = io.StringIO()
+        cli.write_csv([[]], out)
+        self.assertEqual(out.getvalue(), '')
+
+    def test_resolve_only_present(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'after_funcs': ['reduce_infectivity']}
+        cli.resolve_functions(model)
+        self.assertEqual(model['parameters'],
+                         {'after_funcs': [macro.reduce_infectivity]})
+
+    def test_unknown_function(self):
+        with self.assertRaises(ValueError):
+            cli.resolve_function('no_such_function')
+        self.assertIs(cli.resolve_function('ziggie.samples.mix_models'),
+                      samples.mix_models)
+
+
+@unittest.skipIf(numpy is None, "requires numpy")
+class TestBinomial(unittest.TestCase):
+
+    def sir(self, replicates):
+        return {
+            'name': 'Small outbreak',
+            'compartments': {'S': 100, 'I': 1, 'R': 0},
+            'transitions': {'S_I': 0.15, 'I_R': 0.1},
+            'parameters': {'engine': 'binomial', 'replicates': replicates,
+                           'to': 200, 'record_frequency': 200,
+                           'record_last': False}
+        }
+
+    def test_extinction(self):
+        res = macro.simulate([self.sir(200)], seed=3)
+        self.assertEqual(len(res), 400)
+        final = [r[0] for r in res if r[0]['iteration'] == 200]
+        self.assertEqual([m['replicate'] for m in final], list(range(200)))
+        for model in final:
+            self.assertEqual(sum(model['compartments'].values()), 101)
+            for value in model['compartments'].values():
+                self.assertEqual(value, round(value))
+                self.assertGreaterEqual(value, 0)
+        recovered = [m['compartments']['R'] for m in final]
+        self.assertGreater(len([r for r in recovered if r < 10]), 50)
+        self.assertGreater(len([r for r in recovered if r > 20]), 20)
+        self.assertEqual(macro.series_to_table(res)[0],
+                         ['replicate', 'iter', 'name_0', 'S', 'I', 'R'])
+        self.assertEqual(res, macro.simulate([self.sir(200)], seed=3))
+
+    def test_competing(self):
+        model = samples.MacroModels().granich()
+        model['parameters'].update({'engine': 'binomial', 'to': 365,
+                                    'noise': 0.0})
+        res = macro.simulate([model], seed=1)
+        model['parameters']['engine'] = 'dict'
+        expected = macro.simulate([model])
+        totals = macro.calc_totals(res[-1][0])
+        self.assertEqual(
+            macro.grand_sum_totals([macro.calc_totals(res[0][0])], ['N']),
+            macro.grand_sum_totals([totals], ['N']))
+        deterministic = macro.calc_totals(expected[-1][0])
+        for key in ('S', 'I1', 'T1', 'DI'):
+            self.assertLess(abs(totals[key] - deterministic[key]),
+                            0.1 * deterministic[key] + 100)
+
+    def test_unsupported(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'engine': 'binomial', 'transition_funcs': {
+            'I_R': lambda *args: 0.0}}
+        with self.assertRaises(ValueError):
+            macro.simulate([model])
+
+    def test_float32(self):
+        from ziggie import vector
+        model = self.sir(20)
+        model['parameters']['precision'] = 'float32'
+        res = macro.simulate([model], seed=3)
+        for r in res:
+            self.assertEqual(sum(r[0]['compartments'].values()), 101)
+        arrays = vector.ModelArrays(macro._prepare([model]), 20)
+        active = numpy.ones(1, arrays.dtype)
+        self.assertEqual(arrays.per_capita(active).dtype, numpy.float32)
+        vector.binomial_step(arrays, numpy.random.default_rng(1), active)
+        self.assertEqual(arrays.state.dtype, numpy.float32)
+        # The rates the engine computes on each iteration stay float32
+        dtypes = set()
+
+        def step(arrays, rng, active):
+            dtypes.add(arrays.per_capita(active).dtype)
+            vector.binomial_step(arrays, rng, active)
+        vector.STEPS['binomial'] = step
+        try:
+            macro.simulate([model], seed=3)
+        finally:
+            vector.STEPS['binomial'] = vector.binomial_step
+        self.assertEqual(dtypes, {numpy.dtype(numpy.float32)})
+        self.assertEqual(vector.check_precision([self.sir(5)], seed=1),
+                         {'float64': 0.0, 'float32': 0.0})
+        model = self.sir(1)
+        model['compartments']['S'] = 10**8
+        model['parameters'].update({'to': 100, 'record_frequency': 1})
+        drift = vector.check_precision([model], seed=1)
+        self.assertEqual(drift['float64'], 0.0)
+        self.assertGreater(drift['float32'], 0.0)
+        self.assertLess(drift['float32'], 100 * 2**-24)
+        model['parameters'].update({'engine': 'dict',
+                                    'precision': 'float32'})
+        with self.assertRaises(ValueError):
+            macro.simulate([model])
+
+    def test_threads(self):
+        from ziggie import vector
+        model = {'name': 'Country', 'groups': [
+            {'name': 'District ' + str(i), 'groups': [
+                {'name': age, 'compartments': {'S': 1000, 'I': 1, 'R': 0}}
+                for age in ('Young', 'Old')]}
+            for i in range(4)],
+            'transitions': {'S_I': 0.3, 'I_R': 0.1},
+            'parameters': {'engine': 'binomial', 'replicates': 5,
+                           'threads': 3, 'to': 50}}
+        arrays = vector.ModelArrays(macro._prepare([model]))
+        self.assertEqual(arrays.partitions(3),
+                         [slice(0, 3), slice(3, 5), slice(5, 8)])
+        self.assertEqual(arrays.partitions(16),
+                         [slice(g, g + 1) for g in range(8)])
+        unnamed = {'groups': [{'compartments': {'S': 1, 'I': 0}}] * 4,
+                   'transitions': {'S_I': 0.1}}
+        self.assertEqual(
+            vector.ModelArrays(macro._prepare([unnamed])).partitions(2),
+            [slice(0, 2), slice(2, 4)])
+        res = macro.simulate([model], seed=2)
+        self.assertEqual(res, macro.simulate([model], seed=2))
+        for r in res:
+            self.assertEqual(macro.grand_sum_totals(
+                [macro.calc_totals(r[0])], ['N']), 8 * 1001)
+        self.assertGreater(macro.calc_totals(res[-1][0])['R'], 0)
+        # Closing a run early stops its threads
+        threads = threading.active_count()
+        steps = macro._steps(macro._prepare([model]))
+        for _ in range(3):
+            next(steps)
+        self.assertGreater(threading.active_count(), threads)
+        steps.close()
+        self.assertEqual(threading.active_count(), threads)
+        model['parameters']['engine'] = 'dict'
+        with self.assertRaises(ValueError):
+            macro.simulate([model])
+
+    def test_dict_replicates(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'replicates': 3, 'noise': 0.1}
+        res = macro.simulate([model])
+        self.assertEqual(len(res), 27)
+        self.assertEqual(res[-1][0]['replicate'], 2)
+        self.assertNotEqual(res[8][0]['compartments'],
+                            res[-1][0]['compartments'])
+
+
+class TestGillespie(unittest.TestCase):
+
+    def sir(self, replicates):
+        return {
+            'name': 'Small outbreak',
+            'compartments': {'S': 100, 'I': 1, 'R': 0},
+            'transitions': {'S_I': 0.15, 'I_R': 0.1},
+            'parameters': {'engine': 'gillespie', 'replicates': replicates,
+                           'to': 200, 'record_frequency': 200,
+                           'record_last': False}
+        }
+
+    def test_queue(self):
+        rng = random.Random(1)
+        keys = [rng.random() for _ in range(50)]
+        queue = gillespie.IndexedPriorityQueue(keys)
+        for _ in range(500):
+            i = rng.randrange(50)
+            keys[i] = rng.choice([rng.random(), math.inf])
+            queue.update(i, keys[i])
+            self.assertEqual(keys[queue.top()], min(keys))
+            self.assertEqual([queue.heap[p] for p in queue.position],
+                             list(range(50)))
+
+    def test_extinction(self):
+        res = macro.simulate([self.sir(200)], seed=3)
+        self.assertEqual(len(res), 400)
+        final = [r[0] for r in res if r[0]['iteration'] == 200]
+        self.assertEqual([m['replicate'] for m in final], list(range(200)))
+        for model in final:
+            self.assertEqual(sum(model['compartments'].values()), 101)
+            for value in model['compartments'].values():
+                self.assertIsInstance(value, int)
+                self.assertGreaterEqual(value, 0)
+        recovered = [m['compartments']['R'] for m in final]
+        self.assertGreater(len([r for r in recovered if r < 10]), 50)
+        self.assertGreater(len([r for r in recovered if r > 20]), 20)
+        self.assertEqual(res, macro.simulate([self.sir(200)], seed=3))
+
+    def test_competing(self):
+        model = samples.MacroModels().granich()
+        for group in macro.traverse(model):
+            if 'compartments' in group:
+                for key, value in group['compartments'].items():
+                    group['compartments'][key] = value / 10000
+        model['parameters'].update({'to': 365, 'noise': 0.0,
+                                    'record_frequency': 365})
+        deterministic = macro.calc_totals(macro.simulate([model])[-1][0])
+        model['parameters'].update({'engine': 'gillespie',
+                                    'replicates': 10})
+        res = macro.simulate([model], seed=1)
+        final = [macro.calc_totals(r[0]) for r in res
+                 if r[0]['iteration'] == 365]
+        for key in ('S', 'I1', 'T1', 'DI'):
+            mean = sum(f[key] for f in final) / len(final)
+            self.assertLess(abs(mean - deterministic[key]),
+                            0.1 * deterministic[key] + 10)
+
+    def test_hooks(self):
+        model = self.sir(1)
+        model['compartments'] = {'S': 1000, 'I': 100, 'R': 0}
+        model['parameters'].update({'after_funcs': [macro.reduce_infectivity],
+                                    'reduce_infectivity': 0.0,
+                                    'record_frequency': 1})
+        res = macro.simulate([model], seed=2)
+        susceptible = [r[0]['compartments']['S'] for r in res[1:]]
+        self.assertLess(susceptible[0], 1000)
+        self.assertEqual(len(set(susceptible)), 1)
+
+    def test_unsupported(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'engine': 'gillespie', 'transition_funcs': {
+            'I_R': lambda *args: 0.0}}
+        with self.assertRaises(ValueError):
+            macro.simulate([model])
+        model = self.sir(1)
+        model['parameters']['noise'] = 0.1
+        with self.assertRaises(ValueError):
+            macro.simulate([model])
+
+
+class TestAsync(unittest.TestCase):
+
+    def test_simulate(self):
+        simulator = aio.AsyncSimulator(limit=1)
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'noise': 0.05}
+        res = asyncio.run(simulator.simulate([model], seed=1))
+        self.assertEqual(res, macro.simulate([model], seed=1))
+        self.assertEqual(res, list(macro.simulate_iter([model], seed=1)))
+        series = asyncio.run(simulator.simulate_series([[model]] * 3, 1))
+        self.assertEqual(series, [r for ident in range(3) for r in
+                                  macro.simulate([model], ident, seed=1 +
+                                                 ident)])
+        # The runs wait for each other in another event loop too
+        self.assertEqual(
+            asyncio.run(simulator.simulate_series([[model]] * 3, 1)), series)
+
+    def test_stream(self):
+        simulator = aio.AsyncSimulator()
+        model = samples.MacroModels().seir()
+
+        async def first():
+            async for recorded in simulator.stream([model], 7):
+                return recorded
+
+        self.assertEqual(asyncio.run(first()),
+                         macro.simulate([model], 7)[0])
+
+    def test_cancel(self):
+        iterations = []
+
+        def count(model, modelList):
+            iterations.append(model['iteration'])
+
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'to': 10 ** 7, 'record_first': False,
+                               'after_funcs': [count]}
+        simulator = aio.AsyncSimulator(limit=1)
+
+        async def cancel():
+            task = asyncio.create_task(simulator.simulate([model]))
+            while len(iterations) < 10:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0.05)
+            stopped = len(iterations)
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(iterations), stopped)
+
+        asyncio.run(cancel())
+
+    def test_limit(self):
+        running = []
+        peak = []
+
+        def start(model, modelList):
+            if model['iteration'] == 1:
+                running.append(1)
+                peak.append(len(running))
+
+        def end(model, modelList):
+            if model['iteration'] == model['parameters']['to']:
+                running.pop()
+
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'to': 200, 'before_funcs': [start],
+                               'after_funcs': [end]}
+        simulator = aio.AsyncSimulator(ThreadPoolExecutor(4), limit=2)
+        res = asyncio.run(simulator.simulate_series([[model]] * 6))
+        self.assertEqual(len(res), 6 * 6)
+        self.assertLessEqual(max(peak), 2)
+
+    def test_process(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'noise': 0.05}
+        with ProcessPoolExecutor(2) as executor:
+            simulator = aio.AsyncSimulator(executor)
+            res = asyncio.run(simulator.simulate_series([[model]] * 2, 1))
+        self.assertEqual(res, macro.simulate_series([[model]] * 2, 2,
+                                                    seed=1))
+
+
+def record_pid(model, modelList):
+    model['pid'] = os.getpid()
+
+
+class TestPool(unittest.TestCase):
+
+    def test_pool(self):
+        simple = samples.MacroModels().simple()
+        seir = samples.MacroModels().seir()
+        with pool.SimulationPool(2, models={'simple': [simple]}) as p:
+            future = p.submit('simple', 3, 1, {'noise': 0.1, 'to': 100})
+            futures = p.map([[seir], 'simple'], seed=5)
+            results = p.simulate_series([[seir], [simple]])
+            missing = p.submit('missing')
+            self.assertEqual(future.result(), macro.simulate(
+                [dict(simple, parameters={'noise': 0.1, 'to': 100})], 3,
+                seed=1))
+            self.assertEqual(futures[0].result() + futures[1].result(),
+                             macro.simulate_series([[seir], [simple]], 1,
+                                                   seed=5))
+            self.assertEqual(results, macro.simulate_series([[seir],
+                                                             [simple]], 1))
+            with self.assertRaises(KeyError):
+                missing.result()
+
+    def test_preload(self):
+        seir = samples.MacroModels().seir()
+        pool._initialize({'seir': [seir]})
+        compile = macro._compile
+        try:
+            # Runs of the preloaded structure don't compile it again
+            macro._compile = None
+            results = pool._run(('seir', 1, None, None,
+                                 {(0, 'transitions', 'E_I1'): 0.25}))
+        finally:
+            macro._compile = compile
+            pool._initialize({})
+        seir['transitions']['E_I1'] = 0.25
+        self.assertEqual(results, macro.simulate([seir], 1))
+
+    def test_recycle(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'to': 1, 'after_funcs': [record_pid]}
+        with pool.SimulationPool(1, maxtasks=2) as p:
+            results = [f.result()[-1][0]['pid']
+                       for f in p.map([[model]] * 4)]
+        self.assertEqual(results[0], results[1])
+        self.assertNotEqual(results[1], results[2])
+        self.assertEqual(results[2], results[3])
+
+
+def crash_once(model, modelList):
+    marker = model['parameters']['crash_marker']
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        os._exit(1)
+
+
+def final_S(modelListSeries):
+    return modelListSeries[-1][0]['compartments']['S']
+
+
+class TestDistributed(unittest.TestCase):
+
+    def test_series(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'noise': 0.05}
+        series = [[model]] * 5
+        expected = macro.simulate_series(series, 1, seed=2)
+        self.assertEqual(distributed.simulate_series(
+            series, workers=2, seed=2, chunksize=2), expected)
+        self.assertEqual(distributed.simulate_series(
+            series, workers=2, seed=2, reducer=final_S),
+            [final_S(macro.simulate([model], i, seed=2 + i))
+             for i in range(5)])
+
+    def test_worker_lost(self):
+        model = samples.MacroModels().simple()
+        expected = macro.simulate_series([[model]] * 3, 1)
+        with tempfile.TemporaryDirectory() as directory:
+            model['parameters'] = {
+                'after_funcs': [crash_once],
+                'crash_marker': os.path.join(directory, 'crashed')}
+            series = [[model]] * 3
+            results = distributed.simulate_series(series, workers=2)
+            self.assertTrue(os.path.exists(model['parameters']
+                                           ['crash_marker']))
+        for r in results:
+            del r[0]['parameters']
+        for r in expected:
+            del r[0]['parameters']
+        self.assertEqual(results, expected)
+
+    def test_authkey(self):
+        with self.assertRaises(ValueError):
+            distributed.Coordinator([], ('0.0.0.0', 0))
+        coordinator = distributed.Coordinator([])
+        self.assertEqual(len(coordinator.authkey), 32)
+        coordinator.close()
+
+    def test_timeout_without_workers(self):
+        coordinator = distributed.Coordinator([[]], retries=0, timeout=0.01)
+        # A task whose worker has hung, with no other workers asking for
+        # tasks
+        coordinator._pending.pop()
+        coordinator._attempts[0] = 1
+        coordinator._running[0] = (time.monotonic() - 1.0, None)
+        with self.assertRaisesRegex(RuntimeError, 'timeout'):
+            coordinator.wait()
+        coordinator.close()
+
+    def test_timeout_retried(self):
+        coordinator = distributed.Coordinator([[], []], retries=1,
+                                              timeout=0.01)
+        with coordinator._condition:
+            self.assertEqual(coordinator._next(None), 0)
+            coordinator._running[0] = (time.monotonic() - 1.0, None)
+            # The timed out task is given out again after the others
+            self.assertEqual(coordinator._next(None), 1)
+            self.assertEqual(coordinator._next(None), 0)
+            self.assertIsNone(coordinator.error)
+            coordinator._running[0] = (time.monotonic() - 1.0, None)
+            coordinator._expire()
+        self.assertIn('timeout', str(coordinator.error))
+        coordinator.close()
+        coordinator = distributed.Coordinator([[]], retries=0)
+        with coordinator._condition:
+            coordinator._next(None)
+            coordinator._lost(0)
+        self.assertIn('workers were lost', str(coordinator.error))
+        coordinator.close()
+
+    def test_error(self):
+        model = samples.MacroModels().simple()
+        model['transitions']['I_X'] = 0.1
+        with self.assertRaises(ValueError):
+            distributed.simulate_series([[model]], workers=1,
+                                        authkey=b'secret')
+
+
+class TestPatch(unittest.TestCase):
+
+    def test_apply(self):
+        base = samples.MacroModels().corona()
+        before = json.dumps(base, default=str)
+        patched = macro.apply_patch(base, {
+            ('Urban informal', 'transitions', 'S_E'): 0.35,
+            ('Rural', '55-', 'compartments', 'S'): 650000,
+            (1, 0, 'parameters', 'noise'): 0.1,
+            (0, 'parameters', 'transition_funcs'): {'I_R': macro.delta_X_Y}
+        })
+        self.assertEqual(json.dumps(base, default=str), before)
+        self.assertEqual(patched[0]['transitions']['S_E'], 0.35)
+        self.assertEqual(patched[2]['groups'][2]['compartments']['S'],
+                         650000)
+        self.assertEqual(patched[1]['groups'][0]['parameters'],
+                         {'noise': 0.1})
+        funcs = patched[0]['parameters']['transition_funcs']
+        self.assertEqual(funcs['I_R'], macro.delta_X_Y)
+        self.assertEqual(len(funcs), 2)
+        self.assertIs(patched[1]['groups'][1], base[1]['groups'][1])
+        self.assertIs(patched[2]['transitions'], base[2]['transitions'])
+        with self.assertRaises(KeyError):
+            macro.apply_patch(base, {('Nowhere', 'transitions', 'S_E'): 1})
+        with self.assertRaises(ValueError):
+            macro.apply_patch(base, {('Rural', 'groups', 'S_E'): 1})
+
+    def test_simulate(self):
+        base = samples.MacroModels().corona()
+        patches = [{(m, 'transitions', 'S_E'): rate
+                    for m in range(3)} for rate in (0.2, 0.3, 0.4)]
+        patches[1][('Rural', 'parameters', 'noise')] = 0.05
+        expected = macro.simulate_series(
+            [macro.apply_patch(base, patch) for patch in patches], 1,
+            seed=3)
+        self.assertEqual(macro.simulate_patches(base, patches, 2, seed=3),
+                         expected)
+        with pool.SimulationPool(1, models={'corona': base}) as p:
+            future = p.submit('corona', 1, 4, patch=patches[1])
+            self.assertEqual(future.result(), macro.simulate(
+                macro.apply_patch(base, patches[1]), 1, seed=4))
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_deterministic(self):
+        results = cache.ResultCache()
+        model = samples.MacroModels().seir()
+        first = macro.simulate([model], cache=results)
+        self.assertEqual((results.hits, results.misses), (0, 1))
+        first[-1][0]['compartments']['S'] = -1
+        second = macro.simulate([model], cache=results)
+        self.assertEqual((results.hits, results.misses), (1, 1))
+        self.assertEqual(second, macro.simulate([model]))
+        macro.simulate([model], 1, cache=results)
+        model['transitions']['E_I1'] = 0.25
+        macro.simulate([model], cache=results)
+        self.assertEqual((results.hits, results.misses), (1, 3))
+
+    def test_noise(self):
+        results = cache.ResultCache()
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'noise': 0.1}
+        macro.simulate([model], cache=results)
+        macro.simulate([model], cache=results)
+        self.assertEqual((results.hits, results.misses), (0, 0))
+        first = macro.simulate([model], seed=1, cache=results)
+        self.assertEqual(macro.simulate([model], seed=1, cache=results),
+                         first)
+        self.assertEqual((results.hits, results.misses), (1, 1))
+        # A hit leaves the random number generator as the run did
+        macro.simulate([model], seed=1)
+        after_run = random.random()
+        random.seed(5)
+        macro.simulate([model], seed=1, cache=results)
+        self.assertEqual(random.random(), after_run)
+        self.assertEqual((results.hits, results.misses), (2, 1))
+        model['parameters']['after_funcs'] = [lambda m, ml: None]
+        macro.simulate([model], seed=1, cache=results)
+        self.assertEqual((results.hits, results.misses), (2, 1))
+
+    def test_spill(self):
+        results = cache.ResultCache()
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'max_memory': 10000, 'record_frequency': 1}
+        first = macro.simulate([model], cache=results)
+        second = macro.simulate([model], cache=results)
+        self.assertEqual(results.hits, 1)
+        self.assertIsInstance(second, macro.SpillSeries)
+        self.assertEqual(list(second), list(first))
+        first.close()
+        second.close()
+
+    def test_tiers(self):
+        model = samples.MacroModels().simple()
+        with tempfile.TemporaryDirectory() as directory:
+            results = cache.ResultCache(directory, max_entries=1)
+            first = macro.simulate([model], 1, cache=results)
+            macro.simulate([model], 2, cache=results)
+            self.assertEqual(len(results._memory), 1)
+            self.assertEqual(macro.simulate([model], 1, cache=results),
+                             first)
+            results = cache.ResultCache(directory)
+            self.assertEqual(macro.simulate([model], 1, cache=results),
+                             first)
+            self.assertEqual((results.hits, results.misses), (1, 0))
+            results.clear()
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_canonical(self):
+        value = cache.canonical({'a': [1, 2.5], 'f': macro.simulate})
+        self.assertEqual(value[:2], ('dict', ('a', ('list', 1, 2.5))))
+        self.assertEqual(value[2][1][:3],
+                         ('function', 'ziggie.macro', 'simulate'))
+        self.assertEqual(cache.canonical(macro.simulate),
+                         cache.canonical(macro.simulate))
+        # Functions with the same name but different code, e.g. a hook that
+        # was edited, or hooks of two scripts
+        hooks = []
+        for body in ('return 1', 'return 2'):
+            namespace = {'__name__': '__main__'}
+            exec('def hook():\n    ' + body, namespace)
+            hooks.append(namespace['hook'])
+        self.assertNotEqual(cache.canonical(hooks[0]),
+                            cache.canonical(hooks[1]))
+        self.assertNotEqual(cache.canonical({'a': 1, 'b': 2}),
+                            cache.canonical({'b': 2, 'a': 1}))
+        with self.assertRaises(TypeError):
+            cache.canonical(lambda: 0)
+        with self.assertRaises(TypeError):
+            cache.canonical(object())
+
+
+class TestFork(unittest.TestCase):
+
+    def test_identical(self):
+        model = samples.MacroModels().seir()
+        model['parameters'] = {'record_frequency': 7}
+        expected = macro.simulate_series([[model]] * 3, 1)
+        for at in (0, 1, 60, 365):
+            self.assertEqual(macro.simulate_forks([model], at, [{}] * 3),
+                             expected)
+        self.assertEqual(macro.simulate_forks([model], 60, [{}] * 3, 2),
+                         expected)
+
+    def test_intervention(self):
+        base = samples.MacroModels().granich()
+        base['parameters']['noise'] = 0.0
+        intervention = samples.MacroModels().granich(treat_only_I4=True)
+        intervention['parameters']['noise'] = 0.0
+        patch = {(0, 'transitions', key): value
+                 for key, value in intervention['transitions'].items()
+                 if base['transitions'].get(key) != value}
+        res = macro.simulate_forks([base], 0, [{}, patch])
+        half = len(res) // 2
+        self.assertEqual(res[:half], macro.simulate([base], 0))
+        self.assertEqual(res[half + 1:],
+                         macro.simulate([intervention], 1)[1:])
+        self.assertEqual(res[half][0]['transitions'], base['transitions'])
+
+    def test_engine(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'replicates': 2}
+        with self.assertRaises(ValueError):
+            macro.simulate_forks([model], 10, [{}])
+
+    def test_outside(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'from': 10, 'to': 100}
+        for at in (9, 101):
+            with self.assertRaises(ValueError):
+                macro.simulate_forks([model], at, [{}])
+        expected = macro.simulate_series([[model]] * 2)
+        for at in (10, 49, 100):
+            self.assertEqual(macro.simulate_forks([model], at, [{}] * 2),
+                             expected)
+
+
+def lockdown(model, modelList):
+    model['transitions']['S_E'] = 0.6 if model['iteration'] <= 60 else 0.2
+
+
+def age_groups(model, modelList):
+    male = model['groups'][0]['groups'][0]['groups']
+    for key in male[0]['compartments']:
+        moved = 0.01 * male[0]['compartments'][key]
+        male[0]['compartments'][key] -= moved
+        male[1]['compartments'][key] += moved
+
+
+def age_arrays(view):
+    m, young = view.groups[('Van Wyks Dorp', 'Male', '0-50')]
+    _, old = view.groups[('Van Wyks Dorp', 'Male', '50-100')]
+    moved = 0.01 * view.state[m, young]
+    view.state[m, young] -= moved
+    view.state[m, old] += moved
+
+
+def stop_infection(view):
+    view.rates[..., view.keys['S_I']] = 0.0
+
+
+class TestSchedule(unittest.TestCase):
+
+    def test_compile(self):
+        self.assertEqual(macro.compile_schedule(
+            {'piecewise': [[60, 0.2], [0, 0.6]]}, 58, 62),
+            [0.6, 0.6, 0.2, 0.2])
+        self.assertEqual(macro.compile_schedule(
+            {'linear': [[10, 1.0], [20, 2.0]]}, 9, 22),
+            [1.0, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5, 1.6, 1.7, 1.8, 1.9, 2.0,
+             2.0])
+        self.assertEqual(macro.compile_schedule(
+            {'value': 2.0, 'steps': [[2, 0.5], [4, 3]]}, 0, 6),
+            [2.0, 2.0, 1.0, 1.0, 3.0, 3.0])
+        with self.assertRaises(ValueError):
+            macro.compile_schedule({'cubic': [[0, 1]]}, 0, 10)
+        with self.assertRaises(ValueError):
+            macro.compile_schedule({'steps': [[2, 0.5]]}, 0, 10)
+
+    def compare(self, engine):
+        model = samples.MacroModels().seir()
+        model['parameters'] = {'record_frequency': 1, 'engine': engine}
+        hooked = deepcopy(model)
+        hooked['parameters']['before_funcs'] = [lockdown]
+        model['transitions']['S_E'] = {'piecewise': [[0, 0.6], [60, 0.2]]}
+        expected = macro.simulate([hooked], seed=1)
+        res = macro.simulate([model], seed=1)
+        self.assertEqual(len(res), len(expected))
+        for r, e in zip(res, expected):
+            self.assertEqual(r[0]['compartments'], e[0]['compartments'])
+            self.assertEqual(r[0]['transitions'], e[0]['transitions'])
+        if engine == 'dict':
+            self.assertEqual(macro.simulate_forks([model], 30, [{}]),
+                             macro.simulate([model], 0))
+
+    def test_dict(self):
+        self.compare('dict')
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_binomial(self):
+        self.compare('binomial')
+
+
+class TestArrayHooks(unittest.TestCase):
+
+    def test_dict(self):
+        model = samples.MacroModels().complicated()
+        hooked = deepcopy(model)
+        model['parameters'] = {'after_funcs': [age_groups]}
+        hooked['parameters'] = {'after_array_funcs': [age_arrays]}
+        expected = macro.simulate([model])
+        res = macro.simulate([hooked])
+        self.assertEqual(len(res), len(expected))
+        for r, e in zip(macro.series_to_table(res)[1:],
+                        macro.series_to_table(expected)[1:]):
+            for x, y in zip(r, e):
+                if isinstance(x, float):
+                    self.assertAlmostEqual(x, y)
+                else:
+                    self.assertEqual(x, y)
+
+    def check_no_infection(self, engine, replicates=1, kind=float):
+        model = samples.MacroModels().complicated()
+        model['parameters'] = {'engine': engine, 'replicates': replicates,
+                               'before_array_funcs': [stop_infection]}
+        res = macro.simulate([model], seed=1)
+        first = macro.calc_totals(res[0][0])
+        for r in res:
+            totals = macro.calc_totals(r[0])
+            self.assertAlmostEqual(totals['S'], first['S'])
+            self.assertLessEqual(totals['I'], first['I'])
+            self.assertEqual(r[0]['groups'][0]['transitions']['I_R'], 0.1)
+            for group in macro.traverse(r[0]):
+                for value in group.get('compartments', {}).values():
+                    self.assertIsInstance(value, kind)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_binomial(self):
+        self.check_no_infection('binomial', 3)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_gillespie(self):
+        self.check_no_infection('gillespie', kind=int)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_view(self):
+        from ziggie import vector
+        modelList = macro._prepare([samples.MacroModels().complicated()])
+        arrays = vector.ModelArrays(modelList, 2)
+        view = vector.ArrayView(arrays, 1, 5)
+        view.state[0, 0, view.compartments['S']] = 7.0
+        self.assertEqual(arrays.state[1, 0, 0, arrays.compartment_index['S']],
+                         7.0)
+        self.assertEqual(view.state.shape, (1, 4, 3))
+        self.assertEqual(view.groups[('Van Wyks Dorp', 'Female', '0-50')],
+                         (0, 2))
+        self.assertEqual((view.iteration, view.replicate), (5, 1))
+
+
+class TestSensitivity(unittest.TestCase):
+
+    def run_model(self, model, key=None, h=0.0):
+        model = deepcopy(model)
+        for group in macro.traverse(model):
+            if key in group.get('transitions', {}):
+                group['transitions'][key] += h
+        return macro.calc_totals(macro.simulate([model], seed=2)[-1][0])
+
+    def check(self, model):
+        keys = set()
+        for group in macro.traverse(model):
+            keys.update(group.get('transitions', {}))
+        plain = deepcopy(model)
+        model['parameters']['sensitivities'] = sorted(keys)
+        res = macro.simulate([model], seed=2)
+        self.assertEqual(macro.calc_totals(res[-1][0]), self.run_model(plain))
+        sensitivities = macro.calc_sensitivities(res[-1][0])
+        self.assertEqual(sorted(sensitivities), sorted(keys))
+        h = 1e-6
+        for key in keys:
+            up = self.run_model(plain, key, h)
+            down = self.run_model(plain, key, -h)
+            for c, value in sensitivities[key].items():
+                expected = (up[c] - down[c]) / (2 * h)
+                self.assertLess(abs(value - expected),
+                                1e-4 * (abs(expected) + 1))
+
+    def test_seir(self):
+        model = samples.MacroModels().seir()
+        model['parameters'] = {'to': 200}
+        self.check(model)
+
+    def test_groups(self):
+        model = samples.MacroModels().complicated()
+        model['parameters'] = {'noise': 0.05, 'record_level': 'model'}
+        self.check(model)
+
+    def test_unsupported(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'sensitivities': ['I_R'], 'transition_funcs': {
+            'I_R': lambda *args: 0.0}}
+        with self.assertRaises(ValueError):
+            macro.simulate([model])
+        model['parameters'] = {'sensitivities': ['I_R'],
+                               'engine': 'gillespie'}
+        with self.assertRaises(ValueError):
+            macro.simulate([model])
+
+
+class TestReproductionNumber(unittest.TestCase):
+
+    def sir(self):
+        return {
+            'name': 'SIR',
+            'compartments': {'S': 999.0, 'I': 1.0, 'R': 0.0},
+            'transitions': {'S_I': 0.3, 'I_R': 0.1},
+        }
+
+    def test_sir(self):
+        res = macro.simulate([self.sir()])
+        self.assertAlmostEqual(macro.reproduction_number(res[0][0]),
+                               0.3 * 0.999 / 0.1)
+        rt = macro.Rt(res)
+        self.assertEqual(len(rt), len(res))
+        for r, modelList in zip(rt, res):
+            model = modelList[0]
+            self.assertAlmostEqual(r[0], 3.0 * model['compartments']['S'] /
+                                   macro.calc_totals(model)['N'])
+
+    def test_schedule(self):
+        model = self.sir()
+        model['transitions']['S_I'] = {'piecewise': [[0, 0.3], [100, 0.0]]}
+        model['parameters'] = {'record_frequency': 100}
+        rt = macro.Rt(macro.simulate([model]))
+        self.assertGreater(rt[0][0], 1.0)
+        self.assertEqual(rt[-1][0], 0.0)
+
+    def test_changing_rates(self):
+        modelList = samples.MacroModels().corona()
+        for model in modelList:
+            model['parameters']['record_frequency'] = 10
+        res = macro.simulate(modelList)
+        res[-1][0]['groups'][0]['transitions']['Ic_D'] = 0.5
+        rt = macro.Rt(res)
+        for r, recorded in zip(rt, res):
+            self.assertEqual(r, [macro.reproduction_number(model)
+                                 for model in recorded])
+        self.assertGreater(rt[1][0], rt[-2][0])
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_next_generation_matrix(self):
+        # Two kinds of force of infection: E in the first group and the
+        # weighted infectiousness for S_E1 in the second
+        mixed = {
+            'name': 'Mixed',
+            'groups': [
+                {'name': 'a',
+                 'compartments': {'S': 500.0, 'E': 1.0, 'I': 1.0, 'R': 0.0},
+                 'transitions': {'S_E': 0.2, 'E_I': 0.3, 'I_R': 0.1}},
+                {'name': 'b',
+                 'compartments': {'S': 500.0, 'E1': 0.0, 'I': 1.0,
+                                  'R': 0.0},
+                 'transitions': {'S_I': 0.25, 'S_E1': 0.1, 'E1_I': 0.5,
+                                 'I_R': 0.2}}
+            ]
+        }
+        for modelList in (samples.MacroModels().corona(),
+                          [samples.MacroModels().complicated()], [mixed]):
+            modelList = macro._prepare(modelList)
+            for model in modelList:
+                self.assertAlmostEqual(macro.reproduction_number(model),
+                                       self.dense(model))
+
+    def dense(self, model):
+        N = macro.calc_totals(model)['N']
+        bound = macro._bind(model, macro.compile_model(model))
+        parameters = model['parameters']
+        weights = {'I': 1.0, 'T': parameters['treatment_infectiousness'],
+                   'A': parameters['asymptomatic_infectiousness']}
+        index = {}
+        for g, (compartments, _, _) in enumerate(bound):
+            for c in compartments:
+                if c[0] in 'EIAT':
+                    index[(g, c)] = len(index)
+        F = numpy.zeros((len(index), len(index)))
+        V = numpy.zeros((len(index), len(index)))
+        for g, (compartments, transitions, _) in enumerate(bound):
+            for from_, to_, key, values, func in transitions:
+                value = values[key]
+                if func is macro.delta_X_Y and (g, from_) in index:
+                    V[index[g, from_], index[g, from_]] += value
+                    if (g, to_) in index:
+                        V[index[g, to_], index[g, from_]] -= value
+                elif func in (macro.delta_S_I, macro.delta_S_I1):
+                    for (_, c), j in index.items():
+                        weight = (c == to_) if func is macro.delta_S_I \
+                            else weights.get(c[0], 0.0)
+                        F[index[g, to_], j] += \
+                            value * compartments[from_] / N * weight
+        K = F @ numpy.linalg.inv(V)
+        return max(abs(numpy.linalg.eigvals(K)))
+
+
+@unittest.skipIf(pandas is None, "requires pandas")
+class TestDataFrame(unittest.TestCase):
+
+    def results(self):
+        return macro.simulate_series([samples.MacroModels().corona()] * 2)
+
+    def test_wide(self):
+        res = self.results()
+        table = macro.series_to_table(res)
+        frame = macro.series_to_dataframe(res)
+        self.assertEqual(list(frame.columns), table[0])
+        self.assertEqual(len(frame), len(table) - 1)
+        self.assertEqual(str(frame['name_0'].dtype), 'category')
+        for i in (0, 100, len(table) - 2):
+            self.assertEqual(list(frame.iloc[i]), table[i + 1])
+
+    def test_long(self):
+        res = self.results()
+        table = macro.series_to_table(res, concat_names='.')
+        frame = macro.series_to_dataframe(res, 'long', True, '.')
+        self.assertEqual(list(frame.index.names),
+                         ['ident', 'iter', 'name', 'compartment'])
+        compartments = table[0][3:]
+        self.assertEqual(len(frame), (len(table) - 1) * len(compartments))
+        row = table[-1]
+        for c, value in zip(compartments, row[3:]):
+            self.assertEqual(frame.loc[(row[0], row[1], row[2], c), 'value'],
+                             value)
+
+
+class TestResultSeries(unittest.TestCase):
+
+    def test_lookup(self):
+        modelList = samples.MacroModels().corona()
+        res = macro.simulate_series([modelList] * 3, seed=1)
+        self.assertIsInstance(res, macro.ResultSeries)
+        self.assertEqual(res.idents(), [0, 1, 2])
+        self.assertEqual(res.run(1), [r for r in res if r[0]['ident'] == 1])
+        at = [r for r in res if r[0]['iteration'] == 365]
+        self.assertEqual(res.at(365), at)
+        self.assertIs(res.get(2, 365), at[2])
+        self.assertIsNone(res.get(3, 365))
+        self.assertEqual(res.values('D', 365),
+                         [sum(macro.calc_totals(m)['D'] for m in r)
+                          for r in at])
+        rural = [r[2]['groups'][2]['compartments']['S'] for r in at]
+        self.assertEqual(res.values('S', 365, path=('Rural', '55-')), rural)
+        self.assertEqual(res.values('S', 365, 1, ('Rural', '55-')),
+                         rural[1:2])
+        self.assertEqual(res.values('S', 365, path=('Rural', 'Old')),
+                         [None] * 3)
+        res += macro.simulate(modelList, 3)
+        self.assertEqual(len(res.run(3)), 366)
+
+    def test_changes(self):
+        model = samples.MacroModels().simple()
+        res = macro.simulate_series([[model]] * 3)
+        self.assertEqual(res.get(0, 365)[0]['ident'], 0)
+        res.reverse()
+        self.assertEqual(res.get(0, 365)[0]['ident'], 0)
+        self.assertEqual(res.idents(), [2, 1, 0])
+        res.sort(key=lambda r: (r[0]['ident'], r[0]['iteration']))
+        self.assertEqual(res.idents(), [0, 1, 2])
+        records = len(res.run(0))
+        res[0] = res[-1]
+        self.assertIsNone(res.get(0, 0))
+        self.assertEqual(len(res.run(0)), records - 1)
+
+
+class TestSpill(unittest.TestCase):
+
+    def test_spill(self):
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'record_frequency': 1}
+        expected = macro.simulate([model])
+        model['parameters']['max_memory'] = 20000
+        res = macro.simulate([model])
+        self.assertIsInstance(res, macro.SpillSeries)
+        self.assertGreater(len(res._chunks), 3)
+        self.assertEqual(len(res), len(expected))
+        table = macro.series_to_table(expected)
+        self.assertEqual(macro.series_to_table(res), table)
+        self.assertEqual(macro.series_to_table(res[100:110]),
+                         [table[0]] + table[101:111])
+        self.assertEqual(res[-1][0]['compartments'],
+                         expected[-1][0]['compartments'])
+        self.assertEqual(res[3][0]['iteration'], 3)
+        self.assertEqual(res, pickle.loads(pickle.dumps(res)))
+        res.close()
+        self.assertEqual(len(res), 0)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_binomial_replicates(self):
+        from ziggie import vector
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'engine': 'binomial', 'replicates': 4,
+                               'record_frequency': 1}
+        expected = macro.simulate([model], seed=1)
+        model['parameters']['max_memory'] = 40000
+        steps = vector.steps(macro._prepare([model]))
+        for _, recorded in steps:
+            if recorded is not None:
+                break
+        # The replicates' records were held in SpillSeries until the end
+        series = steps.gi_frame.f_locals['series']
+        self.assertTrue(all(isinstance(s, macro.SpillSeries) and
+                            len(s._chunks) > 1 for s in series))
+        steps.close()
+        res = macro.simulate([model], seed=1)
+        self.assertIsInstance(res, macro.SpillSeries)
+        self.assertEqual(macro.series_to_table(res),
+                         macro.series_to_table(expected))
+
+
+class TestBackend(unittest.TestCase):
+
+    def test_backends(self):
+        series = [[samples.MacroModels().simple()],
+                  [samples.MacroModels().seir()]]
+        expected = macro.simulate_series(series, 2)
+        for backend in ('thread', 'serial', 'auto'):
+            self.assertEqual(
+                macro.simulate_series(series, 2, backend=backend), expected)
+        self.assertEqual(macro._choose_backend(series, 2), 'serial')
+        self.assertEqual(macro._choose_backend(series * 40, 2), 'process')
+        self.assertEqual(macro._choose_backend(series * 40, 1), 'serial')
+        with self.assertRaises(ValueError):
+            macro.simulate_series(series, backend='fiber')
+        self.assertEqual(macro.simulate_series([]), [])
+        self.assertEqual(macro.simulate_series(series, None), expected)
+
+    def test_progress(self):
+        series = [[samples.MacroModels().simple()]] * 6
+        for backend in ('process', 'thread', 'serial'):
+            reports = []
+            cancel = macro.CancelToken()
+
+            def progress(report):
+                reports.append(report)
+                if report['completed'] == 3:
+                    cancel.cancel()
+            res = macro.simulate_series(series, 2, backend=backend,
+                                        progress=progress, cancel=cancel)
+            # Runs that finished while the token was cancelled are kept
+            self.assertEqual(len(res.idents()), len(reports))
+            self.assertLess(len(reports), 6)
+            self.assertEqual(reports[2]['completed'], 3)
+            self.assertEqual(reports[2]['total'], 6)
+            self.assertEqual(reports[2]['iterations'], 3 * 365)
+            self.assertGreater(reports[0]['iterations_per_second'], 0)
+            self.assertGreater(reports[0]['eta'], 0)
+        model = samples.MacroModels().simple()
+        model['parameters'] = {'to': 10**7}
+        cancel = macro.CancelToken()
+        cancel.cancel()
+        self.assertEqual(macro.simulate_series([[model]] * 2, 2,
+                                               backend='thread',
+                                               cancel=cancel), [])
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_binomial_threads(self):
+        model = {'name': 'Outbreak',
+                 'compartments': {'S': 1000, 'I': 5, 'R': 0},
+                 'transitions': {'S_I': 0.3, 'I_R': 0.1},
+                 'parameters': {'engine': 'binomial', 'replicates': 10,
+                                'noise': 0.1}}
+        series = [[model]] * 4
+        self.assertEqual(macro._choose_backend(series, 2), 'thread')
+        expected = macro.simulate_series(series, 2, seed=3,
+                                         backend='serial')
+        self.assertEqual(macro.simulate_series(series, 2, seed=3,
+                                               backend='thread'), expected)
+        self.assertEqual(macro.simulate_series(series, 2, seed=3), expected)
+
 
 class TestNoise(unittest.TestCase):
 
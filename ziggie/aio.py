@@ -0,0 +1,161 @@
+"""Asyncio interface to the macro module.
+
+simulate and simulate_series block until they finish, which can take
+minutes. This module runs them in an executor instead, so that they can be
+awaited from an asyncio application, such as a web server, without blocking
+its event loop.
+
+    simulator = AsyncSimulator(limit=4)
+
+    async def handler(modelList):
+        async for recorded in simulator.stream(modelList):
+            ...
+
+    results = await simulator.simulate(modelList, seed=1)
+    results = await simulator.simulate_series(modelListSeries, seed=1)
+
+The simulations are run in a thread pool by default (the event loop's
+default executor), a few iterations at a time. stream yields each recorded
+model list as soon as it is ready. If the task awaiting a simulation is
+cancelled, or a stream is closed before it is exhausted, the simulation
+stops after the iteration it is running.
+
+Any concurrent.futures executor can be used. With a ProcessPoolExecutor the
+simulations run in parallel on several cores, but each is run in one go in
+a worker process: the recorded model lists are only yielded once it has
+finished, and cancelling it only stops it if it hasn't started yet.
+
+The number of simulations run at once by an AsyncSimulator is limited, so
+that bursts of requests wait their turn rather than oversubscribing the
+machine.
+
+Note that the random number generator is shared by all the threads in a
+process, so noisy or stochastic runs with a seed are only reproducible if
+they are run one at a time (limit=1) or in a process executor.
+"""
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
+import os
+import random
+import threading
+from typing import AsyncGenerator
+import weakref
+
+from ziggie import macro
+
+
+def _start(modelList, ident, seed):
+    if seed is not None:
+        random.seed(seed)
+    return macro._steps(macro._prepare(modelList), ident)
+
+
+def _advance(steps, stop):
+    for _, recorded in steps:
+        if recorded is not None:
+            return recorded
+        if stop.is_set():
+            steps.close()
+            return None
+    return None
+
+
+def _simulate(modelList, ident, seed):
+    return macro.simulate(modelList, ident, seed=seed)
+
+
+class AsyncSimulator:
+    """Runs simulations in an executor for asyncio applications.
+
+    Parameters:
+    executor (Executor): executor to run the simulations in (default the
+                         event loop's default executor, a thread pool)
+    limit (int): maximum number of simulations to run at once in each
+                 event loop (default the number of CPUs on the machine)
+    """
+
+    def __init__(self, executor: Executor = None, limit=None):
+        self.executor = executor
+        self.limit = limit or os.cpu_count() or 1
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _slots(self):
+        # Semaphores are bound to the event loop they are first used in, so
+        # there is one for each loop the simulator is used from, e.g. by
+        # successive calls of asyncio.run.
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.limit)
+        return semaphore
+
+    async def stream(self, modelList: macro.ModelList, ident=None,
+                     seed=None) -> AsyncGenerator[macro.ModelList, None]:
+        """Simulate a list of models and yield each model list recorded.
+
+        This yields the same model lists as macro.simulate_iter.
+
+        Parameters:
+        modelList (ModelList): list of related models to iterate
+        ident (int): unique identifier to use to identify this time series
+        seed (int): if not None, the random number generator is seeded with
+                    this so that noisy runs can be reproduced
+        """
+        loop = asyncio.get_running_loop()
+        async with self._slots():
+            if isinstance(self.executor, ProcessPoolExecutor):
+                results = await loop.run_in_executor(
+                    self.executor, _simulate, modelList, ident, seed)
+                for recorded in results:
+                    yield recorded
+                return
+            stop = threading.Event()
+            try:
+                steps = await loop.run_in_executor(
+                    self.executor, _start, modelList, ident, seed)
+                while True:
+                    recorded = await loop.run_in_executor(
+                        self.executor, _advance, steps, stop)
+                    if recorded is None:
+                        break
+                    yield recorded
+            finally:
+                stop.set()
+
+    async def simulate(self, modelList: macro.ModelList, ident=None,
+                       seed=None) -> macro.ModelListSeries:
+        """Simulate a list of models and return a time series of model lists.
+
+        This returns the same as macro.simulate.
+
+        Parameters:
+        modelList (ModelList): list of related models to iterate
+        ident (int): unique identifier to use to identify this time series
+        seed (int): if not None, the random number generator is seeded with
+                    this so that noisy runs can be reproduced
+        """
+        return [recorded
+                async for recorded in self.stream(modelList, ident, seed)]
+
+    async def simulate_series(self, modelListSeries: macro.ModelListSeries,
+                              seed=None) -> macro.ModelListSeries:
+        """Simulate a series of model lists and return their time series.
+
+        The model lists are run concurrently, up to the limit of the
+        simulator, and the results are returned as by macro.simulate_series.
+        If this is cancelled all the model lists are stopped.
+
+        Parameters:
+        modelListSeries (ModelListSeries): series of model lists to execute
+        seed (int): if not None, each model list is run with seed + its
+                    identifier as the seed of the random number generator
+        """
+        output = await asyncio.gather(*[
+            self.simulate(modelList, ident,
+                          None if seed is None else seed + ident)
+            for ident, modelList in enumerate(modelListSeries)])
+        results = macro.ResultSeries()
+        for r in output:
+            results += r
+        return results
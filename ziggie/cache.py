@@ -0,0 +1,253 @@
+"""Caches of values that are expensive to compute.
+
+DiskCache stores picklable values in a directory, keyed by a hash, so that
+they can be reused by other processes and later invocations. When the
+directory grows beyond a size limit the least recently used entries are
+deleted.
+
+ResultCache keeps the most recently used values in memory as well, in
+front of an optional DiskCache.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import tempfile
+
+
+def hash_key(*parts) -> str:
+    """Return a hex digest identifying the given values.
+
+    The values must have a deterministic repr, e.g. nested tuples of
+    strings and numbers.
+
+    Parameters:
+    parts: the values to hash
+    """
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def canonical(value):
+    """Return a representation of a value that hash_key can hash.
+
+    Dictionaries become tuples of their items in order (the order of
+    compartments and transitions affects the results of a simulation),
+    lists become tuples and functions are identified by their module,
+    qualified name and a digest of their code, so that results are not
+    reused after a function is edited and functions with the same name in
+    different scripts are told apart. A TypeError is raised for functions
+    that can't be identified by name, such as lambdas and nested functions,
+    and for values of other types whose repr isn't deterministic.
+
+    Parameters:
+    value: the value to represent, e.g. a model list
+    """
+    if isinstance(value, dict):
+        return ('dict',) + tuple((canonical(k), canonical(v))
+                                 for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(canonical(v) for v in value)
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if callable(value) and hasattr(value, '__qualname__'):
+        if '<' in value.__qualname__:
+            raise TypeError("Can't identify function " + value.__qualname__)
+        code = getattr(value, '__code__', None)
+        return ('function', value.__module__, value.__qualname__,
+                None if code is None else _code_digest(code))
+    raise TypeError("Can't represent value of type " + type(value).__name__)
+
+
+# Digest of a code object that is the same in every process: its bytecode,
+# the names it uses and its constants, including nested code objects (whose
+# repr contains their address) and frozensets (whose order varies).
+def _code_digest(code) -> str:
+    consts = []
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            consts.append(_code_digest(const))
+        elif isinstance(const, frozenset):
+            consts.append(repr(sorted(repr(c) for c in const)))
+        else:
+            consts.append(repr(const))
+    digest = hashlib.sha256(code.co_code)
+    digest.update(repr((code.co_names, code.co_varnames,
+                        consts)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """Pickled values stored in a directory with LRU eviction by size.
+
+    Each value is stored in its own file named after its key. Reading an
+    entry marks it as recently used. After an entry is written the least
+    recently used entries are deleted until the directory is no larger
+    than max_bytes.
+
+    Parameters:
+    directory (str): directory to store entries in (created if needed)
+    max_bytes (int): maximum total size of the entries
+    """
+
+    SUFFIX = '.pickle'
+
+    def __init__(self, directory: str, max_bytes=100 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key: str, default=None):
+        """Return the value stored under key, or default if there is none.
+
+        Parameters:
+        key (str): key of the entry, e.g. from hash_key
+        default: value to return if the entry does not exist
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return default
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key: str, value):
+        """Store a value under key and evict old entries if needed.
+
+        Values that cannot be pickled are not stored.
+
+        Parameters:
+        key (str): key of the entry, e.g. from hash_key
+        value: picklable value to store
+        """
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until within max_bytes."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Delete all the entries."""
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+class ResultCache:
+    """Pickled values cached in memory and optionally on disk.
+
+    The memory tier keeps the max_entries most recently used values. If a
+    directory is given, values are also stored in a DiskCache there, so
+    that they survive the process and can be shared with other processes.
+    Values found on disk are moved into the memory tier.
+
+    Each get returns a new copy of the value, so callers can change it
+    without affecting the cache.
+
+    Parameters:
+    directory (str): if not None, directory of the disk tier
+    max_entries (int): maximum number of values kept in memory
+    max_bytes (int): maximum total size of the disk tier
+    """
+
+    def __init__(self, directory: str = None, max_entries=128,
+                 max_bytes=100 * 2**20):
+        self.max_entries = max_entries
+        self.disk = None if directory is None \
+            else DiskCache(directory, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+
+    def get(self, key: str, default=None):
+        """Return a copy of the value stored under key, or default.
+
+        Parameters:
+        key (str): key of the entry, e.g. from hash_key
+        default: value to return if the entry does not exist
+        """
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return pickle.loads(data)
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self._remember(key, pickle.dumps(value,
+                                                 pickle.HIGHEST_PROTOCOL))
+                self.hits += 1
+                return value
+        self.misses += 1
+        return default
+
+    def put(self, key: str, value):
+        """Store a value under key in both tiers.
+
+        Values that cannot be pickled are not stored.
+
+        Parameters:
+        key (str): key of the entry, e.g. from hash_key
+        value: picklable value to store
+        """
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return
+        self._remember(key, data)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def _remember(self, key, data):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        """Delete all the entries in both tiers."""
+        self._memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
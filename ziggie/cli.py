@@ -0,0 +1,274 @@
+"""Command line batch runner for macro models.
+
+This module provides the "ziggie" command. It loads one or more JSON files of
+model specifications, runs each of them as a scenario in a single process or
+a pool of worker processes, and streams the results to a CSV file or a binary
+(pickle) file as each scenario completes.
+
+A JSON file can contain a model, a list of models (i.e. a ModelList) or a
+list of ModelLists. Each ModelList is a scenario. Functions in the parameters
+of a model are given by name:
+
+{
+    "name": "Simple SEIR model",
+    "compartments": {"S": 1000000, "E": 1, "I": 0, "R": 0},
+    "transitions": {"S_E": 0.6, "E_I": 0.2, "I_R": 0.1},
+    "parameters": {
+        "transition_funcs": {"S_E": "delta_S_I1"},
+        "after_funcs": ["reduce_infectivity"]
+    }
+}
+
+A plain name refers to a function in the ziggie.macro module. Other
+functions are given with their module, e.g. "ziggie.samples.mix_models".
+
+Examples:
+
+ziggie seir.json > seir.csv
+ziggie --workers 4 --seed 1 --record-frequency 1 *.json -o results.csv
+ziggie --format pickle scenarios.json -o results.pickle
+
+The pickle format is a sequence of pickled ModelListSeries, one per
+scenario, that can be read back with read_pickle.
+"""
+
+import argparse
+import csv
+import importlib
+import json
+from multiprocessing import Pool
+import pickle
+import sys
+from typing import Callable, Generator, List
+
+from ziggie import macro
+
+
+def resolve_function(name: str) -> Callable:
+    """Return the function a JSON model specification refers to.
+
+    Parameters:
+    name (str): name of a function in the macro module, or a module and
+                function name separated by a dot or colon
+                (e.g. ziggie.samples.mix_models)
+    """
+    if ':' in name:
+        module, _, func = name.partition(':')
+    elif '.' in name:
+        module, _, func = name.rpartition('.')
+    else:
+        module, func = 'ziggie.macro', name
+    try:
+        return getattr(importlib.import_module(module), func)
+    except (ImportError, AttributeError):
+        raise ValueError("Unknown function: " + name)
+
+
+def resolve_functions(model: macro.Model) -> macro.Model:
+    """Replace function names in the parameters of a model with functions.
+
+    The names in 'transition_funcs', 'before_funcs', 'after_funcs',
+    'before_array_funcs' and 'after_array_funcs' of the parameters of every
+    group are resolved with resolve_function. The model is changed in place
+    and returned.
+
+    Parameters:
+    model (Model): model loaded from a JSON specification
+    """
+    for group in macro.traverse(model):
+        parameters = group.get('parameters')
+        if parameters is None:
+            continue
+        funcs = parameters.get('transition_funcs', {})
+        for key, value in funcs.items():
+            if isinstance(value, str):
+                funcs[key] = resolve_function(value)
+        for hook in ('before_funcs', 'after_funcs', 'before_array_funcs',
+                     'after_array_funcs'):
+            if hook in parameters:
+                parameters[hook] = [
+                    resolve_function(f) if isinstance(f, str) else f
+                    for f in parameters[hook]
+                ]
+    return model
+
+
+def load_scenarios(filename: str) -> List[macro.ModelList]:
+    """Load the scenarios in a JSON file and return them as ModelLists.
+
+    Parameters:
+    filename (str): JSON file containing a model, a list of models or a
+                    list of lists of models
+    """
+    with open(filename) as f:
+        spec = json.load(f)
+    if isinstance(spec, dict):
+        scenarios = [[spec]]
+    elif len(spec) > 0 and isinstance(spec[0], dict):
+        scenarios = [spec]
+    else:
+        scenarios = spec
+    for modelList in scenarios:
+        for model in modelList:
+            resolve_functions(model)
+    return scenarios
+
+
+def _record_level(value):
+    try:
+        return int(value)
+    except ValueError:
+        if value not in ('leaf', 'model', 'modelList'):
+            raise argparse.ArgumentTypeError(
+                "must be leaf, model, modelList or an integer depth")
+        return value
+
+
+def _override(modelList, overrides):
+    for model in modelList:
+        model.setdefault('parameters', {}).update(overrides)
+    return modelList
+
+
+def _run(task):
+    modelList, ident, seed = task
+    return macro.simulate(modelList, ident, seed=seed)
+
+
+def run_scenarios(scenarios: List[macro.ModelList], workers=1,
+                  seed=None) -> Generator[macro.ModelListSeries, None, None]:
+    """Run scenarios and yield their results in order as they complete.
+
+    Each scenario is given its position in the list as its identifier.
+
+    Parameters:
+    scenarios (list of ModelList): the scenarios to run
+    workers (int): number of worker processes (1 runs the scenarios in
+                   this process)
+    seed (int): if not None, each scenario is run with seed + its
+                identifier as the seed of the random number generator
+    """
+    tasks = ((modelList, ident, None if seed is None else seed + ident)
+             for ident, modelList in enumerate(scenarios))
+    if workers == 1:
+        yield from map(_run, tasks)
+    else:
+        with Pool(processes=workers) as pool:
+            yield from pool.imap(_run, tasks)
+
+
+def write_csv(results, out, concat_names=None):
+    """Write a stream of scenario results to a CSV file.
+
+    Parameters:
+    results (iterable of ModelListSeries): results to write
+    out (file): text file to write to
+    concat_names (str): if not None then group names are concatenated,
+                        separated by this string
+    """
+    writer = csv.writer(out)
+    header = True
+    for modelListSeries in results:
+        # The header comes from the first scenario with any records
+        table = macro.series_to_table(modelListSeries, header, concat_names)
+        if len(table) > 0:
+            writer.writerows(table)
+            header = False
+        out.flush()
+
+
+def write_pickle(results, out):
+    """Write a stream of scenario results to a binary file.
+
+    Parameters:
+    results (iterable of ModelListSeries): results to write
+    out (file): binary file to write to
+    """
+    for modelListSeries in results:
+        pickle.dump(modelListSeries, out, pickle.HIGHEST_PROTOCOL)
+        out.flush()
+
+
+def read_pickle(filename: str) -> Generator[macro.ModelListSeries,
+                                            None, None]:
+    """Yield the scenario results in a file written with --format pickle.
+
+    Parameters:
+    filename (str): name of the file to read
+    """
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='ziggie', description='Run macro model specifications in '
+        'JSON files and stream the results.')
+    parser.add_argument('files', nargs='+', metavar='FILE',
+                        help='JSON file of model specifications')
+    parser.add_argument('-o', '--output',
+                        help='file to write to (default standard output)')
+    parser.add_argument('--format', choices=['csv', 'pickle'], default='csv',
+                        help='output format (default csv)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('--seed', type=int,
+                        help='seed for the random number generator')
+    parser.add_argument('--from', type=int, dest='from_',
+                        help='first iteration of every model')
+    parser.add_argument('--to', type=int,
+                        help='last iteration of every model')
+    parser.add_argument('--record-frequency', type=int,
+                        help='record results every this many iterations')
+    parser.add_argument('--record-level', type=_record_level,
+                        help='leaf, model, modelList or a group depth')
+    parser.add_argument('--no-record-first', action='store_true',
+                        help='do not record the initial state')
+    parser.add_argument('--no-record-last', action='store_true',
+                        help='do not record the final state')
+    parser.add_argument('--cache-dir',
+                        help='directory in which to cache compiled models')
+    parser.add_argument('--concat-names',
+                        help='concatenate group names in CSV output, '
+                        'separated by this string')
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    for key, value in (('from', args.from_), ('to', args.to),
+                       ('record_frequency', args.record_frequency),
+                       ('record_level', args.record_level),
+                       ('compile_cache', args.cache_dir)):
+        if value is not None:
+            overrides[key] = value
+    if args.no_record_first:
+        overrides['record_first'] = False
+    if args.no_record_last:
+        overrides['record_last'] = False
+
+    scenarios = []
+    for filename in args.files:
+        scenarios += [_override(modelList, overrides)
+                      for modelList in load_scenarios(filename)]
+    results = run_scenarios(scenarios, args.workers, args.seed)
+
+    if args.format == 'csv':
+        if args.output:
+            with open(args.output, 'w', newline='') as out:
+                write_csv(results, out, args.concat_names)
+        else:
+            write_csv(results, sys.stdout, args.concat_names)
+    else:
+        if args.output:
+            with open(args.output, 'wb') as out:
+                write_pickle(results, out)
+        else:
+            write_pickle(results, sys.stdout.buffer)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
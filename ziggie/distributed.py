@@ -0,0 +1,316 @@
+"""Run a series of model lists on worker processes on several machines.
+
+simulate_series in this module is a version of macro.simulate_series for
+ensembles that outgrow one machine. It starts a Coordinator that splits the
+series into tasks of one or more model lists and listens on a TCP address.
+Worker processes connect to it, on this machine or others, and repeatedly
+ask for a task, run it and send back the results.
+
+Start workers on other machines with:
+
+python -m ziggie.distributed HOST:PORT --authkey SECRET
+
+The connections are authenticated with the authkey, which must be the same
+for the coordinator and its workers, but are not encrypted. An authkey must
+be given to listen on addresses other than loopback ones, since messages
+from workers are unpickled; on a loopback address a random one is used by
+default, which only the local workers are given. Functions in
+the models are pickled by reference, so the workers must be able to import
+the same modules as the coordinator.
+
+If a worker's connection is lost while it is running a task, e.g. because
+its process or machine died, the task is given to another worker, as it is
+if it runs for longer than an optional timeout. A task is retried up to a
+limit, after which simulate_series raises a RuntimeError saying whether its
+workers were lost or it timed out. If a task raises an exception the
+exception is raised by simulate_series.
+
+Instead of the full results, workers can send back a smaller summary of
+each model list's results computed by a reducer function, e.g. the final
+totals of each model.
+
+All of this can be run on one machine by giving simulate_series a number
+of local workers to start:
+
+    results = simulate_series(modelListSeries, workers=4, seed=1)
+"""
+
+import argparse
+import ipaddress
+from multiprocessing import Process
+from multiprocessing.connection import Client, Listener
+import os
+import sys
+import threading
+import time
+from typing import Callable, List
+
+from ziggie import macro
+
+
+def _is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class Coordinator:
+    """Hands out tasks to workers that connect to it and collects results.
+
+    The coordinator listens for workers in background threads once start
+    is called.
+
+    Parameters:
+    tasks (list): the tasks to run, each a list of (modelList, ident, seed)
+                  tuples
+    address (tuple): (host, port) to listen on (port 0 picks a free port)
+    authkey (bytes): key that workers must use to connect. It is required
+                     unless the address is a loopback address, for which a
+                     random key is generated by default (see the authkey
+                     attribute).
+    reducer (function): if not None, workers send back reducer(results)
+                        instead of the results of each model list
+    retries (int): number of times a task is rerun after the worker running
+                   it is lost or it times out
+    timeout (float): if not None, a task that has run for this many seconds
+                     is also given to another worker, which counts as one
+                     of its retries (the first worker's result is still
+                     used if it arrives first)
+    """
+
+    def __init__(self, tasks: List, address=('localhost', 0),
+                 authkey: bytes = None, reducer: Callable = None,
+                 retries=3, timeout=None):
+        self.tasks = tasks
+        self.reducer = reducer
+        self.retries = retries
+        self.timeout = timeout
+        self.results = [None] * len(tasks)
+        self.error = None
+        self._done = [False] * len(tasks)
+        self._attempts = [0] * len(tasks)
+        self._pending = list(range(len(tasks)))
+        self._running = {}
+        self._condition = threading.Condition()
+        if authkey is None:
+            if not _is_loopback(address[0]):
+                raise ValueError("An authkey is required to listen on " +
+                                 str(address[0]))
+            authkey = os.urandom(32)
+        self.authkey = authkey
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+
+    def start(self):
+        """Start accepting workers."""
+        thread = threading.Thread(target=self._accept, daemon=True)
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                return
+            except Exception:
+                continue
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    def _finished(self):
+        return self.error is not None or all(self._done)
+
+    def _next(self, owner):
+        with self._condition:
+            while True:
+                if self._finished():
+                    return None
+                self._expire()
+                if len(self._pending) > 0:
+                    i = self._pending.pop(0)
+                    self._attempts[i] += 1
+                    self._running[i] = (time.monotonic(), owner)
+                    return i
+                self._condition.wait(1.0)
+
+    # Gives tasks that have run for longer than the timeout to other workers.
+    # Called with the condition held.
+    def _expire(self):
+        if self.timeout is not None:
+            now = time.monotonic()
+            for i, (started, _) in list(self._running.items()):
+                if now - started > self.timeout:
+                    self._lost(i, True)
+
+    def _lost(self, i, timed_out=False):
+        del self._running[i]
+        if self._done[i]:
+            return
+        if self._attempts[i] > self.retries:
+            if timed_out:
+                reason = " times because it ran for longer than the " \
+                         "timeout of " + str(self.timeout) + " seconds"
+            else:
+                reason = " times because its workers were lost"
+            self.error = RuntimeError(
+                "Task " + str(i) + " failed " + str(self._attempts[i]) +
+                reason)
+        else:
+            self._pending.append(i)
+        self._condition.notify_all()
+
+    def _serve(self, conn):
+        current = None
+        try:
+            while True:
+                message = conn.recv()
+                with self._condition:
+                    if message[0] == 'result':
+                        if not self._done[message[1]]:
+                            self.results[message[1]] = message[2]
+                            self._done[message[1]] = True
+                        self._running.pop(message[1], None)
+                        self._condition.notify_all()
+                    elif message[0] == 'error':
+                        self.error = message[2]
+                        self._condition.notify_all()
+                    current = None
+                i = self._next(conn)
+                if i is None:
+                    conn.send(None)
+                    return
+                current = i
+                conn.send((i, self.tasks[i], self.reducer))
+        except (EOFError, OSError):
+            with self._condition:
+                if current is not None and \
+                   self._running.get(current, (None, None))[1] is conn:
+                    self._lost(current)
+        finally:
+            conn.close()
+
+    def wait(self) -> List:
+        """Wait for all the tasks to finish and return their results.
+
+        The results are in the order of the tasks. If a task raised an
+        exception, or failed too often, it is raised.
+        """
+        with self._condition:
+            while not self._finished():
+                self._expire()
+                self._condition.wait(1.0)
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    def close(self):
+        """Stop accepting workers."""
+        self._listener.close()
+
+
+def run_worker(address, authkey: bytes = None):
+    """Run tasks from a coordinator until it has no more.
+
+    Parameters:
+    address (tuple): (host, port) of the coordinator
+    authkey (bytes): key to connect to the coordinator with
+    """
+    with Client(address, authkey=authkey) as conn:
+        conn.send(('ready',))
+        while True:
+            task = conn.recv()
+            if task is None:
+                return
+            i, scenarios, reducer = task
+            try:
+                results = []
+                for modelList, ident, seed in scenarios:
+                    result = macro.simulate(modelList, ident, seed=seed)
+                    results.append(result if reducer is None
+                                   else reducer(result))
+            except Exception as e:
+                conn.send(('error', i, e))
+                continue
+            conn.send(('result', i, results))
+
+
+def simulate_series(modelListSeries: macro.ModelListSeries,
+                    address=('localhost', 0), authkey: bytes = None,
+                    workers=0, seed=None, chunksize=1,
+                    reducer: Callable = None, retries=3,
+                    timeout=None) -> List:
+    """Execute series of models on workers and return their time series.
+
+    This returns the same as macro.simulate_series, or if reducer is not
+    None, a list of reducer(results) for each model list in the series.
+
+    Parameters:
+    modelListSeries (ModelListSeries): series of model lists to execute
+    address (tuple): (host, port) to listen for workers on (the default
+                     only accepts workers on this machine)
+    authkey (bytes): key that workers must use to connect (required unless
+                     the address is a loopback address, when the local
+                     workers are given a random key by default)
+    workers (int): number of worker processes to start on this machine
+    seed (int): if not None, each model list is run with seed + its
+                identifier as the seed of the random number generator
+    chunksize (int): number of model lists in each task
+    reducer (function): if not None, a function that workers apply to the
+                        results of each model list before sending them
+                        back
+    retries (int): number of times a task is rerun after the worker running
+                   it is lost or it times out
+    timeout (float): if not None, a task that has run for this many seconds
+                     is also given to another worker, which counts as one
+                     of its retries (the first worker's result is still
+                     used if it arrives first)
+    """
+    scenarios = [(modelList, ident, None if seed is None else seed + ident)
+                 for ident, modelList in enumerate(modelListSeries)]
+    tasks = [scenarios[i:i + chunksize]
+             for i in range(0, len(scenarios), chunksize)]
+    coordinator = Coordinator(tasks, address, authkey, reducer, retries,
+                              timeout)
+    coordinator.start()
+    processes = [Process(target=run_worker,
+                         args=(coordinator.address, coordinator.authkey),
+                         daemon=True)
+                 for _ in range(workers)]
+    for p in processes:
+        p.start()
+    try:
+        output = coordinator.wait()
+    finally:
+        coordinator.close()
+        for p in processes:
+            p.join(1.0)
+            if p.is_alive():
+                p.terminate()
+    results = macro.ResultSeries() if reducer is None else []
+    for r in output:
+        if reducer is None:
+            for result in r:
+                results += result
+        else:
+            results += r
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run simulations for a ziggie coordinator.')
+    parser.add_argument('address', metavar='HOST:PORT',
+                        help='address of the coordinator')
+    parser.add_argument('--authkey', help='key to connect with')
+    args = parser.parse_args(argv)
+    host, _, port = args.address.rpartition(':')
+    run_worker((host, int(port)),
+               None if args.authkey is None else args.authkey.encode())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,443 @@
+"""Exact stochastic simulation of macro models.
+
+This module provides the 'gillespie' engine, which is selected by setting
+the 'engine' parameter of the first model in a list to 'gillespie'. It
+simulates the same model specifications as the deterministic engine, but
+event by event: each transition moves one individual at a time, at random
+times, in continuous time. It is meant for small populations, such as an
+outbreak in a single facility, where chance events matter. The number of
+events, and so the time taken, grows with the size of the population.
+
+Every transition of every group is a reaction whose propensity (expected
+number of events per iteration) is the value its transition function would
+return, e.g. rate * S * I / N for delta_S_I. Only the built-in transition
+functions (delta_X_Y, delta_birth_X, delta_S_I and delta_S_I1) are
+supported. The events are already random, so the 'noise' parameter must be
+0 (a ValueError is raised otherwise).
+
+The engine uses the next reaction method of Gibson and Bruck (2000): the
+putative time of the next event of every reaction is kept in an indexed
+priority queue, and a dependency graph lists the reactions whose
+propensities change when a reaction fires, so that each event only updates
+those reactions instead of all of them.
+
+The models are recorded on the usual iteration grid. Functions in
+before_funcs and after_funcs are called at the start and end of each
+iteration, after which all the propensities are recalculated. They may
+change the values of compartments and transitions, but not add or remove
+them or replace their dictionaries (a ValueError is raised).
+"""
+
+import math
+import random
+import time
+from copy import deepcopy
+
+from ziggie import macro
+
+X_Y, BIRTH, S_I, S_I1 = range(4)
+
+KINDS = {
+    macro.delta_X_Y: X_Y,
+    macro.delta_birth_X: BIRTH,
+    macro.delta_S_I: S_I,
+    macro.delta_S_I1: S_I1,
+}
+
+INFECTIOUS = ('I', 'A', 'T')
+
+
+class IndexedPriorityQueue:
+    """Binary heap of items 0 to n-1 whose keys can be changed in place.
+
+    Parameters:
+    keys (list of float): initial key of each item
+    """
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.heap = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        self.position = [0] * len(self.keys)
+        for p, i in enumerate(self.heap):
+            self.position[i] = p
+
+    def top(self):
+        """Return the item with the smallest key."""
+        return self.heap[0]
+
+    def update(self, i, key):
+        """Change the key of an item and restore the heap order.
+
+        Parameters:
+        i (int): item to change
+        key (float): new key of the item
+        """
+        old = self.keys[i]
+        self.keys[i] = key
+        if key < old:
+            self._up(self.position[i])
+        else:
+            self._down(self.position[i])
+
+    def _swap(self, p, q):
+        heap = self.heap
+        heap[p], heap[q] = heap[q], heap[p]
+        self.position[heap[p]] = p
+        self.position[heap[q]] = q
+
+    def _up(self, p):
+        keys = self.keys
+        heap = self.heap
+        while p > 0:
+            parent = (p - 1) >> 1
+            if keys[heap[parent]] <= keys[heap[p]]:
+                break
+            self._swap(p, parent)
+            p = parent
+
+    def _down(self, p):
+        keys = self.keys
+        heap = self.heap
+        n = len(heap)
+        while True:
+            child = 2 * p + 1
+            if child >= n:
+                break
+            if child + 1 < n and keys[heap[child + 1]] < keys[heap[child]]:
+                child += 1
+            if keys[heap[p]] <= keys[heap[child]]:
+                break
+            self._swap(p, child)
+            p = child
+
+
+class Reactions:
+    """The reactions of a model list and the dependencies between them.
+
+    Parameters:
+    modelList (ModelList): models with complete parameters, as prepared by
+                           simulate
+    """
+
+    def __init__(self, modelList: macro.ModelList):
+        self.modelList = modelList
+        # For each reaction: kind, model index, compartments of its group,
+        # from compartment, to compartment, transitions dictionary that
+        # holds its rate, transition key
+        self.reactions = []
+        readers = {}
+        for m, model in enumerate(modelList):
+            for compartments, transitions, _ in macro._compile_and_bind(model):
+                for from_, to_, key, values, func in transitions:
+                    if func not in KINDS:
+                        raise ValueError(
+                            "Transition " + key + " uses " +
+                            func.__qualname__ + ", which the gillespie "
+                            "engine does not support")
+                    kind = KINDS[func]
+                    i = len(self.reactions)
+                    self.reactions.append((kind, m, compartments, from_, to_,
+                                           values, key))
+                    reads = [(m, id(compartments),
+                              to_ if kind == BIRTH else from_)]
+                    if kind == S_I:
+                        reads += [(m, 'total', to_), (m, 'N')]
+                    elif kind == S_I1:
+                        reads += [(m, 'infectious'), (m, 'N')]
+                    for r in reads:
+                        readers.setdefault(r, []).append(i)
+
+        self.dependencies = []
+        for i, (kind, m, compartments, from_, to_, _, _) in \
+                enumerate(self.reactions):
+            changes = [(m, id(compartments), from_),
+                       (m, id(compartments), to_),
+                       (m, 'total', from_), (m, 'total', to_)]
+            if (from_[0] == 'D') != (to_[0] == 'D'):
+                changes.append((m, 'N'))
+            if from_[0] in INFECTIOUS or to_[0] in INFECTIOUS:
+                changes.append((m, 'infectious'))
+            dependents = set()
+            for c in changes:
+                dependents.update(readers.get(c, ()))
+            dependents.discard(i)
+            self.dependencies.append(tuple(dependents))
+        self.recalculate_totals()
+
+    def recalculate_totals(self):
+        """Calculate the model totals used by the infection reactions."""
+        self.totals = []
+        self.N = []
+        self.infectious = []
+        self.weights = []
+        for model in self.modelList:
+            parameters = model['parameters']
+            weights = {'I': 1.0,
+                       'A': parameters['asymptomatic_infectiousness'],
+                       'T': parameters['treatment_infectiousness']}
+            totals = macro.calc_totals(model)
+            self.totals.append(totals)
+            self.N.append(totals['N'])
+            self.infectious.append(sum(weights[key[0]] * value
+                                       for key, value in totals.items()
+                                       if key[0] in weights))
+            self.weights.append(weights)
+
+    def propensity(self, i) -> float:
+        """Return the expected number of events per iteration of a reaction.
+
+        Parameters:
+        i (int): index of the reaction
+        """
+        kind, m, compartments, from_, to_, values, key = self.reactions[i]
+        rate = values[key]
+        if kind == X_Y:
+            return max(rate * compartments[from_], 0.0)
+        if kind == BIRTH:
+            return max(rate * compartments[to_], 0.0)
+        N = self.N[m]
+        if N <= 0:
+            return 0.0
+        if kind == S_I:
+            infectious = self.totals[m][to_]
+        else:
+            infectious = self.infectious[m]
+        return max(rate * compartments[from_] * infectious / N, 0.0)
+
+    def fire(self, i):
+        """Move one individual as reaction i and update the model totals.
+
+        Parameters:
+        i (int): index of the reaction
+        """
+        _, m, compartments, from_, to_, _, _ = self.reactions[i]
+        compartments[from_] -= 1
+        compartments[to_] += 1
+        totals = self.totals[m]
+        totals[from_] -= 1
+        totals[to_] += 1
+        if from_[0] == 'D':
+            self.N[m] += 1
+        if to_[0] == 'D':
+            self.N[m] -= 1
+        weights = self.weights[m]
+        self.infectious[m] += weights.get(to_[0], 0.0) - \
+            weights.get(from_[0], 0.0)
+
+
+def _draw(propensity, t):
+    if propensity > 0.0:
+        return t + random.expovariate(propensity)
+    return math.inf
+
+
+class NextReaction:
+    """State of a next reaction method simulation of a model list.
+
+    Parameters:
+    modelList (ModelList): models with complete parameters, as prepared by
+                           simulate
+    """
+
+    def __init__(self, modelList: macro.ModelList):
+        self.reactions = Reactions(modelList)
+        self.t = 0.0
+        self.events = 0
+        self.active = [True] * len(modelList)
+        self.reset()
+
+    def reset(self):
+        """Recalculate all propensities and draw new event times.
+
+        This must be called whenever the compartments, transitions or
+        parameters of the models are changed from outside.
+        """
+        reactions = self.reactions
+        reactions.recalculate_totals()
+        n = len(reactions.reactions)
+        self.propensities = [
+            reactions.propensity(i)
+            if self.active[reactions.reactions[i][1]] else 0.0
+            for i in range(n)
+        ]
+        self.queue = IndexedPriorityQueue(
+            [_draw(a, self.t) for a in self.propensities])
+
+    def advance(self, end):
+        """Fire reactions until the time of the next one is at least end.
+
+        Parameters:
+        end (float): time to advance to
+        """
+        reactions = self.reactions
+        propensities = self.propensities
+        queue = self.queue
+        keys = queue.keys
+        active = self.active
+        while len(keys) > 0:
+            mu = queue.top()
+            t = keys[mu]
+            if t >= end:
+                break
+            self.t = t
+            reactions.fire(mu)
+            self.events += 1
+            a = reactions.propensity(mu)
+            propensities[mu] = a
+            queue.update(mu, _draw(a, t))
+            for alpha in reactions.dependencies[mu]:
+                if not active[reactions.reactions[alpha][1]]:
+                    continue
+                old = propensities[alpha]
+                new = reactions.propensity(alpha)
+                propensities[alpha] = new
+                if new <= 0.0:
+                    queue.update(alpha, math.inf)
+                elif old > 0.0:
+                    queue.update(alpha, t + (old / new) * (keys[alpha] - t))
+                else:
+                    queue.update(alpha, _draw(new, t))
+        self.t = end
+
+
+def _steps(modelList, ident, profile, start):
+    for model in modelList:
+        for group in macro.traverse(model):
+            if 'compartments' in group:
+                compartments = group['compartments']
+                for key, value in compartments.items():
+                    compartments[key] = round(value)
+
+    def _record(models):
+        for model in models:
+            if ident is not None:
+                model['ident'] = ident
+        return (macro._record(models) if profile is None
+                else profile._record(models))
+
+    begin = min([m['parameters']['from'] for m in modelList])
+    from_ = begin if start is None else max(begin, start)
+    to_ = max([m['parameters']['to'] for m in modelList])
+    schedules = macro._schedules(modelList, begin, to_)
+
+    first = [m for m in modelList
+             if m['parameters']['record_first'] and start is None]
+    for model in first:
+        model['iteration'] = 0
+    if len(first) > 0:
+        yield 0, _record(first)
+
+    parameters = modelList[0]['parameters']
+    arrays = macro._model_arrays(modelList)
+    hooks = arrays is not None or any(m['parameters']['before_funcs'] or
+                                      m['parameters']['after_funcs']
+                                      for m in modelList)
+    fingerprints = [macro._fingerprint(m) for m in modelList]
+    simulation = NextReaction(modelList)
+    simulation.t = float(from_)
+    simulation.reset()
+    for iteration in range(from_, to_):
+        active = [False] * len(modelList)
+        for m, model in enumerate(modelList):
+            if iteration < model['parameters']['from'] or \
+               iteration >= model['parameters']['to']:
+                break
+            active[m] = True
+            model['iteration'] = iteration + 1
+            if ident is not None:
+                model['ident'] = ident
+        if profile is not None:
+            profile._start_iteration(iteration + 1, ident)
+        t0 = time.perf_counter()
+        changed = schedules and \
+            macro._apply_schedules(schedules, iteration, begin)
+        if hooks:
+            for m, model in enumerate(modelList):
+                if active[m]:
+                    for func in model['parameters']['before_funcs']:
+                        func(model, modelList)
+            macro._check_fingerprints(modelList, fingerprints, 'gillespie')
+        if parameters['before_array_funcs']:
+            macro._array_hooks(arrays, 'before_array_funcs', iteration + 1,
+                               None)
+        if hooks or changed or active != simulation.active:
+            simulation.active = active
+            simulation.reset()
+        t1 = time.perf_counter()
+        simulation.advance(float(iteration + 1))
+        t2 = time.perf_counter()
+        if hooks:
+            for m, model in enumerate(modelList):
+                if active[m]:
+                    for func in model['parameters']['after_funcs']:
+                        func(model, modelList)
+            macro._check_fingerprints(modelList, fingerprints, 'gillespie')
+        if parameters['after_array_funcs']:
+            macro._array_hooks(arrays, 'after_array_funcs', iteration + 1,
+                               None)
+        if profile is not None:
+            profile._add('before_funcs', t1 - t0)
+            profile._add('update_compartments', t2 - t1)
+            profile._add('after_funcs', time.perf_counter() - t2)
+            profile.iterations += sum(active)
+        recorded = [model for m, model in enumerate(modelList)
+                    if active[m] and (iteration + 1) %
+                    model['parameters']['record_frequency'] == 0]
+        yield iteration + 1, _record(recorded) if len(recorded) > 0 \
+            else None
+
+    if profile is not None:
+        profile._current = None
+    last = [m for m in modelList if m['parameters']['record_last']]
+    for model in last:
+        model['iteration'] = to_
+    if len(last) > 0:
+        yield to_, _record(last)
+
+
+def steps(modelList: macro.ModelList, ident=None, profile=None,
+          start=None):
+    """Iterate a list of models with the gillespie engine.
+
+    This is called by simulate when the 'engine' parameter of the first
+    model is 'gillespie'. The compartments are rounded to whole numbers
+    first. If the 'replicates' parameter of the first model is more than
+    one, the replicates are simulated one after the other and each
+    recorded model gets a 'replicate' field.
+
+    This is a generator that yields an (iteration, recorded models) pair
+    for each iteration, with None if no models were recorded, and for the
+    initial and final records.
+
+    Parameters:
+    modelList (ModelList): models with complete parameters, as prepared by
+                           simulate
+    ident (int): identifier to give the recorded models
+    profile (Profile): if not None, timings and counts of the run are added
+                       to this Profile
+    start (int): if not None, the iteration to resume the models from,
+                 without recording their initial state
+    """
+    replicates = modelList[0]['parameters']['replicates']
+    if replicates == 1:
+        yield from _steps(modelList, ident, profile, start)
+        return
+    for r in range(replicates):
+        replicate = deepcopy(modelList)
+        for model in replicate:
+            model['replicate'] = r
+        yield from _steps(replicate, ident, profile, start)
+
+
+def iterate(modelList: macro.ModelList, ident=None, profile=None):
+    """Return the ModelListSeries of models iterated by steps.
+
+    Parameters:
+    modelList (ModelList): models with complete parameters, as prepared by
+                           simulate
+    ident (int): identifier to give the recorded models
+    profile (Profile): if not None, timings and counts of the run are added
+                       to this Profile
+    """
+    return [recorded for _, recorded in steps(modelList, ident, profile)
+            if recorded is not None]
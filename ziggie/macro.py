@@ -9,6 +9,8 @@ a flat table or exported to a CSV file.
 
 The main functions are:
     * simulate - Takes a list of model specifications and executes it.
+    * simulate_iter - Same as simulate but yields the output as it is
+                      recorded.
     * simulate_series - Multiple lists of model specifications and
                         runs them in parallel.
     * series_to_table - Takes the output of the above and
@@ -267,6 +269,13 @@ them in a ModelList? Well, you could specify a custom function in the
 individuals between the two models or connect them in some other way. See the
 TestCorona class in test.py for an example.
 
+Before a run starts the structure of each model is compiled (see
+compile_model). Functions in "before_funcs" and "after_funcs" may change the
+values of compartments, transitions and parameters. They may also add or
+remove groups, compartments or transitions, or replace their dictionaries,
+but only with the default dict engine, which then compiles the structure
+again. The other engines raise a ValueError if they do this.
+
 
 Transitions
 -----------
@@ -315,12 +324,28 @@ V - Vaccinated
 
 """
 
+from array import array
+from bisect import bisect_right
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import csv
-from copy import deepcopy
+from copy import copy, deepcopy
+from functools import wraps
+from itertools import chain
+import mmap
+import pickle
 import random
+import multiprocessing
 from multiprocessing import Pool
 from typing import List, Dict, Generator
 import os
+import sys
+import tempfile
+import threading
+import time
+
+from ziggie import __version__
+from ziggie.cache import DiskCache, canonical, hash_key
 
 Model = Dict
 Group = Dict
@@ -483,6 +508,84 @@ def reduce_infectivity(model: Model, modelList=None):
                     group['transitions'][key] *= reduction
 
 
+def compile_schedule(schedule: Dict, from_: int, to_: int) -> List[float]:
+    """Return the value of a rate schedule for each iteration.
+
+    Instead of a number, the value of a transition can be a schedule that
+    gives its value on each iteration. There are three kinds of schedule,
+    each a list of [iteration, value] points:
+
+    * {'piecewise': [[0, 0.6], [60, 0.3], [120, 0.45]]} - the value of
+      each point holds from its iteration until the next point (the first
+      value also holds before the first point)
+    * {'linear': [[0, 0.001], [365, 0.01]]} - the value is interpolated
+      linearly between the points and is constant before the first and
+      after the last point
+    * {'value': 0.6, 'steps': [[60, 0.5], [90, 1.5]]} - the value starts
+      at 'value' and is multiplied by the value of each point from its
+      iteration onwards
+
+    Schedules are compiled when a simulation starts and the transition then
+    holds the value of the current iteration, which is what before_funcs
+    and after_funcs see and what is recorded. Functions that change a
+    scheduled transition are overridden on the next iteration.
+
+    Parameters:
+    schedule (dict): the schedule
+    from_ (int): first iteration
+    to_ (int): iteration after the last one
+    """
+    for kind in ('piecewise', 'linear', 'steps'):
+        if kind in schedule:
+            points = sorted(schedule[kind])
+            break
+    else:
+        raise ValueError("Unknown schedule: " + str(schedule))
+    if len(points) == 0 and kind != 'steps':
+        raise ValueError("Schedule has no points: " + str(schedule))
+    if kind == 'steps' and 'value' not in schedule:
+        raise ValueError("Schedule has no value: " + str(schedule))
+    values = []
+    j = 0
+    value = schedule['value'] if kind == 'steps' else points[0][1]
+    for iteration in range(from_, to_):
+        while j < len(points) and points[j][0] <= iteration:
+            if kind == 'steps':
+                value *= points[j][1]
+            else:
+                value = points[j][1]
+            j += 1
+        if kind == 'linear' and 0 < j < len(points):
+            (x0, y0), (x1, y1) = points[j - 1], points[j]
+            value = y0 + (y1 - y0) * (iteration - x0) / (x1 - x0)
+        values.append(value)
+    return values
+
+
+def _schedules(modelList, from_, to_):
+    schedules = []
+    for model in modelList:
+        for group in traverse(model):
+            transitions = group.get('transitions', {})
+            for key, value in transitions.items():
+                if isinstance(value, dict):
+                    values = compile_schedule(value, from_, to_)
+                    if len(values) > 0:
+                        transitions[key] = values[0]
+                    schedules.append((transitions, key, values))
+    return schedules
+
+
+def _apply_schedules(schedules, iteration, from_):
+    changed = False
+    for transitions, key, values in schedules:
+        value = values[iteration - from_]
+        if transitions[key] != value:
+            transitions[key] = value
+            changed = True
+    return changed
+
+
 # These are the default parameters
 PARAMETERS = {
     'from': 0,
@@ -497,6 +600,30 @@ PARAMETERS = {
     'discrete': False,
     'record_first': True,
     'record_last': True,
+    # What to record: 'leaf' (full model), a depth k (int), 'model' or
+    # 'modelList'. See _record.
+    'record_level': 'leaf',
+    # Directory in which to cache compiled model structures (see
+    # compile_model) and the maximum size in bytes of the cache
+    'compile_cache': None,
+    'compile_cache_size': 100 * 2**20,
+    # How to iterate the models: 'dict', 'binomial' (see the vector
+    # module) or 'gillespie' (see the gillespie module). The engine of the
+    # first model in a list is used for all of them.
+    'engine': 'dict',
+    # Number of independent replicates of the models to run
+    'replicates': 1,
+    # If not None, the approximate number of bytes of recorded model lists
+    # to keep in memory. simulate then returns a SpillSeries that writes
+    # the older records to a temporary file. Only the first model's is used.
+    'max_memory': None,
+    # Floating point type of the arrays of the binomial engine, 'float64'
+    # or 'float32' (see the vector module). The other engines use Python
+    # floats.
+    'precision': 'float64',
+    # Number of threads the binomial engine splits the groups of the models
+    # between on each iteration (see the vector module).
+    'threads': 1,
     'transition_funcs': {
         'S_I': delta_S_I,
         'S_E': delta_S_I,
@@ -507,49 +634,366 @@ PARAMETERS = {
     },
     'before_funcs': [],
     'after_funcs': [],
+    # Functions called with a vector.ArrayView of all the models once per
+    # iteration, before and after the models are updated. Only those of the
+    # first model in a list are used. These require NumPy.
+    'before_array_funcs': [],
+    'after_array_funcs': [],
+    # Transition keys to calculate the sensitivities of the compartments to
+    # (see calc_sensitivities). Only used by the dict engine.
+    'sensitivities': [],
 }
 
 
-def _update_compartments(model, totals, group=None,
-                         transitions=None, parameters=None):
-    if group is None:
-        group = model
+# Incremented whenever the output of compile_model changes
+_COMPILE_VERSION = 1
+
 
-    if transitions is None:
-        transitions = {}
-    t = transitions.copy()
-    if 'transitions' in group:
-        t.update(group['transitions'])
+def _structure(group: Group):
+    return (group.get('name'),
+            tuple(group['compartments']) if 'compartments' in group
+            else None,
+            tuple(group.get('transitions', ())),
+            'parameters' in group,
+            tuple(_structure(g) for g in group.get('groups', ())))
 
-    if parameters is None:
+
+def _compile(model):
+    leaves = []
+    parameters = []
+
+    def _walk(group, path, names, transitions):
+        t = transitions.copy()
+        for key in group.get('transitions', ()):
+            t[key] = path
+        if 'parameters' in group:
+            parameters.append(path)
+        if 'name' in group:
+            names = names + [group['name']]
+        if 'compartments' in group:
+            compartments = group['compartments']
+            for key in t:
+                from_to = key.split("_")
+                if len(from_to) != 2:
+                    raise ValueError("Transition " + key + " in group " +
+                                     str(names) + " is not two compartment "
+                                     "names separated by an underscore")
+                for c in from_to:
+                    if c not in compartments:
+                        raise ValueError("Transition " + key + " in group " +
+                                         str(names) + " refers to unknown "
+                                         "compartment " + c)
+            leaves.append({
+                'path': path,
+                'names': names,
+                'compartments': list(compartments),
+                'transitions': [tuple(key.split("_")) + (key, owner)
+                                for key, owner in t.items()],
+                'parameters': list(parameters),
+            })
+        for i, g in enumerate(group.get('groups', ())):
+            _walk(g, path + (i,), names, t)
+
+    _walk(model, (), [], {})
+    return {'version': _COMPILE_VERSION, 'leaves': leaves}
+
+
+def compile_model(model: Model, cache=None) -> Dict:
+    """Resolve and validate the structure of a model and return it.
+
+    A simulation only needs to work out once per run which transitions
+    and parameters apply to each group, rather than on every iteration.
+    This function does that work. It returns a dictionary with a 'leaves'
+    entry listing the groups that have compartments in the order traverse
+    yields them. Each leaf has:
+        * path - tuple of indices into the 'groups' lists from the model
+                 down to the leaf
+        * names - names of the groups along the path
+        * compartments - names of the leaf's compartments
+        * transitions - (from, to, key, owner path) for each transition
+                        that applies to the leaf, including inherited
+                        ones, where owner path is the path of the group
+                        whose 'transitions' entry defines it
+        * parameters - paths of the groups whose 'parameters' apply to
+                       the leaf
+
+    The result depends only on the structure of the model (its groups,
+    names and the keys of its compartments, transitions and parameters),
+    not on any values, so it can be reused for runs of the same
+    structure with different rates. A ValueError is raised if a
+    transition refers to a compartment its group does not have.
+
+    Parameters:
+    model (Model): the model to compile
+    cache (DiskCache): if not None, compiled structures are looked up in
+                       and stored in this cache, keyed by a hash of the
+                       model's structure
+    """
+    if cache is None:
+        return _compile(model)
+    key = hash_key('compile_model', _COMPILE_VERSION, _structure(model))
+    compiled = cache.get(key)
+    if compiled is None:
+        compiled = _compile(model)
+        cache.put(key, compiled)
+    return compiled
+
+
+def _group_at(model: Model, path) -> Group:
+    group = model
+    for i in path:
+        group = group['groups'][i]
+    return group
+
+
+def _bind(model: Model, compiled: Dict) -> List:
+    bound = []
+    for leaf in compiled['leaves']:
+        owners = [_group_at(model, p)['parameters']
+                  for p in leaf['parameters']]
         parameters = {}
-    if 'parameters' in group:
-        parameters.update(group['parameters'])
+        for p in owners:
+            parameters.update(p)
+        funcs = parameters['transition_funcs']
+        transitions = [
+            (from_, to_, key, _group_at(model, owner)['transitions'],
+             funcs.get(key, funcs['default']))
+            for from_, to_, key, owner in leaf['transitions']
+        ]
+        bound.append((_group_at(model, leaf['path'])['compartments'],
+                      transitions, owners))
+    return bound
+
+
+# Compiled structures kept in memory by processes that run many models of
+# the same structures, keyed by _structure (see pool.SimulationPool)
+_compiled = {}
+
+
+def _compile_cached(model: Model) -> Dict:
+    directory = model['parameters']['compile_cache']
+    cache = None
+    if directory is not None:
+        cache = DiskCache(directory,
+                          model['parameters']['compile_cache_size'])
+    return compile_model(model, cache)
+
+
+def _compile_and_bind(model: Model) -> List:
+    compiled = _compiled.get(_structure(model)) if _compiled else None
+    if compiled is None:
+        compiled = _compile_cached(model)
+    return _bind(model, compiled)
+
+
+# Functions in before_funcs and after_funcs may change the structure of a
+# model that has been bound, which the engines detect by comparing this
+# before and after calling them. The ids of the dictionaries can be compared
+# because the bound structure keeps the dictionaries it was bound to alive.
+def _fingerprint(model: Model) -> List:
+    result = []
+    stack = [model]
+    while stack:
+        group = stack.pop()
+        compartments = group.get('compartments')
+        transitions = group.get('transitions')
+        result.append((id(compartments), compartments and tuple(compartments),
+                       id(transitions), transitions and tuple(transitions),
+                       id(group.get('parameters'))))
+        if 'groups' in group:
+            stack += group['groups']
+    return result
 
-    if 'compartments' in group:
-        compartments = group['compartments']
-        deltas = {}
-        for key, value in t.items():
-            func = None
-            if key in parameters['transition_funcs']:
-                func = parameters['transition_funcs'][key]
+
+def _check_fingerprints(modelList, fingerprints, engine):
+    if [_fingerprint(m) for m in modelList] != fingerprints:
+        raise ValueError("Functions in before_funcs and after_funcs can't "
+                         "add or remove groups, compartments or "
+                         "transitions, or replace their dictionaries, with "
+                         "the " + engine + " engine")
+
+
+def _rebind(model, m, boundList, fingerprints):
+    fingerprint = _fingerprint(model)
+    if fingerprint != fingerprints[m]:
+        fingerprints[m] = fingerprint
+        boundList[m] = _compile_and_bind(model)
+        if model['parameters']['sensitivities']:
+            _init_sensitivities(model, boundList[m])
+    return boundList[m]
+
+
+def _calc_totals(bound) -> Dict[str, float]:
+    totals = {'N': 0}
+    for compartments, _, _ in bound:
+        for key, value in compartments.items():
+            if key in totals:
+                totals[key] += value
             else:
-                func = parameters['transition_funcs']['default']
-            val = func(key, value, compartments, totals, model)
-            noise = parameters['noise']
+                totals[key] = value
+            if key[0] != 'D':
+                totals['N'] += value
+    return totals
+
+
+def _update_compartments(model, totals, bound, profile=None):
+    if model['parameters']['sensitivities']:
+        _update_sensitivities(model, totals, bound, profile)
+        return
+    for compartments, transitions, owners in bound:
+        if len(owners) == 1:
+            parameters = owners[0]
+        else:
+            parameters = {}
+            for p in owners:
+                parameters.update(p)
+        noise = parameters['noise']
+        discrete = parameters['discrete']
+        deltas = []
+        for _, _, key, values, func in transitions:
+            if profile is None:
+                val = func(key, values[key], compartments, totals, model)
+            else:
+                val = profile._call(func, key, values[key], compartments,
+                                    totals, model)
             if noise:
                 val *= random.uniform(1.0 - noise, 1.0 + noise)
-            if parameters['discrete']:
+            if discrete:
                 val = round(val, 0)
-            deltas[key] = val
-        for key, value in deltas.items():
-            from_, to_ = key.split("_")
-            compartments[from_] -= value
-            compartments[to_] += value
+            deltas.append(val)
+        for transition, value in zip(transitions, deltas):
+            compartments[transition[0]] -= value
+            compartments[transition[1]] += value
+
+
+# Forward (tangent-linear) sensitivities. Each group with compartments has a
+# 'sensitivities' field holding, for each selected transition key, the
+# derivative of each of its compartments with respect to the value of that
+# transition. They are updated with the derivatives of the built-in
+# transition functions alongside the compartments, so they are exact for the
+# discrete-time equations the dict engine iterates.
+_TANGENTS = (delta_X_Y, delta_birth_X, delta_S_I, delta_S_I1)
+
+
+def _init_sensitivities(model, bound):
+    keys = model['parameters']['sensitivities']
+    for _, transitions, owners in bound:
+        for _, _, key, _, func in transitions:
+            if func not in _TANGENTS:
+                raise ValueError(
+                    "Sensitivities can't be calculated for transition " +
+                    key + ", which uses " + func.__qualname__ +
+                    " instead of a built-in transition function")
+        if any(p.get('discrete') for p in owners):
+            raise ValueError("Sensitivities can't be calculated for "
+                             "discrete models")
+    for group in traverse(model):
+        if 'compartments' in group:
+            tangent = group.setdefault('sensitivities', {})
+            for key in keys:
+                if key not in tangent:
+                    tangent[key] = dict.fromkeys(group['compartments'], 0.0)
+
+
+def _update_sensitivities(model, totals, bound, profile=None):
+    parameters = model['parameters']
+    keys = parameters['sensitivities']
+    weights = {'I': 1.0, 'T': parameters['treatment_infectiousness'],
+               'A': parameters['asymptomatic_infectiousness']}
+    tangents = [group['sensitivities'] for group in traverse(model)
+                if 'compartments' in group]
+    # Derivatives of the totals and of the weighted infectiousness used by
+    # delta_S_I1, which is kept up to date as each group is updated.
+    dtotals = {key: {'N': 0.0} for key in keys}
+    infectious = 0.0
+    dinfectious = dict.fromkeys(keys, 0.0)
+    for (compartments, _, _), tangent in zip(bound, tangents):
+        for c, value in compartments.items():
+            infectious += weights.get(c[0], 0.0) * value
+        for key in keys:
+            d = dtotals[key]
+            for c, value in tangent[key].items():
+                d[c] = d.get(c, 0.0) + value
+                if c[0] != 'D':
+                    d['N'] += value
+                dinfectious[key] += weights.get(c[0], 0.0) * value
+    N = totals['N']
+    for (compartments, transitions, owners), tangent in zip(bound, tangents):
+        noise = 0.0
+        for p in owners:
+            noise = p.get('noise', noise)
+        deltas = []
+        for from_, to_, key, values, func in transitions:
+            value = values[key]
+            if profile is None:
+                val = func(key, value, compartments, totals, model)
+            else:
+                val = profile._call(func, key, value, compartments, totals,
+                                    model)
+            if func is delta_X_Y:
+                base = compartments[from_]
+                dval = {k: value * tangent[k][from_] for k in keys}
+            elif func is delta_birth_X:
+                base = compartments[to_]
+                dval = {k: value * tangent[k][to_] for k in keys}
+            else:
+                X = compartments[from_]
+                f = totals[to_] / N if func is delta_S_I \
+                    else infectious / N
+                base = X * f
+                dval = {}
+                for k in keys:
+                    df = dtotals[k][to_] if func is delta_S_I \
+                        else dinfectious[k]
+                    df = (df - f * dtotals[k]['N']) / N
+                    dval[k] = value * (tangent[k][from_] * f + X * df)
+            if key in dval:
+                dval[key] += base
+            if noise:
+                u = random.uniform(1.0 - noise, 1.0 + noise)
+                val *= u
+                for k in keys:
+                    dval[k] *= u
+            deltas.append((val, dval))
+        for (from_, to_, _, _, _), (val, dval) in zip(transitions, deltas):
+            compartments[from_] -= val
+            compartments[to_] += val
+            w = weights.get(to_[0], 0.0) - weights.get(from_[0], 0.0)
+            infectious += w * val
+            for k in keys:
+                tangent[k][from_] -= dval[k]
+                tangent[k][to_] += dval[k]
+                dinfectious[k] += w * dval[k]
+
+
+def calc_sensitivities(model: Model) -> Dict[str, Dict[str, float]]:
+    """Sum the sensitivities of each compartment in all groups and return them.
+
+    When the 'sensitivities' parameter of a model lists transition keys,
+    e.g. ['S_I', 'I_R'], the dict engine calculates the derivative of every
+    compartment with respect to the value of each of those transitions as it
+    iterates, and stores them in a 'sensitivities' field of each group with
+    compartments: {'S_I': {'S': dS/dS_I, 'I': dI/dS_I, ...}, ...}. If
+    several groups define the same transition key, the derivative is with
+    respect to adding the same amount to all of them. This returns the sum
+    of the sensitivities of each compartment across the groups of a
+    model, like calc_totals does for the compartments.
+
+    The derivatives are exact, for the built-in transition functions only.
+    Functions in before_funcs and after_funcs, and scheduled values, are
+    treated as not depending on the transition values, and with noise the
+    derivatives are those of the run with its random draws held fixed.
 
-    if 'groups' in group:
-        for group in group['groups']:
-            _update_compartments(model, totals, group, t, parameters)
+    Parameters:
+    model (Model): a model, or recorded model, with sensitivities
+    """
+    result = {}
+    for group in traverse(model):
+        for key, tangent in group.get('sensitivities', {}).items():
+            totals = result.setdefault(key, {})
+            for c, value in tangent.items():
+                totals[c] = totals.get(c, 0.0) + value
+    return result
 
 
 def calc_totals(model: Model) -> Dict[str, float]:
@@ -611,6 +1055,31 @@ def sum_totals(totals: List[Dict[str, float]]) -> List[Dict[str, float]]:
     return result
 
 
+def conservation_drift(modelListSeries: ModelListSeries) -> List[float]:
+    """Return how far the total of all compartments drifts over each run.
+
+    Every transition moves individuals from one compartment to another, so
+    the sum of all the compartments of a model list, including the birth
+    (B) and dead (D) compartments, stays the same in exact arithmetic.
+    This returns, for each recorded model list, the relative difference
+    between that sum and its value in the first record of the same run
+    (ident and replicate), which measures the rounding error that has
+    accumulated, e.g. to compare float32 with float64 precision.
+
+    Parameters:
+    modelListSeries (ModelListSeries): time series of model lists
+    """
+    initial = {}
+    drift = []
+    for modelList in modelListSeries:
+        run = (modelList[0].get('ident'), modelList[0].get('replicate'))
+        total = sum(sum(_sum_compartments(model).values())
+                    for model in modelList)
+        N = initial.setdefault(run, total)
+        drift.append(abs(total - N) / abs(N) if N != 0 else abs(total))
+    return drift
+
+
 def _sum_compartment(total_dict, compartment_prefixes):
     total = 0
     for key, value in total_dict.items():
@@ -648,6 +1117,7 @@ def R0(modelListSeries: ModelListSeries) -> List[float]:
     """Calculate R0 for a time series of model outputs.
 
     Highly inaccurate and needs to be reconceptualised. Don't use for now.
+    Use reproduction_number and Rt instead.
     """
     if len(modelListSeries) < 4:
         return None
@@ -657,39 +1127,510 @@ def R0(modelListSeries: ModelListSeries) -> List[float]:
     return r0
 
 
-def _iterate_model(modelList, ident=None):
-    modelListSeries = []
+# Prefixes of the compartments of infected individuals (see the meaningful
+# compartment prefixes above)
+_INFECTED = ('E', 'I', 'A', 'T')
+
+
+def _solve(matrix, column):
+    # Gaussian elimination with partial pivoting. Returns None if the matrix
+    # is singular.
+    n = len(matrix)
+    a = [row[:] + [column[i]] for i, row in enumerate(matrix)]
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda r: abs(a[r][i]))
+        if a[pivot][i] == 0.0:
+            return None
+        a[i], a[pivot] = a[pivot], a[i]
+        for r in range(i + 1, n):
+            f = a[r][i] / a[i][i]
+            if f != 0.0:
+                for c in range(i, n + 1):
+                    a[r][c] -= f * a[i][c]
+    x = [0.0] * n
+    for i in reversed(range(n)):
+        x[i] = (a[i][n] - sum(a[i][c] * x[c]
+                              for c in range(i + 1, n))) / a[i][i]
+    return x
+
+
+def _spectral_radius(matrix, tolerance=1e-12, max_iterations=10000):
+    # Power iteration on the matrix plus the identity, which has the same
+    # dominant eigenvector as the non-negative matrix but converges even if
+    # the matrix is periodic.
+    n = len(matrix)
+    if n == 1:
+        return matrix[0][0]
+    x = [1.0] * n
+    value = 0.0
+    for _ in range(max_iterations):
+        y = [x[i] + sum(matrix[i][j] * x[j] for j in range(n))
+             for i in range(n)]
+        norm = max(y)
+        if norm == 0.0:
+            return 0.0
+        y = [v / norm for v in y]
+        converged = max(abs(u - v) for u, v in zip(x, y)) < tolerance
+        x, value = y, norm
+        if converged:
+            break
+    return value - 1.0
+
+
+# The residence times in the infected compartments only depend on the values
+# of the transitions out of them, so the next generation matrix is worked out
+# in two steps: a plan for the structure and those values, which Rt reuses
+# for all the records with the same ones, and its evaluation with the
+# infection rates, susceptibles and population of each record.
+def _rates_key(bound, weights):
+    return (weights, tuple(
+        (func, None if func is delta_S_I or func is delta_S_I1
+         else values[key])
+        for _, transitions, _ in bound
+        for _, _, key, values, func in transitions))
+
+
+def _next_generation(bound, weights):
+    # Each infection transition adds a rank one matrix to the next
+    # generation matrix F V^-1: the individuals it infects per infected
+    # individual, times the residence times of an individual infected by it
+    # in the infected compartments, weighted by how they contribute to the
+    # force of infection. Infections with the same kind of force of
+    # infection ('total' of one compartment for delta_S_I, 'weighted' for
+    # delta_S_I1) are summed, so the non-zero eigenvalues of F V^-1 are
+    # those of a matrix Q with a row and column for each kind. Returns the
+    # number of kinds and, for each infection, (leaf, position of the
+    # transition in the leaf, column, coefficients), where the infection
+    # adds coefficients[row] times its rate and the proportion of the
+    # population in its from compartment to Q[row][column]; or None if V is
+    # singular.
+    forces = {}
+    entries = []
+    for leaf, (compartments, transitions, _) in enumerate(bound):
+        infections = [(t, to_, func)
+                      for t, (_, to_, _, _, func) in enumerate(transitions)
+                      if func is delta_S_I or func is delta_S_I1]
+        if len(infections) == 0:
+            continue
+        infected = [c for c in compartments if c[0] in _INFECTED]
+        for _, to_, _ in infections:
+            if to_ not in infected:
+                infected.append(to_)
+        index = {c: i for i, c in enumerate(infected)}
+        V = [[0.0] * len(infected) for _ in infected]
+        for from_, to_, key, values, func in transitions:
+            if from_ not in index:
+                continue
+            if func is not delta_X_Y:
+                raise ValueError(
+                    "Can't calculate the reproduction number of transition " +
+                    key + " out of an infected compartment because it uses " +
+                    func.__qualname__ + " instead of delta_X_Y")
+            V[index[from_]][index[from_]] += values[key]
+            if to_ in index:
+                V[index[to_]][index[from_]] -= values[key]
+        residence = {}
+        for t, to_, func in infections:
+            if to_ not in residence:
+                e = [0.0] * len(infected)
+                e[index[to_]] = 1.0
+                residence[to_] = _solve(V, e)
+                if residence[to_] is None:
+                    return None
+            force = ('total', to_) if func is delta_S_I else ('weighted',)
+            entries.append((leaf, t, forces.setdefault(force, len(forces)),
+                            residence[to_], index))
+    plan = []
+    for leaf, t, column, r, index in entries:
+        coefficients = []
+        for force in forces:
+            if force[0] == 'total':
+                contribution = r[index[force[1]]] if force[1] in index \
+                    else 0.0
+            else:
+                contribution = sum(weights.get(c[0], 0.0) * r[i]
+                                   for c, i in index.items())
+            coefficients.append(contribution)
+        plan.append((leaf, t, column, coefficients))
+    return len(forces), plan
+
+
+def _evaluate(plan, bound):
+    N = _calc_totals(bound)['N']
+    if N == 0:
+        return 0.0
+    if plan is None:
+        return float('inf')
+    n, entries = plan
+    if n == 0:
+        return 0.0
+    Q = [[0.0] * n for _ in range(n)]
+    for leaf, t, column, coefficients in entries:
+        compartments, transitions, _ = bound[leaf]
+        from_, _, key, values, _ = transitions[t]
+        infections = values[key] * compartments[from_] / N
+        for row, coefficient in enumerate(coefficients):
+            Q[row][column] += infections * coefficient
+    return _spectral_radius(Q)
+
+
+def _weights(model):
+    parameters = model['parameters']
+    return (('I', 1.0), ('T', parameters['treatment_infectiousness']),
+            ('A', parameters['asymptomatic_infectiousness']))
+
+
+def reproduction_number(model: Model) -> float:
+    """Return the reproduction number of a model.
+
+    This is the dominant eigenvalue of the next-generation matrix F V^-1 of
+    the model in its current state, where F holds the rates of new
+    infections in each group's infected compartments (those starting with
+    E, I, A or T) caused by the individuals in the infected compartments,
+    and V the rates of the transitions out of and between the infected
+    compartments. It uses the current susceptibles and transition values, so
+    for a model that hasn't been simulated, with few infected individuals,
+    it is the basic reproduction number R0, and for a recorded model it is
+    the effective reproduction number at that iteration (see Rt).
+
+    The infections are those of the delta_S_I and delta_S_I1 transitions
+    and the transitions out of infected compartments must use delta_X_Y.
+    The transition values are per capita per iteration, as the dict engine
+    uses them.
+
+    Parameters:
+    model (Model): model with complete parameters, e.g. a recorded model
+    """
+    bound = _bind(model, compile_model(model))
+    return _evaluate(_next_generation(bound, dict(_weights(model))), bound)
+
+
+def Rt(modelListSeries: ModelListSeries) -> List[List[float]]:
+    """Calculate the effective reproduction number of each recorded model.
+
+    Returns a list with an entry for each model list in the series, holding
+    reproduction_number of each of its models. The structure of the models
+    is compiled once for all the records with the same structure, and the
+    residence times in the infected compartments are solved once for all
+    the records with the same structure and values of the transitions out
+    of them, so that each record only costs a pass over its groups, far
+    less than simulating it. The infection rates may change between
+    records, e.g. with reduce_infectivity. The records must be full models
+    (the 'leaf' record_level), with the transition values at each
+    iteration, including scheduled ones.
+
+    Parameters:
+    modelListSeries (ModelListSeries): output of simulate
+    """
+    compiled = {}
+    plans = {}
+    result = []
+    for modelList in modelListSeries:
+        row = []
+        for model in modelList:
+            structure = _structure(model)
+            if structure not in compiled:
+                compiled[structure] = compile_model(model)
+            bound = _bind(model, compiled[structure])
+            weights = _weights(model)
+            key = (structure, _rates_key(bound, weights))
+            if key not in plans:
+                plans[key] = _next_generation(bound, dict(weights))
+            row.append(_evaluate(plans[key], bound))
+        result.append(row)
+    return result
+
+
+def _sum_compartments(group: Group) -> Dict[str, float]:
+    totals = {}
+    for g in traverse(group):
+        if 'compartments' in g:
+            for key, value in g['compartments'].items():
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _aggregate(group: Group, depth: int, sensitivities=False) -> Group:
+    result = {key: group[key]
+              for key in ('ident', 'replicate', 'iteration', 'name')
+              if key in group}
+    if depth <= 0 or 'groups' not in group:
+        result['compartments'] = _sum_compartments(group)
+        if sensitivities:
+            result['sensitivities'] = calc_sensitivities(group)
+    else:
+        result['groups'] = [_aggregate(g, depth - 1, sensitivities)
+                            for g in group['groups']]
+    return result
+
+
+def _record(modelList: ModelList) -> ModelList:
+    """Return the snapshot of a model list to store in the output series.
+
+    The 'record_level' parameter determines what is stored:
+        * 'leaf' - a full copy of each model (the default)
+        * k (int) - each model with the groups at depth k replaced by
+                    the sums of their compartments, where depth 0 is the
+                    model itself and depth 1 its top-level groups
+        * 'model' - the same as 0, i.e. the totals of each model
+        * 'modelList' - a single entry with the totals across all the
+                        models in the list
+
+    Aggregated snapshots only contain the name, ident, iteration, groups
+    and compartments fields, and the sums of the sensitivities of models
+    that calculate them (except at the 'modelList' level), so the output
+    remains a ModelListSeries that can be passed to calc_totals,
+    series_to_table, etc. The 'record_level' of the first model
+    determines whether the whole list is aggregated into one entry.
+    """
+    if modelList[0]['parameters']['record_level'] == 'modelList':
+        result = {key: modelList[0][key]
+                  for key in ('ident', 'replicate', 'iteration')
+                  if key in modelList[0]}
+        result['compartments'] = sum_totals([_sum_compartments(model)
+                                             for model in modelList])
+        return [result]
+    snapshot = []
+    memo = {}
+    for model in modelList:
+        level = model['parameters']['record_level']
+        if level == 'leaf':
+            snapshot.append(deepcopy(model, memo))
+        elif level == 'model':
+            snapshot.append(_aggregate(
+                model, 0, bool(model['parameters']['sensitivities'])))
+        elif isinstance(level, int):
+            snapshot.append(_aggregate(
+                model, level, bool(model['parameters']['sensitivities'])))
+        else:
+            raise ValueError("Unknown record_level: " + str(level))
+    return snapshot
+
+
+def _sizeof(obj, seen=None) -> int:
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _sizeof(key, seen) + _sizeof(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            size += _sizeof(value, seen)
+    return size
+
+
+class Profile:
+    """Timings and counts collected while models are simulated.
+
+    Pass an instance as the profile argument of simulate or
+    simulate_series to find out where the time of a run goes.
+    Profiling is off by default and costs nothing when it is off.
+
+    The collected values are:
+        * phases - seconds spent in each phase of the iteration loop:
+                   before_funcs, calc_totals, update_compartments,
+                   after_funcs and record
+        * funcs - for each transition function, the number of calls
+                  and the seconds spent in them
+        * iterations - number of model iterations executed
+        * records - number of model lists recorded
+        * bytes_recorded - approximate in-memory size of the recorded
+                           output
+        * trace - if trace is True, a list with the phase timings of
+                  every iteration
+
+    Example:
+    profile = Profile()
+    simulate([my_model], profile=profile)
+    print(profile.report())
+
+    Parameters:
+    trace (bool): whether to also collect per-iteration timings
+    """
+
+    PHASES = ('before_funcs', 'calc_totals', 'update_compartments',
+              'after_funcs', 'record')
+
+    def __init__(self, trace=False):
+        self.phases = dict.fromkeys(self.PHASES, 0.0)
+        self.funcs = {}
+        self.iterations = 0
+        self.records = 0
+        self.bytes_recorded = 0
+        self.trace = [] if trace else None
+        self._current = None
+
+    def report(self) -> Dict:
+        """Return the collected values as a dictionary."""
+        report = {
+            'phases': dict(self.phases),
+            'funcs': {key: dict(value) for key, value in self.funcs.items()},
+            'iterations': self.iterations,
+            'records': self.records,
+            'bytes_recorded': self.bytes_recorded,
+        }
+        if self.trace is not None:
+            report['trace'] = list(self.trace)
+        return report
+
+    def merge(self, report: Dict):
+        """Add the values of a report to this profile.
+
+        Parameters:
+        report (dict): output of the report method of another profile
+        """
+        for key, value in report['phases'].items():
+            self.phases[key] += value
+        for key, value in report['funcs'].items():
+            stats = self.funcs.setdefault(key, {'calls': 0, 'time': 0.0})
+            stats['calls'] += value['calls']
+            stats['time'] += value['time']
+        self.iterations += report['iterations']
+        self.records += report['records']
+        self.bytes_recorded += report['bytes_recorded']
+        if self.trace is not None:
+            self.trace += report.get('trace', [])
+
+    def _add(self, phase, elapsed):
+        self.phases[phase] += elapsed
+        if self._current is not None:
+            self._current[phase] += elapsed
+
+    def _start_iteration(self, iteration, ident):
+        if self.trace is not None:
+            self._current = dict.fromkeys(self.PHASES, 0.0)
+            self._current['iteration'] = iteration
+            self._current['ident'] = ident
+            self.trace.append(self._current)
+
+    def _call(self, func, *args):
+        start = time.perf_counter()
+        val = func(*args)
+        elapsed = time.perf_counter() - start
+        stats = self.funcs.get(func.__qualname__)
+        if stats is None:
+            stats = self.funcs[func.__qualname__] = {'calls': 0, 'time': 0.0}
+        stats['calls'] += 1
+        stats['time'] += elapsed
+        return val
+
+    def _step(self, model, modelList, bound, rebind=None):
+        start = time.perf_counter()
+        for func in model['parameters']['before_funcs']:
+            func(model, modelList)
+        if rebind is not None:
+            bound = _rebind(model, *rebind)
+        t1 = time.perf_counter()
+        totals = _calc_totals(bound)
+        t2 = time.perf_counter()
+        _update_compartments(model, totals, bound, self)
+        t3 = time.perf_counter()
+        for func in model['parameters']['after_funcs']:
+            func(model, modelList)
+        t4 = time.perf_counter()
+        self._add('before_funcs', t1 - start)
+        self._add('calc_totals', t2 - t1)
+        self._add('update_compartments', t3 - t2)
+        self._add('after_funcs', t4 - t3)
+        self.iterations += 1
+
+    def _record(self, modelList):
+        start = time.perf_counter()
+        snapshot = _record(modelList)
+        self._add('record', time.perf_counter() - start)
+        self.records += 1
+        self.bytes_recorded += _sizeof(snapshot)
+        return snapshot
+
+
+# The dict and gillespie engines keep the state in the models, so the arrays
+# given to the array hooks are synchronised with the models around each call.
+def _model_arrays(modelList):
+    parameters = modelList[0]['parameters']
+    if not (parameters['before_array_funcs'] or
+            parameters['after_array_funcs']):
+        return None
+    try:
+        from ziggie import vector
+    except ImportError:
+        raise ImportError("before_array_funcs and after_array_funcs "
+                          "require numpy")
+    return vector.ModelArrays(modelList)
+
+
+def _array_hooks(arrays, name, iteration, profile):
+    from ziggie import vector
+    vector.array_hooks(arrays, name, iteration, sync=True, profile=profile)
+
+
+def _steps_model(modelList, ident=None, profile=None, start=None):
+    parameters = modelList[0]['parameters']
+    first = min([m['parameters']['from'] for m in modelList])
+    from_ = first if start is None else max(first, start)
+    to_ = max([m['parameters']['to'] for m in modelList])
+    schedules = _schedules(modelList, first, to_)
+    boundList = [_compile_and_bind(model) for model in modelList]
+    for model, bound in zip(modelList, boundList):
+        if model['parameters']['sensitivities']:
+            _init_sensitivities(model, bound)
+    hooks = any(m['parameters']['before_funcs'] or
+                m['parameters']['after_funcs'] for m in modelList)
+    fingerprints = [_fingerprint(m) for m in modelList] if hooks else None
     firstModelList = []
     for model in modelList:
-        if model['parameters']['record_first']:
+        if model['parameters']['record_first'] and start is None:
             if ident is not None:
                 model['ident'] = ident
             model['iteration'] = 0
-            firstModelList.append(deepcopy(model))
+            firstModelList.append(model)
     if len(firstModelList) > 0:
-        modelListSeries.append(firstModelList)
-    from_ = min([m['parameters']['from'] for m in modelList])
-    to_ = max([m['parameters']['to'] for m in modelList])
+        yield 0, (_record(firstModelList) if profile is None
+                  else profile._record(firstModelList))
+    arrays = _model_arrays(modelList)
 
     for iteration in range(from_, to_):
         iterationModelList = []
-        for model in modelList:
+        if profile is not None:
+            profile._start_iteration(iteration + 1, ident)
+        if schedules:
+            _apply_schedules(schedules, iteration, first)
+        if arrays is not None and parameters['before_array_funcs']:
+            _array_hooks(arrays, 'before_array_funcs', iteration + 1,
+                         profile)
+        for m, model in enumerate(modelList):
             if iteration < model['parameters']['from'] or \
                iteration >= model['parameters']['to']:
                 break
             model['iteration'] = iteration + 1
             if ident is not None:
                 model['ident'] = ident
-            for func in model['parameters']['before_funcs']:
-                func(model, modelList)
-            totals = calc_totals(model)
-            _update_compartments(model, totals)
-            for func in model['parameters']['after_funcs']:
-                func(model, modelList)
+            bound = boundList[m]
+            if profile is None:
+                for func in model['parameters']['before_funcs']:
+                    func(model, modelList)
+                if hooks:
+                    bound = _rebind(model, m, boundList, fingerprints)
+                totals = _calc_totals(bound)
+                _update_compartments(model, totals, bound)
+                for func in model['parameters']['after_funcs']:
+                    func(model, modelList)
+            else:
+                profile._step(model, modelList, bound,
+                              (m, boundList, fingerprints) if hooks else None)
             if (iteration + 1) % model['parameters']['record_frequency'] == 0:
                 iterationModelList.append(model)
+        if arrays is not None and parameters['after_array_funcs']:
+            _array_hooks(arrays, 'after_array_funcs', iteration + 1, profile)
         if len(iterationModelList) > 0:
-            modelListSeries.append(deepcopy(iterationModelList))
+            yield iteration + 1, (
+                _record(iterationModelList) if profile is None
+                else profile._record(iterationModelList))
+        else:
+            yield iteration + 1, None
 
     lastModelList = []
     for model in modelList:
@@ -697,11 +1638,74 @@ def _iterate_model(modelList, ident=None):
             if ident is not None:
                 model['ident'] = ident
             model['iteration'] = to_
-            lastModelList.append(deepcopy(model))
+            lastModelList.append(model)
+    if profile is not None:
+        profile._current = None
     if len(lastModelList) > 0:
-        modelListSeries.append(lastModelList)
-
-    return modelListSeries
+        yield to_, (_record(lastModelList) if profile is None
+                    else profile._record(lastModelList))
+
+
+# Each engine yields an (iteration, recorded models) pair for every iteration,
+# with None in place of the recorded models if none were recorded, as well as
+# one for each of the initial and final records. This lets callers stream the
+# results and stop runs between iterations. If start is not None the models
+# are resumed from that iteration: the initial state is not recorded and the
+# earlier iterations are skipped.
+def _steps(modelList, ident=None, profile=None, start=None):
+    parameters = modelList[0]['parameters']
+    engine = parameters['engine']
+    if engine != 'dict' and any(m['parameters']['sensitivities']
+                                for m in modelList):
+        raise ValueError("Sensitivities are only calculated by the dict "
+                         "engine")
+    if parameters['precision'] not in ('float64', 'float32'):
+        raise ValueError("Unknown precision: " + str(parameters['precision']))
+    if engine != 'binomial' and parameters['precision'] != 'float64':
+        raise ValueError("Only the binomial engine supports float32 "
+                         "precision")
+    if engine != 'binomial' and parameters['threads'] != 1:
+        raise ValueError("Only the binomial engine uses threads")
+    if engine == 'binomial':
+        try:
+            from ziggie import vector
+        except ImportError:
+            raise ImportError("The " + engine + " engine requires numpy")
+        return vector.steps(modelList, ident, profile, start)
+    if engine == 'gillespie':
+        if any(group['parameters'].get('noise') for model in modelList
+               for group in traverse(model) if 'parameters' in group):
+            raise ValueError("The gillespie engine doesn't support noise")
+        from ziggie import gillespie
+        return gillespie.steps(modelList, ident, profile, start)
+    if engine != 'dict':
+        raise ValueError("Unknown engine: " + str(engine))
+    if parameters['replicates'] == 1:
+        return _steps_model(modelList, ident, profile, start)
+    return _steps_replicates(modelList, ident, profile, start)
+
+
+def _steps_replicates(modelList, ident=None, profile=None, start=None):
+    for r in range(modelList[0]['parameters']['replicates']):
+        replicate = deepcopy(modelList)
+        for model in replicate:
+            model['replicate'] = r
+        yield from _steps_model(replicate, ident, profile, start)
+
+
+def _iterate(modelList, ident=None, profile=None, start=None):
+    return _collect(modelList, _steps(modelList, ident, profile, start))
+
+
+def _collect(modelList, steps):
+    max_memory = modelList[0]['parameters']['max_memory']
+    if max_memory is None:
+        return [recorded for _, recorded in steps if recorded is not None]
+    results = SpillSeries(max_memory)
+    for _, recorded in steps:
+        if recorded is not None:
+            results.append(recorded)
+    return results
 
 
 def _get_header(model, concat_names=None):
@@ -712,6 +1716,8 @@ def _get_header(model, concat_names=None):
     for group in traverse(model):
         if 'ident' in group:
             current.append('ident')
+        if 'replicate' in group:
+            current.append('replicate')
         if 'iteration' in group:
             current.append('iter')
         if 'name' in group:
@@ -733,51 +1739,97 @@ def _get_header(model, concat_names=None):
     return biggest
 
 
-def model_to_table(model: Model, concat_names=None) -> List[List]:
-    """Create and return a table from a model.
-
-    This converts a model to list of lists, where each list corresponds
-    to a group in the model. This is also an interim step to converting
-    a model output to a csv file.
-
-    Parameters
-    model (Model): model to convert
-    concat_names (str): if not None then group names are concatenated,
-                        separated by this string
-    """
-    table = []
-    current = []
+# Tables are filled from a layout worked out once for each sequence of
+# groups (their names, fields and the keys of their compartments), so that
+# tabulating the records of a run only copies their values. A layout is a
+# list of the (group index, field) of the identifier columns of the rows,
+# and for each row the position of its identifier columns in that list, its
+# name columns and the index of its group.
+def _table_groups(model, values=None):
+    # The groups in the order traverse yields them, and their signature:
+    # the name, fields and compartment names of each group. If values is
+    # not None, the values of the compartments are appended to it in the
+    # same walk, in the order of the rows of the table.
+    groups = []
+    signature = []
+    stack = [model]
+    while stack:
+        group = stack.pop()
+        groups.append(group)
+        signature.append(group.get('name'))
+        signature.append(tuple(group))
+        if 'compartments' in group:
+            compartments = group['compartments']
+            signature.append(tuple(compartments))
+            if values is not None:
+                values.extend(compartments.values())
+        if 'groups' in group:
+            stack += reversed(group['groups'])
+    return groups, tuple(signature)
+
+
+def _table_layout(groups, concat_names):
+    specs = {}
+    rows = []
     idents = []
     prevIdents = idents
     names = []
     prevNames = names
-    for group in traverse(model):
-        if 'ident' in group:
-            idents.append(group['ident'])
-        if 'iteration' in group:
-            idents.append(group['iteration'])
+    for index, group in enumerate(groups):
+        for field in ('ident', 'replicate', 'iteration'):
+            if field in group:
+                idents.append((index, field))
         if 'name' in group:
             names.append(group['name'])
         if 'compartments' in group:
             i = max(len(prevIdents) - len(idents), 0)
-            current += prevIdents[:i] + idents
-
+            spec = tuple(prevIdents[:i] + idents)
             i = max(len(prevNames) - len(names), 0)
             if concat_names is None:
-                current += prevNames[:i] + names
+                nameColumns = prevNames[:i] + names
             else:
-                current.append(concat_names.join(prevNames[:i] + names))
-            for key, val in group['compartments'].items():
-                current.append(val)
-            table.append(current.copy())
-            current = []
+                nameColumns = [concat_names.join(prevNames[:i] + names)]
+            rows.append((specs.setdefault(spec, len(specs)), nameColumns,
+                         index))
             if len(prevIdents) < len(idents):
                 prevIdents = idents.copy()
             idents = []
             if len(prevNames) < len(names):
                 prevNames = names.copy()
             names = []
-    return table
+    return list(specs), rows
+
+
+def _model_layout(model, concat_names, layouts, values=None):
+    groups, signature = _table_groups(model, values)
+    layout = layouts.get((signature, concat_names))
+    if layout is None:
+        layout = layouts[(signature, concat_names)] = \
+            _table_layout(groups, concat_names)
+    return groups, layout
+
+
+def _model_rows(model, concat_names, layouts):
+    groups, (specs, rows) = _model_layout(model, concat_names, layouts)
+    idents = [[groups[g][field] for g, field in spec] for spec in specs]
+    return [idents[spec] + nameColumns +
+            list(groups[index]['compartments'].values())
+            for spec, nameColumns, index in rows]
+
+
+def model_to_table(model: Model, concat_names=None) -> List[List]:
+    """Create and return a table from a model.
+
+    This converts a model to list of lists, where each list corresponds
+    to a group in the model. This is also an interim step to converting
+    a model output to a csv file.
+
+    Parameters
+    model (Model): model to convert
+    concat_names (str): if not None then group names are concatenated,
+                        separated by this string
+    """
+    return _model_rows(model, concat_names, {})
 
 
 def modelList_to_table(modelList: ModelList, header=True,
@@ -796,11 +1848,12 @@ def modelList_to_table(modelList: ModelList, header=True,
     concat_names (str): if not None then group names are concatenated,
                         separated by this string
     """
+    layouts = {}
     table = []
     if header:
         table.append(_get_header(modelList[0], concat_names))
     for model in modelList:
-        table += model_to_table(model, concat_names)
+        table += _model_rows(model, concat_names, layouts)
     return table
 
 
@@ -839,17 +1892,18 @@ def series_to_table(modelListSeries: ModelListSeries, header=True,
 
     Parameters
     modelListSeries (ModelListSeries): time series of model lists to convert
-    header (bool): whether or not the first row should be a header
+    header (bool): whether or not the first row should be a header (an
+                   empty series gives an empty table)
     concat_names (str): if not None then group names are concatenated,
                         separated by this string
     """
     table = []
-    if header:
+    if header and len(modelListSeries) > 0:
         table.append(_get_header(modelListSeries[0][0], concat_names))
+    layouts = {}
     for modelList in modelListSeries:
-        tbl = modelList_to_table(modelList, False, concat_names)
-        for row in tbl:
-            table.append(row)
+        for model in modelList:
+            table += _model_rows(model, concat_names, layouts)
     return table
 
 
@@ -877,7 +1931,191 @@ def series_to_csv(modelListSeries: ModelListSeries, csvfile: str,
     table_to_csv(table, csvfile, delimiter, quotechar, quoting)
 
 
-def simulate(modelList: ModelList, ident=None) -> ModelListSeries:
+_ID_COLUMNS = {'ident': 'ident', 'replicate': 'replicate', 'iteration': 'iter'}
+
+
+# Collects the columns of series_to_dataframe with NumPy. The values of the
+# compartments are copied straight into one flat array of doubles, and
+# everything else is worked out once for each table layout and expanded to
+# the rows of every model with the layout with NumPy indexing: the codes of
+# the group names into lists of categories, the compartments of each row and
+# which of the model's identifier specs it uses. Returns a list of (column
+# name, data, categories) where categories is None unless the data are the
+# codes of a categorical column.
+def _dataframe_columns(modelListSeries, long, concat_names):
+    import numpy
+    layouts = {}
+    layoutIndex = {}
+    layoutRows = []
+    categories = []
+    compartmentSets = {}
+    identNames = {}
+    identValues = []
+    models = array('q')
+    values = array('d')
+    for modelList in modelListSeries:
+        for model in modelList:
+            groups, layout = _model_layout(model, concat_names, layouts,
+                                           values)
+            specs, rows = layout
+            k = layoutIndex.get(id(layout))
+            if k is None:
+                k = layoutIndex[id(layout)] = len(layoutRows)
+                names = []
+                for _, nameColumns, index in rows:
+                    codes = []
+                    for j, name in enumerate(nameColumns):
+                        if j == len(categories):
+                            categories.append({})
+                        codes.append(categories[j].setdefault(
+                            name, len(categories[j])))
+                    names.append(codes)
+                    compartmentSets.setdefault(
+                        tuple(groups[index]['compartments']),
+                        len(compartmentSets))
+                layoutRows.append((
+                    [spec for spec, _, _ in rows], names,
+                    [compartmentSets[tuple(groups[index]['compartments'])]
+                     for _, _, index in rows], len(specs)))
+            models.append(k)
+            for spec in specs:
+                row = {}
+                for g, field in spec:
+                    name = identNames.setdefault(_ID_COLUMNS[field],
+                                                 len(identNames))
+                    row.setdefault(name, groups[g][field])
+                identValues.append(row)
+
+    # Rows of all the layouts, one after the other
+    specOf = []
+    namesOf = []
+    keysOf = []
+    for specs, names, keys, _ in layoutRows:
+        specOf += specs
+        namesOf += names
+        keysOf += keys
+    counts = numpy.array([len(r[0]) for r in layoutRows], numpy.int_)
+    starts = numpy.cumsum(counts) - counts
+    models = numpy.frombuffer(models, numpy.int64) if len(models) \
+        else numpy.zeros(0, numpy.int_)
+    perModel = counts[models]
+    first = numpy.cumsum(perModel) - perModel
+    rows = numpy.repeat(starts[models] - first, perModel) + \
+        numpy.arange(perModel.sum())
+    specCounts = numpy.array([r[3] for r in layoutRows], numpy.int_)[models]
+    specs = numpy.repeat(numpy.cumsum(specCounts) - specCounts, perModel) + \
+        numpy.array(specOf, numpy.int_)[rows]
+    keys = numpy.array(keysOf, numpy.int_)[rows]
+
+    columnsOf = list(compartmentSets)
+    compartments = {}
+    for columns in columnsOf:
+        for c in columns:
+            compartments.setdefault(c, len(compartments))
+    values = numpy.frombuffer(values) if len(values) else numpy.zeros(0)
+    lengths = numpy.array([len(c) for c in columnsOf], numpy.int_)[keys]
+    offsets = numpy.cumsum(lengths) - lengths
+
+    def _expand(column):
+        return numpy.repeat(column, lengths) if long else column
+
+    result = []
+    for name, i in identNames.items():
+        column = numpy.array([row.get(i) for row in identValues])
+        result.append((name, _expand(column[specs]), None))
+    for j, names in enumerate(categories):
+        codes = numpy.array([row[j] if j < len(row) else -1
+                             for row in namesOf], numpy.int32)
+        result.append(('name' if concat_names is not None
+                       else 'name_' + str(j), _expand(codes[rows]),
+                       list(names)))
+    if long:
+        codes = numpy.empty(len(values), numpy.int32)
+        for k, columns in enumerate(columnsOf):
+            where = numpy.flatnonzero(keys == k)
+            codes[offsets[where][:, None] + numpy.arange(len(columns))] = \
+                [compartments[c] for c in columns]
+        result.append(('compartment', codes, list(compartments)))
+        result.append(('value', values, None))
+        return result
+    if len(columnsOf) == 1 and list(columnsOf[0]) == list(compartments):
+        matrix = values.reshape(len(keys), len(compartments))
+    else:
+        matrix = numpy.full((len(keys), len(compartments)), numpy.nan)
+        for k, columns in enumerate(columnsOf):
+            where = numpy.flatnonzero(keys == k)
+            matrix[numpy.ix_(where, [compartments[c] for c in columns])] = \
+                values[offsets[where][:, None] + numpy.arange(len(columns))]
+    result.append((list(compartments), matrix, None))
+    return result
+
+
+def series_to_dataframe(modelListSeries: ModelListSeries, layout='wide',
+                        index=False, concat_names=None, precision=None):
+    """Create a pandas DataFrame from a time series of model lists.
+
+    This is the equivalent of series_to_table for pandas, but it builds
+    the columns of the frame directly as arrays rather than as rows of
+    Python objects that pandas then has to convert, so that large ensembles
+    load quickly. The group names are stored as categoricals.
+
+    In the 'wide' layout there is a row for each group with compartments
+    in each recorded model, with the same columns as series_to_table: the
+    ident, replicate and iter columns the records have, the names of the
+    groups (name_0, name_1, ... or name if concat_names is not None) and a
+    column for each compartment (NaN for groups without it). In the 'long'
+    layout there is a row for each compartment of each of these groups,
+    with a categorical compartment column and a value column instead of the
+    compartment columns.
+
+    E.g. frame = series_to_dataframe(simulate_series(series), index=True)
+
+    This requires pandas.
+
+    Parameters:
+    modelListSeries (ModelListSeries): time series of model lists to convert
+    layout (str): 'wide' or 'long'
+    index (bool): if True, the identifier and name columns (and compartment
+                  column in the long layout) are made a MultiIndex
+    concat_names (str): if not None then group names are concatenated,
+                        separated by this string
+    precision (str): type of the compartment values, 'float64' or 'float32'
+                     (default the 'precision' parameter of the first
+                     recorded model, or 'float64' if it wasn't recorded)
+    """
+    try:
+        import pandas
+    except ImportError:
+        raise ImportError("series_to_dataframe requires pandas")
+    if layout not in ('wide', 'long'):
+        raise ValueError("Unknown layout: " + str(layout))
+    if precision is None:
+        first = modelListSeries[0][0] if len(modelListSeries) > 0 else {}
+        precision = first.get('parameters', {}).get('precision', 'float64')
+    if precision not in ('float64', 'float32'):
+        raise ValueError("Unknown precision: " + str(precision))
+    columns = _dataframe_columns(modelListSeries, layout == 'long',
+                                 concat_names)
+    if layout == 'wide':
+        names, matrix, _ = columns.pop()
+        frame = pandas.DataFrame(matrix.astype(precision, copy=False),
+                                 columns=names, copy=False)
+    else:
+        name, values, _ = columns[-1]
+        columns[-1] = (name, values.astype(precision, copy=False), None)
+        frame = pandas.DataFrame(index=pandas.RangeIndex(len(values)))
+    for i, (name, data, categories) in enumerate(columns):
+        if categories is not None:
+            data = pandas.Categorical.from_codes(data, categories)
+        frame.insert(i, name, data)
+    if index:
+        frame = frame.set_index([name for name, _, _ in columns
+                                 if name != 'value'])
+    return frame
+
+
+def simulate(modelList: ModelList, ident=None, profile=None,
+             seed=None, cache=None) -> ModelListSeries:
     """Iterate list of models and return a time series of model lists.
 
     Note that often the first parameter will only contain one model. It's
@@ -891,41 +2129,868 @@ def simulate(modelList: ModelList, ident=None) -> ModelListSeries:
     ident (int): unique identifier to use to identify this time series
                  (useful for generating a table or CSV file with multiple
                  model time series).
+    profile (Profile): if not None, timings and counts of the run are
+                       added to this Profile
+    seed (int): if not None, the random number generator is seeded with
+                this so that noisy runs can be reproduced
+    cache (ResultCache): if not None, the results are looked up in and
+                         stored in this cache. Runs with noise or a
+                         stochastic engine are only cached if they have a
+                         seed, and runs with a profile are not cached. A
+                         cached seeded run restores the state the random
+                         number generator was left in by the run, and
+                         results are returned as a SpillSeries if the
+                         'max_memory' parameter is set.
 
     """
+    models = _prepare(modelList)
+    if seed is not None:
+        random.seed(seed)
+    key = None
+    if cache is not None and profile is None:
+        key = _result_key(models, ident, seed)
+        if key is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                results, state = cached
+                # A seeded run leaves the random number generator in the
+                # same state whether or not its results were cached
+                if state is not None:
+                    random.setstate(state)
+                max_memory = models[0]['parameters']['max_memory']
+                if max_memory is not None:
+                    spilled = SpillSeries(max_memory)
+                    spilled.extend(results)
+                    results = spilled
+                return results
+    results = _iterate(models, ident, profile)
+    if key is not None:
+        cache.put(key, (results, None if seed is None
+                        else random.getstate()))
+    return results
+
+
+# Incremented whenever what simulate stores in a ResultCache changes
+_RESULT_VERSION = 1
+
+
+# A run is cached under a hash of its models with their complete parameters,
+# its identifier, seed and the version of ziggie. Runs with noise or a
+# stochastic engine are only cached if they have a seed, and runs whose
+# models refer to functions that can't be identified by name (e.g. lambdas)
+# are not cached. Functions in before_funcs and after_funcs are assumed not
+# to use the random number generator unless the run has a seed.
+def _result_key(modelList, ident, seed):
+    if seed is None:
+        for model in modelList:
+            parameters = model['parameters']
+            if parameters['noise'] or parameters['engine'] != 'dict':
+                return None
+    try:
+        return hash_key('simulate', _RESULT_VERSION, __version__, ident,
+                        seed, canonical(modelList))
+    except TypeError:
+        return None
+
+
+def simulate_iter(modelList: ModelList, ident=None, profile=None,
+                  seed=None) -> Generator[ModelList, None, None]:
+    """Iterate list of models and yield each model list as it is recorded.
+
+    This takes the same parameters as simulate and yields the same model
+    lists that simulate returns, but one at a time as the simulation
+    progresses, so that they can be processed, or the simulation stopped,
+    before it finishes.
+
+    Parameters:
+    modelList (modelList): list of related models to iterate
+    ident (int): unique identifier to use to identify this time series
+    profile (Profile): if not None, timings and counts of the run are
+                       added to this Profile
+    seed (int): if not None, the random number generator is seeded with
+                this so that noisy runs can be reproduced
+    """
+    if seed is not None:
+        random.seed(seed)
+    for _, recorded in _steps(_prepare(modelList), ident, profile):
+        if recorded is not None:
+            yield recorded
+
+
+def _prepare(modelList):
     results = []
     for model in modelList:
         m = deepcopy(model)
         m['parameters'] = _make_parameters(m.get('parameters', {}))
         results.append(m)
-    return _iterate_model(results, ident)
+    return results
 
 
 def _simulate(m):
-    return simulate(m[0], m[1])
+    if m[2] is None:
+        return simulate(m[0], m[1], seed=m[3]), None
+    profile = Profile(trace=m[2])
+    return simulate(m[0], m[1], profile, m[3]), profile.report()
+
+
+class ResultSeries(list):
+    """A time series of model lists indexed by identifier and iteration.
+
+    simulate_series and the other functions that run a series of model
+    lists return one of these. It is a list of the recorded model lists, in
+    the same order as before, so it can be used wherever a ModelListSeries
+    is used, but finding the records of one run or iteration doesn't need
+    a scan of the whole list:
+
+        results = simulate_series(series)
+        results.run(3)                  # the records of the run with ident 3
+        results.at(365)                 # the records at iteration 365
+        results.get(3, 365)             # the model list of run 3 at 365
+        results.values('D', 365)        # D in each run at iteration 365
+        results.values('D', 365, path=('Corona', 'Rural'))
+
+    The index is built the first time it is needed and again after the list
+    is changed with any of its methods, e.g. append, sort or reverse.
+    Changes to the identifiers or iterations of the recorded models
+    themselves are not noticed. Group paths are the names of the model and
+    of the named groups down to a group, as in vector.ArrayView.groups.
+    """
+
+    def _index(self):
+        index = self.__dict__.get('_indices')
+        if index is None or index[0] != len(self):
+            idents = {}
+            iterations = {}
+            keys = {}
+            for i, modelList in enumerate(self):
+                first = modelList[0]
+                ident = first.get('ident')
+                iteration = first.get('iteration')
+                idents.setdefault(ident, []).append(i)
+                iterations.setdefault(iteration, []).append(i)
+                keys.setdefault((ident, first.get('replicate'), iteration), i)
+            index = self._indices = (len(self), idents, iterations, keys)
+        return index
+
+    def idents(self) -> List:
+        """Return the identifiers of the runs in the order they first occur."""
+        return list(self._index()[1])
+
+    def iterations(self) -> List:
+        """Return the iterations recorded in the order they first occur."""
+        return list(self._index()[2])
+
+    def run(self, ident) -> 'ResultSeries':
+        """Return the model lists recorded by the run with an identifier.
+
+        Parameters:
+        ident (int): identifier of the run
+        """
+        return ResultSeries(self[i] for i in self._index()[1].get(ident, ()))
+
+    def at(self, iteration: int) -> 'ResultSeries':
+        """Return the model lists of all the runs recorded at an iteration.
+
+        Parameters:
+        iteration (int): the iteration
+        """
+        return ResultSeries(self[i]
+                            for i in self._index()[2].get(iteration, ()))
+
+    def get(self, ident, iteration: int, replicate=None) -> ModelList:
+        """Return the model list recorded by a run at an iteration, or None.
+
+        Parameters:
+        ident (int): identifier of the run
+        iteration (int): the iteration
+        replicate (int): the replicate, for runs with replicates
+        """
+        i = self._index()[3].get((ident, replicate, iteration))
+        return None if i is None else self[i]
+
+    def group(self, modelList: ModelList, path) -> Group:
+        """Return the group of a recorded model list at a path, or None.
+
+        Parameters:
+        modelList (ModelList): a model list of this series
+        path (tuple): names of the model and named groups down to the group
+        """
+        path = tuple(path)
+        routes = self.__dict__.setdefault('_routes', {})
+        route = routes.get(path)
+        if route is not None:
+            group = _follow(modelList, route, path)
+            if group is not None:
+                return group
+        for m, model in enumerate(modelList):
+            route = _route(model, path, (), (m,))
+            if route is not None:
+                routes[path] = route
+                return _follow(modelList, route, path)
+        return None
+
+    def values(self, compartment: str, iteration: int = None, ident=None,
+               path=None) -> List[float]:
+        """Return the value of a compartment in each of the selected records.
+
+        The records are those at the iteration and of the run given, or all
+        of them if these are None, in the order of the list. The value is the
+        sum of the compartment in the group at the path (the whole model
+        list if path is None), or None if a record doesn't have the group.
+
+        Parameters:
+        compartment (str): name of the compartment
+        iteration (int): if not None, only records at this iteration
+        ident (int): if not None, only records of this run
+        path (tuple): if not None, names of the model and named groups down
+                      to the group to sum
+        """
+        _, idents, iterations, _ = self._index()
+        if iteration is not None and ident is not None:
+            selected = sorted(set(iterations.get(iteration, ())) &
+                              set(idents.get(ident, ())))
+        elif iteration is not None:
+            selected = iterations.get(iteration, [])
+        elif ident is not None:
+            selected = idents.get(ident, [])
+        else:
+            selected = range(len(self))
+        result = []
+        for i in selected:
+            if path is None:
+                groups = self[i]
+            else:
+                group = self.group(self[i], path)
+                groups = [] if group is None else [group]
+            total = None
+            for group in groups:
+                value = _sum_compartments(group).get(compartment)
+                if value is not None:
+                    total = value if total is None else total + value
+            result.append(total)
+        return result
+
+    def __getstate__(self):
+        return {}
+
+
+def _invalidating(method):
+    @wraps(method)
+    def mutate(self, *args, **kwargs):
+        self.__dict__.pop('_indices', None)
+        return method(self, *args, **kwargs)
+    return mutate
+
+
+for _name in ('__setitem__', '__delitem__', '__iadd__', '__imul__',
+              'append', 'extend', 'insert', 'pop', 'remove', 'clear',
+              'reverse', 'sort'):
+    setattr(ResultSeries, _name, _invalidating(getattr(list, _name)))
+
+
+# A route to a group is the index of its model in the list followed by the
+# index of each group in its parent's 'groups' down to it. Routes are
+# checked against the names along them before they are reused.
+def _route(group, path, names, route):
+    if 'name' in group:
+        names = names + (group['name'],)
+    if names != path[:len(names)]:
+        return None
+    if names == path:
+        return route
+    for i, g in enumerate(group.get('groups', ())):
+        found = _route(g, path, names, route + (i,))
+        if found is not None:
+            return found
+    return None
+
+
+def _follow(modelList, route, path):
+    if route[0] >= len(modelList):
+        return None
+    group = modelList[route[0]]
+    names = []
+    for i in route[1:]:
+        if 'name' in group:
+            names.append(group['name'])
+        children = group.get('groups', ())
+        if i >= len(children):
+            return None
+        group = children[i]
+    if 'name' in group:
+        names.append(group['name'])
+    return group if tuple(names) == path else None
+
+
+class SpillSeries(Sequence):
+    """A time series of model lists that spills to a temporary file.
+
+    Runs with a 'max_memory' parameter return one of these instead of a
+    list, so that long runs that record often don't run out of memory. The
+    most recent records are kept in a buffer in memory. When the buffer is
+    full the records in it are pickled as one chunk and appended to a
+    temporary file, which is memory-mapped to read them back. The series
+    can be indexed, sliced and iterated like a list wherever its records
+    are, and iterating over it reads one chunk at a time.
+
+    Roughly half of max_memory is used for the buffer and half for the
+    last chunk read back. The size of a record is estimated from the first
+    record of each chunk, so the bound is approximate. Records read from
+    the file are copies: changing them doesn't change the series. The
+    records must be picklable, and a SpillSeries is pickled as a list.
+
+    Parameters:
+    max_memory (int): approximate number of bytes of records to keep in
+                      memory
+    """
+
+    def __init__(self, max_memory: int):
+        self.max_memory = max_memory
+        self._buffer = []
+        self._capacity = None
+        self._chunks = []
+        self._starts = []
+        self._spilled = 0
+        self._file = None
+        self._map = None
+        self._cached = (None, None)
+
+    def append(self, modelList: ModelList):
+        """Add a model list to the end of the series.
+
+        Parameters:
+        modelList (ModelList): the recorded model list
+        """
+        if self._capacity is None:
+            self._capacity = max(1, self.max_memory //
+                                 (2 * max(1, _sizeof(modelList))))
+        self._buffer.append(modelList)
+        if len(self._buffer) >= self._capacity:
+            self._spill()
+
+    def extend(self, modelListSeries: ModelListSeries):
+        """Add model lists to the end of the series.
+
+        Parameters:
+        modelListSeries (ModelListSeries): the recorded model lists
+        """
+        for modelList in modelListSeries:
+            self.append(modelList)
+
+    def _spill(self):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='ziggie-')
+        data = pickle.dumps(self._buffer, pickle.HIGHEST_PROTOCOL)
+        self._file.seek(0, os.SEEK_END)
+        self._chunks.append((self._file.tell(), len(data)))
+        self._starts.append(self._spilled)
+        self._file.write(data)
+        self._file.flush()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._spilled += len(self._buffer)
+        self._buffer = []
+        self._capacity = None
+
+    def _chunk(self, c):
+        if self._cached[0] != c:
+            if self._map is None:
+                self._map = mmap.mmap(self._file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            offset, length = self._chunks[c]
+            # Release the last chunk read before reading the next one
+            self._cached = (None, None)
+            self._cached = (c, pickle.loads(
+                self._map[offset:offset + length]))
+        return self._cached[1]
+
+    def __len__(self):
+        return self._spilled + len(self._buffer)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("SpillSeries index out of range")
+        if i >= self._spilled:
+            return self._buffer[i - self._spilled]
+        c = bisect_right(self._starts, i) - 1
+        return self._chunk(c)[i - self._starts[c]]
+
+    def __iter__(self):
+        for c in range(len(self._chunks)):
+            yield from self._chunk(c)
+        yield from list(self._buffer)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, SpillSeries)) or \
+           len(other) != len(self):
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+    def close(self):
+        """Delete the temporary file and the records in it."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._chunks = []
+        self._starts = []
+        self._spilled = 0
+        self._cached = (None, None)
+
+
+class CancelToken:
+    """A flag that stops the simulations of a batch that haven't finished.
+
+    Pass one as the cancel argument of simulate_series and call cancel,
+    e.g. from another thread or from the progress callback, to stop the
+    batch. simulate_series then returns the results of the model lists
+    that had finished. Runs in threads or in this process stop after the
+    iteration they are running, and runs in worker processes are
+    abandoned when the pool is stopped.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """Ask the simulations using this token to stop."""
+        self._event.set()
+
+    def cancelled(self) -> bool:
+        """Return whether cancel has been called."""
+        return self._event.is_set()
+
+
+# Runs of the thread backend share the random module, so it is seeded and
+# each run started (which is when the vectorised engines seed their own
+# generators) while holding this lock.
+_seed_lock = threading.Lock()
+
+
+def _until(steps, cancel):
+    for step in steps:
+        yield step
+        if cancel.cancelled():
+            steps.close()
+            return
+
+
+# Runs a model list in this process, as the thread and serial backends of
+# simulate_series do. Returns None if the run is cancelled.
+def _simulate_local(m, cancel=None):
+    modelList, ident, trace, seed = m
+    if cancel is not None and cancel.cancelled():
+        return None
+    profile = None if trace is None else Profile(trace=trace)
+    models = _prepare(modelList)
+    with _seed_lock:
+        if seed is not None:
+            random.seed(seed)
+        steps = _steps(models, ident, profile)
+        first = next(steps, (None, None))
+    if cancel is not None:
+        steps = _until(steps, cancel)
+    results = _collect(models, chain([first], steps))
+    if cancel is not None and cancel.cancelled():
+        return None
+    return results, None if profile is None else profile.report()
+
+
+def _simulate_indexed(m):
+    return m[1], _simulate(m)
+
+
+# Each backend yields (ident, (results, profile report)) for each model list
+# as it finishes, and stops early if cancel is set.
+def _run_processes(tasks, processes, cancel):
+    if len(tasks) == 0:
+        return
+    # The same chunks as Pool.map
+    chunksize, extra = divmod(len(tasks), (processes or os.cpu_count()) * 4)
+    with Pool(processes=processes) as pool:
+        finished = pool.imap_unordered(_simulate_indexed, tasks,
+                                       max(1, chunksize + bool(extra)))
+        if cancel is None:
+            yield from finished
+            return
+        for _ in range(len(tasks)):
+            while True:
+                if cancel.cancelled():
+                    return
+                try:
+                    yield finished.next(timeout=0.1)
+                    break
+                except multiprocessing.TimeoutError:
+                    pass
+
+
+def _run_threads(tasks, threads, cancel):
+    with ThreadPoolExecutor(threads) as executor:
+        futures = {executor.submit(_simulate_local, m, cancel): m[1]
+                   for m in tasks}
+        # Once cancelled, the runs that haven't started return None at once
+        for future in as_completed(futures):
+            result = future.result()
+            if result is not None:
+                yield futures[future], result
+
+
+def _run_serial(tasks, cancel):
+    for m in tasks:
+        result = _simulate_local(m, cancel)
+        if result is None:
+            return
+        yield m[1], result
+
+
+def _iterations(modelList):
+    parameters = [dict(PARAMETERS, **model.get('parameters', {}))
+                  for model in modelList]
+    return (max(p['to'] for p in parameters) -
+            min(p['from'] for p in parameters)) * parameters[0]['replicates']
+
+
+def _progress(completed, total, iterations, start):
+    elapsed = time.perf_counter() - start
+    return {
+        'completed': completed,
+        'total': total,
+        'elapsed': elapsed,
+        'iterations': iterations,
+        'iterations_per_second': iterations / elapsed if elapsed > 0
+        else 0.0,
+        'eta': elapsed / completed * (total - completed) if completed > 0
+        else None,
+    }
+
+
+# Estimated amount of work, in group iterations, below which 'auto' runs a
+# series in this process: about a second of the dict engine, which is more
+# than the time it takes to start a pool of processes.
+_SERIAL_WORK = 20000
+
+
+def _work(modelList):
+    work = 0
+    for model in modelList:
+        parameters = dict(PARAMETERS, **model.get('parameters', {}))
+        leaves = sum(1 for g in traverse(model) if 'compartments' in g)
+        work += leaves * (parameters['to'] - parameters['from']) * \
+            parameters['replicates']
+    return work
+
+
+def _choose_backend(modelListSeries, processes):
+    if processes == 1 or len(modelListSeries) <= 1:
+        return 'serial'
+    if all(modelList[0].get('parameters', {}).get('engine') == 'binomial'
+           for modelList in modelListSeries):
+        return 'thread'
+    if sum(_work(modelList) for modelList in modelListSeries) < \
+       _SERIAL_WORK:
+        return 'serial'
+    return 'process'
 
 
 def simulate_series(modelListSeries: ModelListSeries,
-                    processes=os.cpu_count()) -> ModelListSeries:
+                    processes=os.cpu_count(),
+                    profile=None, seed=None, backend='process',
+                    progress=None, cancel=None) -> ModelListSeries:
     """Execute series of models and return a time series of model lists.
 
     This function is useful for sensitivity analysis or calibration.
     The point of it is to execute the same or related models many times.
     It uses Python's multiprocessing library to execute the models in
     parallel. It returns a time series of model lists each with a unique
-    identifier so that the output can be sorted appropriately afterwards.
+    identifier so that the output can be sorted appropriately afterwards,
+    as a ResultSeries, which can look up the records of each identifier and
+    iteration without scanning the whole series.
+
+    The backend determines where the model lists are run:
+        * 'process' - in a pool of worker processes (the default)
+        * 'thread' - in a pool of threads in this process, which avoids
+                     starting processes and pickling the models and results.
+                     Only the binomial engine runs in parallel in threads,
+                     because NumPy releases the GIL. Runs that draw from the
+                     random module after they start (noise in the dict
+                     engine, the gillespie engine and hooks) are not
+                     reproducible with a seed.
+        * 'serial' - one after the other in this process
+        * 'auto' - 'serial' if there is one model list or process or the
+                   series is small, 'thread' if all the model lists use
+                   the binomial engine, else 'process'
+
+    If progress is not None it is called, in the calling thread, each time
+    a model list finishes, with a dictionary of:
+        * completed - number of model lists finished
+        * total - number of model lists in the series
+        * elapsed - seconds since the series started
+        * iterations - iterations of the finished model lists (times their
+                       replicates)
+        * iterations_per_second - iterations / elapsed
+        * eta - estimated seconds until the series finishes
+
+    If cancel is not None and its cancel method is called, the model lists
+    that haven't finished are stopped and the results of those that have
+    are returned (see CancelToken).
+
+    E.g. simulate_series(series, progress=lambda p: print(p['eta']))
 
     Parameters:
     modelListSeries (modelListSeries): series of model lists to execute in
                                        parallel
+    processes (int): number of CPU processes, or threads, to use (default
+                     one for each CPU on the machine)
+    profile (Profile): if not None, the timings and counts of all the
+                       runs are added to this Profile
+    seed (int): if not None, each model list is run with seed + its
+                identifier as the seed of the random number generator
+    backend (str): 'process', 'thread', 'serial' or 'auto'
+    progress (function): if not None, called with the progress of the
+                         series each time a model list finishes
+    cancel (CancelToken): if not None, a token to stop the series with
+    """
+    if backend == 'auto':
+        backend = _choose_backend(modelListSeries, processes)
+    trace = None if profile is None else profile.trace is not None
+    mls_with_ident = [(m[0], m[1], trace,
+                       None if seed is None else seed + m[1])
+                      for m in zip(modelListSeries,
+                                   range(len(modelListSeries)))]
+    if backend == 'process':
+        finished = _run_processes(mls_with_ident, processes, cancel)
+    elif backend == 'thread':
+        finished = _run_threads(mls_with_ident, processes, cancel)
+    elif backend == 'serial':
+        finished = _run_serial(mls_with_ident, cancel)
+    else:
+        raise ValueError("Unknown backend: " + str(backend))
+    output = {}
+    iterations = 0
+    start = time.perf_counter()
+    for ident, result in finished:
+        output[ident] = result
+        if progress is not None:
+            iterations += _iterations(modelListSeries[ident])
+            progress(_progress(len(output), len(mls_with_ident),
+                               iterations, start))
+    results = ResultSeries()
+    for ident in sorted(output):
+        r, report = output[ident]
+        results += r
+        if report is not None:
+            profile.merge(report)
+    return results
+
+
+def apply_patch(modelList: ModelList, patch: Dict) -> ModelList:
+    """Return a copy of a list of models with some values changed.
+
+    A patch is a dictionary that maps paths to new values. A path is a tuple
+    consisting of the name (or index in the list) of a model, the names of
+    the groups leading to the group to change, if it isn't the model
+    itself, then 'compartments', 'transitions' or 'parameters' and the key
+    to set. E.g.
+
+    {
+        ('Urban informal', 'transitions', 'S_E'): 0.35,
+        ('Rural', '55-', 'compartments', 'S'): 650000,
+        (0, 'parameters', 'to'): 730
+    }
+
+    A parameter whose old and new values are both dictionaries, such as
+    transition_funcs, is updated with the new entries rather than replaced.
+    The models are not changed. Only the groups along the paths in the patch
+    are copied; the rest of the returned list shares the models' groups.
+
+    Parameters:
+    modelList (ModelList): list of models to patch
+    patch (dict): paths and the values to set them to
+    """
+    result = list(modelList)
+    copied = set()
+
+    def _own(container, key):
+        value = container[key]
+        if id(value) not in copied:
+            value = copy(value)
+            container[key] = value
+            copied.add(id(value))
+        return value
+
+    def _find(groups, name):
+        if isinstance(name, int):
+            return name
+        for i, group in enumerate(groups):
+            if group.get('name') == name:
+                return i
+        raise KeyError("No group named " + str(name))
+
+    for path, value in patch.items():
+        if len(path) < 3 or \
+           path[-2] not in ('compartments', 'transitions', 'parameters'):
+            raise ValueError("Invalid patch path: " + str(path))
+        group = _own(result, _find(result, path[0]))
+        for name in path[1:-2]:
+            groups = _own(group, 'groups')
+            group = _own(groups, _find(groups, name))
+        section, key = path[-2:]
+        if section in group:
+            values = _own(group, section)
+        else:
+            values = group[section] = {}
+            copied.add(id(values))
+        if section == 'parameters' and isinstance(value, dict) and \
+           isinstance(values.get(key), dict):
+            merged = dict(values[key])
+            merged.update(value)
+            value = merged
+        values[key] = value
+    return result
+
+
+_base = None
+
+
+def _set_base(modelList):
+    global _base
+    _base = modelList
+
+
+def _simulate_patch(m):
+    return _simulate((apply_patch(_base, m[0]),) + m[1:])
+
+
+def simulate_patches(modelList: ModelList, patches: List[Dict],
+                     processes=os.cpu_count(), profile=None,
+                     seed=None) -> ModelListSeries:
+    """Execute patched copies of a list of models in parallel.
+
+    This returns the same as
+    simulate_series([apply_patch(modelList, p) for p in patches], ...)
+    but is faster for large models, because the model list is sent to each
+    worker process only once, when it starts, and each run only sends its
+    patch. See apply_patch for the format of a patch.
+
+    Parameters:
+    modelList (ModelList): list of models to patch and execute
+    patches (list of dict): one patch for each run
     processes (int): number of CPU processes to use (default uses one
                      process for each CPU on the machine)
+    profile (Profile): if not None, the timings and counts of all the
+                       runs are added to this Profile
+    seed (int): if not None, each run is executed with seed + its
+                identifier (its position in patches) as the seed of the
+                random number generator
     """
-    mls_with_ident = [(m[0], m[1]) for m in
-                      zip(modelListSeries, range(len(modelListSeries)))]
-    with Pool(processes=processes) as pool:
-        output = pool.map(_simulate, mls_with_ident)
-    results = []
-    for r in output:
+    trace = None if profile is None else profile.trace is not None
+    tasks = [(patch, ident, trace, None if seed is None else seed + ident)
+             for ident, patch in enumerate(patches)]
+    with Pool(processes, _set_base, (modelList,)) as pool:
+        output = pool.map(_simulate_patch, tasks)
+    results = ResultSeries()
+    for r, report in output:
         results += r
+        if report is not None:
+            profile.merge(report)
+    return results
+
+
+def _continue_fork(m):
+    patch, at, ident, seed = m
+    if seed is not None:
+        random.seed(seed)
+    return _iterate(deepcopy(apply_patch(_base, patch)), ident, start=at)
+
+
+def simulate_forks(modelList: ModelList, at: int, patches: List[Dict],
+                   processes=1, seed=None) -> ModelListSeries:
+    """Run a list of models up to an iteration and then fork it.
+
+    Scenarios that only differ from some iteration onwards, such as an
+    intervention starting on day 60, share the same trajectory up to that
+    iteration. This function runs the models once up to iteration at, then
+    continues a copy of them from there for each patch (see apply_patch),
+    with the patch applied.
+
+    The result is the same as that of simulate_series for deterministic
+    model lists that are only changed by the patches from iteration at,
+    whether or not at is an iteration that is recorded: the series of each
+    fork, in the order of the patches and with their position as their
+    identifier, each starting with the model lists recorded before the
+    fork. A ValueError is raised if at is outside the run.
+
+    Only the 'dict' and 'gillespie' engines with one replicate can be
+    forked.
+
+    Parameters:
+    modelList (ModelList): list of related models to iterate
+    at (int): iteration to fork at, from the earliest 'from' parameter of
+              the models to the latest 'to'
+    patches (list of dict): the changes to make to each fork
+    processes (int): number of CPU processes to run the forks in
+    seed (int): if not None, the iterations before the fork are run with
+                this as the seed of the random number generator and each
+                fork with seed + its identifier + 1
+    """
+    models = _prepare(modelList)
+    parameters = models[0]['parameters']
+    if parameters['engine'] not in ('dict', 'gillespie') or \
+       parameters['replicates'] != 1:
+        raise ValueError("Only the dict and gillespie engines with one "
+                         "replicate can be forked")
+    from_ = min([m['parameters']['from'] for m in models])
+    to_ = max([m['parameters']['to'] for m in models])
+    if at < from_ or at > to_:
+        raise ValueError("Can't fork at iteration " + str(at) + ", which "
+                         "is outside the run from " + str(from_) + " to " +
+                         str(to_))
+    if seed is not None:
+        random.seed(seed)
+    # The forks compile the schedules again when they start
+    schedules = [(group['transitions'], key, value)
+                 for model in models for group in traverse(model)
+                 for key, value in group.get('transitions', {}).items()
+                 if isinstance(value, dict)]
+    steps = _steps(models)
+    prefix = []
+    if any(m['parameters']['record_first'] for m in models):
+        prefix.append(next(steps)[1])
+    if at > from_:
+        for iteration, recorded in steps:
+            if recorded is not None:
+                prefix.append(recorded)
+            if iteration == at:
+                break
+    steps.close()
+    for transitions, key, schedule in schedules:
+        transitions[key] = schedule
+
+    tasks = [(patch, at, ident, None if seed is None else seed + ident + 1)
+             for ident, patch in enumerate(patches)]
+    if processes == 1:
+        _set_base(models)
+        output = list(map(_continue_fork, tasks))
+        _set_base(None)
+    else:
+        with Pool(processes, _set_base, (models,)) as pool:
+            output = pool.map(_continue_fork, tasks)
+    results = ResultSeries()
+    for ident, forked in enumerate(output):
+        for recorded in prefix:
+            recorded = deepcopy(recorded)
+            for model in recorded:
+                model['ident'] = ident
+            results.append(recorded)
+        results += forked
     return results
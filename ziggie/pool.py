@@ -0,0 +1,167 @@
+"""Persistent pool of worker processes for running simulations.
+
+simulate_series starts a new pool of processes on each call, and these
+processes import ziggie and unpickle the models before they can start
+simulating. For services and interactive use, where many small batches of
+simulations are run, that overhead can exceed the time spent simulating.
+
+A SimulationPool keeps its worker processes alive between calls:
+
+    with SimulationPool(4, models={'seir': [seir]}) as pool:
+        future = pool.submit('seir', seed=1)
+        futures = pool.map([[model_a], [model_b]])
+        results = future.result()
+
+submit and map return concurrent.futures.Future objects. Model lists that
+are run often can be preloaded into the workers by name: their parameters
+are completed and their structures are compiled once when each worker
+starts and kept in memory for all the runs of models with those structures,
+and submitting them by name only sends the name, and any parameters to
+override or patch to apply (see macro.apply_patch), to the worker rather
+than the whole model list.
+
+Workers can be replaced after a number of tasks (maxtasks) so that any
+memory they accumulate is released.
+"""
+
+from concurrent.futures import Future
+from copy import deepcopy
+from multiprocessing import Pool
+import os
+import random
+from typing import Dict, List
+
+from ziggie import macro
+
+_preloaded = {}
+
+
+def _initialize(models):
+    _preloaded.clear()
+    macro._compiled.clear()
+    for name, modelList in models.items():
+        modelList = macro._prepare(modelList)
+        for model in modelList:
+            macro._compiled[macro._structure(model)] = \
+                macro._compile_cached(model)
+        _preloaded[name] = modelList
+
+
+def _run(task):
+    modelList, ident, seed, parameters, patch = task
+    if isinstance(modelList, str):
+        if modelList not in _preloaded:
+            raise KeyError("No model list preloaded as " + modelList)
+        modelList = deepcopy(macro.apply_patch(_preloaded[modelList],
+                                               patch or {}))
+    else:
+        modelList = macro._prepare(macro.apply_patch(modelList,
+                                                     patch or {}))
+    for model in modelList:
+        for key, value in (parameters or {}).items():
+            if isinstance(value, dict) and \
+               isinstance(model['parameters'].get(key), dict):
+                model['parameters'][key].update(value)
+            else:
+                model['parameters'][key] = value
+    if seed is not None:
+        random.seed(seed)
+    return macro._iterate(modelList, ident)
+
+
+class SimulationPool:
+    """Pool of long-lived worker processes that run simulations.
+
+    Parameters:
+    processes (int): number of worker processes (default one for each CPU
+                     on the machine)
+    models (dict): model lists to preload into each worker, keyed by the
+                   names they are submitted by
+    maxtasks (int): if not None, each worker is replaced by a new one after
+                    running this many tasks
+    """
+
+    def __init__(self, processes=os.cpu_count(),
+                 models: Dict[str, macro.ModelList] = None, maxtasks=None):
+        self.models = dict(models or {})
+        self._pool = Pool(processes, _initialize, (self.models,), maxtasks)
+
+    def submit(self, modelList, ident=None, seed=None, parameters=None,
+               patch=None) -> Future:
+        """Run a list of models in a worker and return a Future of the result.
+
+        The result of the Future is the time series of model lists that
+        simulate would return.
+
+        Parameters:
+        modelList (ModelList or str): list of related models to iterate, or
+                                      the name of a preloaded model list
+        ident (int): unique identifier to use to identify this time series
+        seed (int): if not None, the random number generator is seeded with
+                    this so that noisy runs can be reproduced
+        parameters (dict): if not None, parameters to override in every
+                           model in the list
+        patch (dict): if not None, changes to make to the model list (see
+                      macro.apply_patch)
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+        task = (modelList, ident, seed, parameters, patch)
+        self._pool.apply_async(_run, (task,),
+                               callback=future.set_result,
+                               error_callback=future.set_exception)
+        return future
+
+    def map(self, modelListSeries: List, seed=None,
+            parameters=None) -> List[Future]:
+        """Run a series of model lists and return a Future for each one.
+
+        Each model list is given its position in the series as its
+        identifier, as simulate_series does.
+
+        Parameters:
+        modelListSeries (list): model lists, or names of preloaded model
+                                lists, to run
+        seed (int): if not None, each model list is run with seed + its
+                    identifier as the seed of the random number generator
+        parameters (dict): if not None, parameters to override in every
+                           model
+        """
+        return [self.submit(modelList, ident,
+                            None if seed is None else seed + ident,
+                            parameters)
+                for ident, modelList in enumerate(modelListSeries)]
+
+    def simulate_series(self, modelListSeries: List,
+                        seed=None) -> macro.ModelListSeries:
+        """Run a series of model lists and return their time series.
+
+        This returns the same as macro.simulate_series but uses the workers
+        of the pool.
+
+        Parameters:
+        modelListSeries (list): model lists, or names of preloaded model
+                                lists, to run
+        seed (int): if not None, each model list is run with seed + its
+                    identifier as the seed of the random number generator
+        """
+        results = macro.ResultSeries()
+        for future in self.map(modelListSeries, seed):
+            results += future.result()
+        return results
+
+    def close(self):
+        """Wait for the submitted tasks to finish and stop the workers."""
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        """Stop the workers immediately, abandoning any unfinished tasks."""
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
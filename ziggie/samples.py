@@ -413,3 +413,44 @@ class MacroModels():
                 ]
             }
         ]
+
+    def synthetic(self, leaves=10, depth=1, compartments=3):
+        """Return a generated SIR-like model for scaling tests.
+
+        The model has the given number of leaf groups spread evenly over
+        a tree of the given depth. Its compartments are S, I, I2, ...
+        and R, with an infection transition in the top-level group and
+        progression rates that vary slightly between the leaves.
+        """
+        names = ['S', 'I'] + ['I' + str(i)
+                              for i in range(2, compartments - 1)] + ['R']
+        counter = [0]
+
+        def _group(n, level):
+            if level == depth or n == 1:
+                i = counter[0]
+                counter[0] += 1
+                group = {
+                    'name': str(i),
+                    'transitions': {},
+                    'compartments': dict.fromkeys(names, 0.0)
+                }
+                group['compartments']['S'] = 1000.0 + i % 7
+                if i == 0:
+                    group['compartments']['I'] = 1.0
+                for j in range(1, len(names) - 1):
+                    group['transitions'][names[j] + '_' + names[j + 1]] = \
+                        0.1 + 0.01 * ((i + j) % 5)
+                return group
+            branches = min(n, max(2, round(n ** (1.0 / (depth - level)))))
+            sizes = [n // branches + (1 if b < n % branches else 0)
+                     for b in range(branches)]
+            return {
+                'name': 'G' + str(level) + '_' + str(counter[0]),
+                'groups': [_group(size, level + 1) for size in sizes]
+            }
+
+        model = _group(leaves, 0)
+        model['name'] = 'Synthetic model'
+        model.setdefault('transitions', {})['S_I'] = 0.3
+        return model
@@ -0,0 +1,666 @@
+"""Vectorised engines for macro models.
+
+The engines in this module store the compartments of a model list in a NumPy
+array with the shape (replicates, models, groups, compartments), where groups
+are the groups with compartments (the leaves) of each model, and execute an
+iteration for all the groups and replicates at once. They are selected with
+the 'engine' parameter of the first model in the list:
+
+    * binomial - chain-binomial stochastic simulation. The compartments are
+                 whole numbers of individuals. On each iteration the number
+                 of individuals leaving a compartment is drawn from a
+                 binomial distribution with probability 1 - exp(-h), where
+                 h is the sum of the per capita rates of all the transitions
+                 out of it, and the leavers are split between the
+                 transitions with a multinomial draw in proportion to their
+                 rates. Births are drawn from a Poisson distribution. Small
+                 populations can therefore die out, unlike in the
+                 deterministic engine.
+
+The per capita rate of a transition is the value its transition function
+would return for a compartment of one individual, so only the built-in
+transition functions (delta_X_Y, delta_birth_X, delta_S_I and delta_S_I1)
+are supported. The model-wide totals used by the infection functions are
+calculated at the start of each iteration, and all the models in the list
+are updated together, after all their before_funcs have run and before
+their after_funcs are run.
+
+Functions in before_funcs and after_funcs are still called with the usual
+dictionaries: the compartments of each replicate are copied into the models
+before the functions are called and copied back afterwards. This is slow for
+many replicates, so models without such functions run fastest. They may
+change the values of compartments and transitions, but not add or remove
+them or replace their dictionaries (a ValueError is raised). Functions in
+before_array_funcs and after_array_funcs work on the arrays directly (see
+ArrayView).
+
+The arrays are float64 by default. Setting the 'precision' parameter of the
+first model to 'float32' halves their memory and the memory traffic of each
+iteration, at the cost of these error bounds:
+
+    * Every whole number up to 2**24 (16,777,216) is exact in float32, so
+      compartments that stay below it are updated exactly and the total
+      population is conserved exactly, as with float64.
+    * Larger compartments are rounded to the nearest float32 on each
+      update, a relative error of at most 2**-24 (about 6e-8), so after T
+      iterations a compartment is within a relative error of about
+      T * 6e-8 of its float64 value (2.2e-5 after 365 iterations) given
+      the same draws.
+    * The per capita rates and probabilities have relative errors of a few
+      times 2**-24, far smaller than the sampling noise of the binomial
+      draws.
+
+Use check_precision to measure the drift in the total population of a model
+list with both precisions.
+
+A single large model, e.g. with hundreds of districts as top-level groups,
+can be split between threads with the 'threads' parameter of the first
+model. The groups are only coupled through the model-wide totals, so on
+each iteration the totals are calculated once and then each thread updates
+a range of the groups (see ModelArrays.partitions). NumPy
+releases the GIL in its array operations and random draws, so the threads
+run on several cores. Each thread draws from its own random number
+generator, so the results depend on the number of threads as well as the
+seed. Small models run faster in one thread.
+
+This module requires NumPy.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+import random
+import time
+
+import numpy as np
+
+from ziggie import macro
+
+X_Y, BIRTH, S_I, S_I1 = range(4)
+
+KINDS = {
+    macro.delta_X_Y: X_Y,
+    macro.delta_birth_X: BIRTH,
+    macro.delta_S_I: S_I,
+    macro.delta_S_I1: S_I1,
+}
+
+
+class ModelArrays:
+    """The compartments and rates of a model list stored in arrays.
+
+    Attributes:
+    state - compartments, shape (replicates, models, groups, compartments)
+    rates - transition values, shape (replicates, models, groups, keys)
+    compartments - names of the compartments axis
+    keys - names of the transitions (keys) axis
+    present - whether each group has each compartment
+    has - whether each transition applies to each group
+    kind - which built-in transition function each transition uses
+    src, dst - index of the from and to compartment of each transition
+    source - matrix of shape (keys, compartments) selecting the from
+             compartment of each transition
+    incidence - matrix of shape (keys, compartments) that, multiplied by
+                the number of individuals moved by each transition, gives
+                the change in each compartment
+    groups - (model, group) indices of each group, keyed by the tuple of
+             names from the model down to the group
+    dtype - floating point type of the arrays, set by the 'precision'
+            parameter of the first model
+    integers - whether the compartments are numbers of individuals that
+               write copies back as ints, as the gillespie engine keeps
+               them
+    unsupported - transitions whose functions the engines in this module
+                  do not support
+
+    Parameters:
+    modelList (ModelList): models with complete parameters, as prepared by
+                           simulate
+    replicates (int): number of copies of the state
+    """
+
+    def __init__(self, modelList: macro.ModelList, replicates=1):
+        self.modelList = modelList
+        self.replicates = replicates
+        self.bound = [macro._compile_and_bind(m) for m in modelList]
+        self.integers = modelList[0]['parameters']['engine'] == 'gillespie'
+        self.compartments = []
+        self.keys = []
+        compartment_index = {}
+        key_index = {}
+        for bound in self.bound:
+            for compartments, transitions, _ in bound:
+                for c in compartments:
+                    if c not in compartment_index:
+                        compartment_index[c] = len(self.compartments)
+                        self.compartments.append(c)
+                for from_, to_, key, _, _ in transitions:
+                    if key not in key_index:
+                        key_index[key] = len(self.keys)
+                        self.keys.append(key)
+        self.compartment_index = compartment_index
+        self.key_index = key_index
+
+        M = len(modelList)
+        G = max(len(bound) for bound in self.bound)
+        C = len(self.compartments)
+        K = len(self.keys)
+        self.present = np.zeros((M, G, C), bool)
+        self.has = np.zeros((M, G, K), bool)
+        self.kind = np.zeros((M, G, K), np.int8)
+        self.unsupported = []
+        for m, bound in enumerate(self.bound):
+            for g, (compartments, transitions, _) in enumerate(bound):
+                for c in compartments:
+                    self.present[m, g, compartment_index[c]] = True
+                for _, _, key, _, func in transitions:
+                    k = key_index[key]
+                    self.has[m, g, k] = True
+                    if func in KINDS:
+                        self.kind[m, g, k] = KINDS[func]
+                    else:
+                        self.kind[m, g, k] = -1
+                        self.unsupported.append((key, func))
+        self.groups = {}
+        for m, model in enumerate(modelList):
+            for g, leaf in enumerate(macro.compile_model(model)['leaves']):
+                self.groups[tuple(leaf['names'])] = (m, g)
+        self.src = np.array([compartment_index[key.split("_")[0]]
+                             for key in self.keys], np.intp)
+        self.dst = np.array([compartment_index[key.split("_")[1]]
+                             for key in self.keys], np.intp)
+        self.dtype = np.dtype(modelList[0]['parameters']['precision'])
+        self.source = np.zeros((K, C), self.dtype)
+        self.source[np.arange(K), self.src] = 1.0
+        self.incidence = -self.source
+        self.incidence[np.arange(K), self.dst] += 1.0
+        self.alive = np.array([c[0] != 'D' for c in self.compartments])
+        # Transitions grouped so that no two in a group leave the same
+        # compartment, for splitting the individuals leaving a compartment
+        # between its transitions one transition at a time.
+        births = ((self.kind == BIRTH) | ~self.has).all(axis=(0, 1))
+        seen = {}
+        self.ranks = []
+        for k, src in enumerate(self.src):
+            if births[k]:
+                continue
+            rank = seen.get(src, 0)
+            seen[src] = rank + 1
+            if rank == len(self.ranks):
+                self.ranks.append([])
+            self.ranks[rank].append(k)
+        self.ranks = [np.array(keys, np.intp) for keys in self.ranks]
+        self.state = np.zeros((replicates, M, G, C), self.dtype)
+        self.rates = np.zeros((replicates, M, G, K), self.dtype)
+        self.hooks = any(m['parameters']['before_funcs'] or
+                         m['parameters']['after_funcs'] for m in modelList)
+        for r in range(replicates):
+            self.read(r)
+
+    def read(self, r):
+        """Copy the compartments and transitions of the models into arrays.
+
+        Parameters:
+        r (int): replicate to copy into
+        """
+        ci = self.compartment_index
+        ki = self.key_index
+        for m, bound in enumerate(self.bound):
+            state = self.state[r, m]
+            rates = self.rates[r, m]
+            for g, (compartments, transitions, _) in enumerate(bound):
+                for key, value in compartments.items():
+                    state[g, ci[key]] = value
+                for _, _, key, values, _ in transitions:
+                    rates[g, ki[key]] = values[key]
+        self.read_parameters()
+
+    def read_parameters(self):
+        """Copy the parameters used by the engines into arrays."""
+        M = len(self.modelList)
+        self.noise = np.zeros(M, self.dtype)
+        self.weights = np.zeros((M, len(self.compartments)), self.dtype)
+        for m, model in enumerate(self.modelList):
+            parameters = model['parameters']
+            self.noise[m] = parameters['noise']
+            for c, name in enumerate(self.compartments):
+                if name[0] == 'I':
+                    self.weights[m, c] = 1.0
+                elif name[0] == 'A':
+                    self.weights[m, c] = \
+                        parameters['asymptomatic_infectiousness']
+                elif name[0] == 'T':
+                    self.weights[m, c] = \
+                        parameters['treatment_infectiousness']
+
+    def write(self, r, rates=False):
+        """Copy the compartments of a replicate into the models.
+
+        Parameters:
+        r (int): replicate to copy from
+        rates (bool): whether to copy the transition values too
+        """
+        ci = self.compartment_index
+        ki = self.key_index
+        for m, bound in enumerate(self.bound):
+            state = self.state[r, m]
+            if self.integers:
+                state = np.rint(state).astype(np.int64)
+            state = state.tolist()
+            transition_values = self.rates[r, m].tolist() if rates else None
+            for g, (compartments, transitions, _) in enumerate(bound):
+                row = state[g]
+                for key in compartments:
+                    compartments[key] = row[ci[key]]
+                if rates:
+                    row = transition_values[g]
+                    for _, _, key, values, _ in transitions:
+                        values[key] = row[ki[key]]
+
+    def forces(self):
+        """Return the model-wide totals used by the infection transitions.
+
+        These are the only values shared between groups: for each replicate
+        and model, the proportion of the living population in the to
+        compartment of each transition, and the weighted proportion that is
+        infectious.
+        """
+        totals = self.state.sum(axis=2)
+        N = (totals * self.alive).sum(axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            to_ = np.where(N[..., None] != 0,
+                           totals[..., self.dst] / N[..., None], 0.0)
+            weighted = np.where(N != 0,
+                                (totals * self.weights).sum(axis=-1) / N,
+                                0.0)
+        return to_, weighted
+
+    def per_capita(self, active, groups=slice(None), forces=None):
+        """Return the per capita rate of every transition in every group.
+
+        Parameters:
+        active (array): 1.0 for each model that is iterated, else 0.0
+        groups (slice): the groups to calculate the rates of
+        forces (tuple): if not None, the model-wide totals returned by
+                        forces, to save calculating them again
+        """
+        to_, weighted = self.forces() if forces is None else forces
+        kind = self.kind[:, groups]
+        factor = np.where(kind == S_I, to_[:, :, None, :], 1.0)
+        factor = np.where(kind == S_I1, weighted[:, :, None, None], factor)
+        h = self.rates[:, :, groups] * factor * \
+            (self.has[:, groups] * active[:, None, None])
+        return h
+
+    def partitions(self, n):
+        """Return up to n slices of the groups axis of about equal size.
+
+        The groups are the leaves of the models in the order of the groups
+        axis, so each slice is a range of consecutive groups whatever the
+        names and depth of the models.
+
+        Parameters:
+        n (int): number of slices
+        """
+        G = self.state.shape[2]
+        n = max(1, min(n, G))
+        cuts = [round(k * G / n) for k in range(n + 1)]
+        return [slice(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+
+def binomial_step(arrays: ModelArrays, rng, active, groups=slice(None),
+                  forces=None):
+    """Execute one chain-binomial iteration of all groups and replicates.
+
+    Parameters:
+    arrays (ModelArrays): state to update
+    rng (numpy.random.Generator): random number generator
+    active (array): 1.0 for each model that is iterated, else 0.0
+    groups (slice): if given, only these groups are updated
+    forces (tuple): if not None, the model-wide totals at the start of the
+                    iteration (see ModelArrays.forces)
+    """
+    h = np.maximum(arrays.per_capita(active, groups, forces), 0.0)
+    noise = arrays.noise[:, None, None]
+    if noise.any():
+        h *= rng.uniform(1.0 - noise, 1.0 + noise, h.shape)
+    births = arrays.kind[:, groups] == BIRTH
+    exits = np.where(births, 0.0, h)
+    state = arrays.state[:, :, groups]
+    counts = np.zeros(h.shape, state.dtype)
+
+    if births.any():
+        mean = np.where(births, h, 0.0) * state[..., arrays.dst]
+        counts += rng.poisson(np.maximum(mean, 0.0))
+
+    H = exits @ arrays.source
+    population = np.maximum(np.rint(state), 0).astype(np.int64)
+    remaining = rng.binomial(population, -np.expm1(-H))
+    for keys in arrays.ranks:
+        src = arrays.src[keys]
+        rate = exits[..., keys]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p = np.where(H[..., src] > 0, rate / H[..., src], 0.0)
+        n = rng.binomial(remaining[..., src], np.clip(p, 0.0, 1.0))
+        counts[..., keys] += n
+        remaining[..., src] -= n
+        H[..., src] -= rate
+    state += counts @ arrays.incidence
+
+
+STEPS = {
+    'binomial': binomial_step,
+}
+
+
+# Runs a step on each partition of the groups in parallel. The model-wide
+# totals are calculated first, and the step returns once every partition
+# has been updated, so the partitions only interact through the totals, as
+# they do when the step is run on all the groups at once.
+def _parallel_step(step, arrays, rngs, active, executor, partitions):
+    forces = arrays.forces()
+    futures = [executor.submit(step, arrays, rng, active, groups, forces)
+               for groups, rng in zip(partitions, rngs)]
+    for future in futures:
+        future.result()
+
+
+def _hooks(arrays, name, ident, profile):
+    start = time.perf_counter()
+    modelList = arrays.modelList
+    fingerprints = [macro._fingerprint(m) for m in modelList]
+    for r in range(arrays.replicates):
+        arrays.write(r, arrays.replicates > 1)
+        for model in modelList:
+            if arrays.replicates > 1:
+                model['replicate'] = r
+            for func in model['parameters'][name]:
+                func(model, modelList)
+        macro._check_fingerprints(modelList, fingerprints,
+                                  modelList[0]['parameters']['engine'])
+        arrays.read(r)
+    if profile is not None:
+        profile._add(name, time.perf_counter() - start)
+
+
+class ArrayView:
+    """The state of a model list passed to functions in the array hooks.
+
+    Functions in the 'before_array_funcs' and 'after_array_funcs' parameters
+    of the first model in a list are called with an ArrayView once per
+    iteration (and replicate) instead of once per model. The state and rates
+    are views of the engine's arrays, so that changes to them are used by
+    the engine, e.g. to move a tenth of the infectious individuals of the
+    first group of every model to the second group:
+
+    def migrate(view):
+        i = view.compartments['I']
+        moved = 0.1 * view.state[:, 0, i]
+        view.state[:, 0, i] -= moved
+        view.state[:, 1, i] += moved
+
+    Attributes:
+    state - compartments, shape (models, groups, compartments)
+    rates - transition values, shape (models, groups, keys)
+    compartments - index of each compartment name in the last axis of state
+    keys - index of each transition key in the last axis of rates
+    groups - (model, group) indices of each group, keyed by the tuple of
+             names from the model down to the group
+    present - whether each group has each compartment
+    has - whether each transition applies to each group
+    modelList - the models
+    iteration - the iteration, as in the models' 'iteration' field
+    replicate - the replicate
+
+    Parameters:
+    arrays (ModelArrays): arrays of the engine
+    r (int): replicate to view
+    iteration (int): the current iteration
+    """
+
+    def __init__(self, arrays: ModelArrays, r: int, iteration: int):
+        self.state = arrays.state[r]
+        self.rates = arrays.rates[r]
+        self.compartments = arrays.compartment_index
+        self.keys = arrays.key_index
+        self.groups = arrays.groups
+        self.present = arrays.present
+        self.has = arrays.has
+        self.modelList = arrays.modelList
+        self.iteration = iteration
+        self.replicate = r
+
+
+def array_hooks(arrays: ModelArrays, name: str, iteration: int, sync=False,
+                profile=None):
+    """Call the array hooks of a model list with an ArrayView.
+
+    Parameters:
+    arrays (ModelArrays): arrays of the models
+    name (str): 'before_array_funcs' or 'after_array_funcs'
+    iteration (int): the current iteration
+    sync (bool): if True, the models are copied into the arrays before the
+                 functions are called and back afterwards, for engines
+                 that don't keep the state in the arrays
+    profile (Profile): if not None, the time taken is added to this
+                       Profile
+    """
+    start = time.perf_counter()
+    funcs = arrays.modelList[0]['parameters'][name]
+    for r in range(arrays.replicates):
+        if sync:
+            arrays.read(r)
+        view = ArrayView(arrays, r, iteration)
+        for func in funcs:
+            func(view)
+        if sync:
+            arrays.write(r, rates=True)
+    if profile is not None:
+        profile._add(name[:-len('_array_funcs')] + '_funcs',
+                     time.perf_counter() - start)
+
+
+def _schedule_cells(arrays, schedules):
+    # The (models, groups, keys) indices of the rates that each schedule
+    # sets, i.e. those of the groups that inherit the scheduled transition.
+    owners = {}
+    for s, (transitions, key, _) in enumerate(schedules):
+        owners[(id(transitions), key)] = s
+    cells = [([], [], []) for _ in schedules]
+    for m, bound in enumerate(arrays.bound):
+        for g, (_, transitions, _) in enumerate(bound):
+            for _, _, key, values, _ in transitions:
+                s = owners.get((id(values), key))
+                if s is not None:
+                    cells[s][0].append(m)
+                    cells[s][1].append(g)
+                    cells[s][2].append(arrays.key_index[key])
+    return [tuple(np.array(i, np.intp) for i in cell) for cell in cells]
+
+
+def _record(arrays, modelList, series, ident, profile):
+    for r in range(arrays.replicates):
+        arrays.write(r)
+        for model in modelList:
+            if ident is not None:
+                model['ident'] = ident
+            if arrays.replicates > 1:
+                model['replicate'] = r
+        series[r].append(macro._record(modelList) if profile is None
+                         else profile._record(modelList))
+
+
+def steps(modelList: macro.ModelList, ident=None, profile=None,
+          start=None):
+    """Iterate a list of models with a vectorised engine.
+
+    This is called by simulate when the 'engine' parameter of the first
+    model names one of the engines in this module. The 'replicates'
+    parameter of the first model gives the number of independent copies
+    to iterate. When it is more than one each recorded model gets a
+    'replicate' field.
+
+    This is a generator that yields an (iteration, recorded models) pair
+    for each iteration, with None if no models were recorded, and for the
+    initial and final records. With more than one replicate the recorded
+    models of all the replicates are yielded one after the other at the
+    end of the run, and are held in SpillSeries until then if the
+    'max_memory' parameter is set.
+
+    Parameters:
+    modelList (ModelList): models with complete parameters, as prepared by
+                           simulate
+    ident (int): identifier to give the recorded models
+    profile (Profile): if not None, timings and counts of the run are added
+                       to this Profile
+    start (int): if not None, the iteration to resume the models from,
+                 without recording their initial state
+    """
+    parameters = modelList[0]['parameters']
+    step = STEPS[parameters['engine']]
+    replicates = parameters['replicates']
+    rng = np.random.default_rng(random.getrandbits(64))
+    begin = min([m['parameters']['from'] for m in modelList])
+    from_ = begin if start is None else max(begin, start)
+    to_ = max([m['parameters']['to'] for m in modelList])
+    schedules = macro._schedules(modelList, begin, to_)
+    arrays = ModelArrays(modelList, replicates)
+    if arrays.unsupported:
+        key, func = arrays.unsupported[0]
+        raise ValueError("Transition " + key + " uses " + func.__qualname__ +
+                         ", which the vectorised engines do not support")
+    cells = _schedule_cells(arrays, schedules)
+    if parameters['threads'] > 1:
+        partitions = arrays.partitions(parameters['threads'])
+        rngs = [np.random.default_rng(random.getrandbits(64))
+                for _ in partitions]
+    if parameters['engine'] == 'binomial':
+        arrays.state = np.rint(arrays.state)
+    if replicates > 1 and parameters['max_memory'] is not None:
+        # The records of each replicate are held until the end of the run,
+        # so they share half of the memory budget, leaving the other half
+        # for the series they are collected into
+        series = [macro.SpillSeries(
+                      max(1, parameters['max_memory'] // (2 * replicates)))
+                  for _ in range(replicates)]
+    else:
+        series = [[] for _ in range(replicates)]
+
+    def _pop(iteration):
+        if replicates == 1 and len(series[0]) > 0:
+            return iteration, series[0].pop()
+        return iteration, None
+
+    first = [m for m in modelList
+             if m['parameters']['record_first'] and start is None]
+    for model in first:
+        model['iteration'] = 0
+    if len(first) > 0:
+        _record(arrays, first, series, ident, profile)
+        if replicates == 1:
+            yield _pop(0)
+
+    # Started after the first record, so that closing the generator at any
+    # later yield shuts the threads down
+    executor = None
+    if parameters['threads'] > 1:
+        executor = ThreadPoolExecutor(len(partitions))
+    try:
+        for iteration in range(from_, to_):
+            active = np.zeros(len(modelList), arrays.dtype)
+            for m, model in enumerate(modelList):
+                if iteration < model['parameters']['from'] or \
+                   iteration >= model['parameters']['to']:
+                    break
+                active[m] = 1.0
+                model['iteration'] = iteration + 1
+                if ident is not None:
+                    model['ident'] = ident
+            if profile is not None:
+                profile._start_iteration(iteration + 1, ident)
+            if schedules and \
+               macro._apply_schedules(schedules, iteration, begin):
+                for (transitions, key, _), cell in zip(schedules, cells):
+                    arrays.rates[(slice(None),) + cell] = transitions[key]
+            if arrays.hooks:
+                _hooks(arrays, 'before_funcs', ident, profile)
+            if parameters['before_array_funcs']:
+                array_hooks(arrays, 'before_array_funcs', iteration + 1,
+                            profile=profile)
+            t0 = time.perf_counter()
+            if executor is None:
+                step(arrays, rng, active)
+            else:
+                _parallel_step(step, arrays, rngs, active, executor,
+                               partitions)
+            if profile is not None:
+                profile._add('update_compartments', time.perf_counter() - t0)
+                profile.iterations += int(active.sum()) * replicates
+            if arrays.hooks:
+                _hooks(arrays, 'after_funcs', ident, profile)
+            if parameters['after_array_funcs']:
+                array_hooks(arrays, 'after_array_funcs', iteration + 1,
+                            profile=profile)
+            recorded = [model for m, model in enumerate(modelList)
+                        if active[m] and (iteration + 1) %
+                        model['parameters']['record_frequency'] == 0]
+            if len(recorded) > 0:
+                _record(arrays, recorded, series, ident, profile)
+            yield _pop(iteration + 1)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if profile is not None:
+        profile._current = None
+    last = [m for m in modelList if m['parameters']['record_last']]
+    for model in last:
+        model['iteration'] = to_
+    if len(last) > 0:
+        _record(arrays, last, series, ident, profile)
+        if replicates == 1:
+            yield _pop(to_)
+
+    if replicates > 1:
+        for s in series:
+            for recorded in s:
+                yield to_, recorded
+            if isinstance(s, macro.SpillSeries):
+                s.close()
+
+
+def iterate(modelList: macro.ModelList, ident=None, profile=None):
+    """Return the ModelListSeries of models iterated by steps.
+
+    Parameters:
+    modelList (ModelList): models with complete parameters, as prepared by
+                           simulate
+    ident (int): identifier to give the recorded models
+    profile (Profile): if not None, timings and counts of the run are added
+                       to this Profile
+    """
+    return [recorded for _, recorded in steps(modelList, ident, profile)
+            if recorded is not None]
+
+
+def check_precision(modelList: macro.ModelList, seed=None):
+    """Return the population drift of a model list in float64 and float32.
+
+    The model list is simulated with each precision and the largest
+    conservation_drift of each run is returned, keyed by 'float64' and
+    'float32', so the rounding error of float32 can be checked before
+    using it for large runs.
+
+    Parameters:
+    modelList (ModelList): list of related models to iterate with the
+                           binomial engine
+    seed (int): if not None, the random number generator is seeded with
+                this for each run
+    """
+    drift = {}
+    for precision in ('float64', 'float32'):
+        models = deepcopy(modelList)
+        for model in models:
+            model.setdefault('parameters', {})['precision'] = precision
+        results = macro.simulate(models, seed=seed)
+        drift[precision] = max(macro.conservation_drift(results),
+                               default=0.0)
+    return drift